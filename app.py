@@ -5,16 +5,52 @@ Flask server to automatically create aliases via Mailcow API
 """
 
 import os
+import re
+import codecs
 import json
+import base64
+import hashlib
+import heapq
+import glob
+import gzip
+import atexit
+import contextlib
+import shutil
+import sqlite3
 import hmac
+import ipaddress
+import secrets
+import signal
+import threading
+import time
 import requests
-from flask import Flask, request, jsonify, send_from_directory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from werkzeug.security import check_password_hash
+from limits import parse_many
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+from limits.storage import Storage
+from werkzeug.security import check_password_hash, generate_password_hash
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from functools import lru_cache
+from types import MappingProxyType
+from urllib.parse import parse_qs, quote
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, single-process use only
+    fcntl = None
+try:
+    import brotli
+except ImportError:  # optional: static assets are then only precompressed with gzip
+    brotli = None
 # The bundled widget (altcha.js, v3.1.0) speaks the ALTCHA v1 challenge
 # protocol. altcha-python 2.x made the v2 protocol the default and moved v1
 # behind the *_v1 names, so pin the v1 API explicitly rather than relying on
@@ -28,6 +64,57 @@ __version__ = "1.0.4"  # x-release-please-version
 # more work. Tests solve challenges with the same bound, hence the constant.
 ALTCHA_MAX_NUMBER = 10000
 
+# Default lifetime of an ALTCHA challenge (config "altcha_challenge_ttl").
+# Solved challenges are remembered in the shared state store for this long to
+# reject replays, so the store holds (verifications per second x TTL) entries.
+ALTCHA_CHALLENGE_TTL = 3600
+
+# Sustained rate of successful ALTCHA verifications the memory:// store keeps
+# replay markers for. Beyond it, new verifications are refused until markers
+# expire, rather than forgetting live ones.
+ALTCHA_VERIFICATIONS_PER_SECOND = 10
+
+# Adaptive difficulty: the challenge's max number doubles each time the failed
+# logins seen in the sliding window reach another multiple of the threshold for
+# the client IP, its subnet (/24 IPv4, /64 IPv6) or the whole site, up to
+# "altcha_max_number_cap". Expected client work is proportional to it.
+DEFAULT_ALTCHA_FAILURE_THRESHOLDS = {'ip': 5, 'subnet': 20, 'global': 100}
+ALTCHA_MAX_NUMBER_CAP = 1000000
+AUTH_FAILURE_WINDOW = 600
+
+# Prometheus metrics, served on /metrics. Under Gunicorn, docker-start.sh sets
+# PROMETHEUS_MULTIPROC_DIR so that every worker writes its samples there and
+# /metrics reports the sum over all workers (see gunicorn.conf.py).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REQUESTS = Counter('http_requests_total', 'HTTP requests', ['route', 'method', 'status'])
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response (headers, for streams)',
+    ['route', 'method'], buckets=LATENCY_BUCKETS,
+)
+MAILCOW_LATENCY = Histogram(
+    'mailcow_api_duration_seconds', 'Mailcow API call latency', ['endpoint'], buckets=LATENCY_BUCKETS,
+)
+MAILCOW_ERRORS = Counter('mailcow_api_errors_total', 'Failed Mailcow API calls', ['endpoint', 'error'])
+AUTH_SUCCESSES = Counter('auth_successes_total', 'Successful logins')
+AUTH_FAILURES = Counter('auth_failures_total', 'Failed login attempts', ['reason'])
+ALTCHA_VERIFY_LATENCY = Histogram(
+    'altcha_verify_duration_seconds', 'ALTCHA solution verification time', ['provider', 'result'],
+    buckets=LATENCY_BUCKETS,
+)
+ALTCHA_DIFFICULTY = Histogram(
+    'altcha_challenge_max_number', 'Max number of issued ALTCHA challenges',
+    buckets=[ALTCHA_MAX_NUMBER << level for level in range(8)],
+)
+GATECHA_LATENCY = Histogram(
+    'gatecha_verify_seconds', 'GateCHA verify call latency', ['outcome'], buckets=LATENCY_BUCKETS,
+)
+GATECHA_SHORT_CIRCUITS = Counter(
+    'gatecha_short_circuits_total', 'Verifications not sent to GateCHA because the breaker was open',
+)
+CONFIG_RELOADS = Counter('config_reloads_total', 'Configuration file (re)loads')
+# Hit ratio per cache: config snapshot, derived values, alias index, GateCHA verdicts.
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+
 # Logging configuration
 # In Docker, we only log to console (best practice for containers)
 if os.getenv('DOCKER_CONTAINER'):
@@ -40,7 +127,7 @@ if os.getenv('DOCKER_CONTAINER'):
     log_dir = '/app/logs'  # For compatibility with log saving functions
 else:
     # Local environment - try file logging with fallback
-    log_dir = '/app/logs'
+    log_dir = os.getenv('LOG_DIR', '/app/logs')
     log_file = os.path.join(log_dir, 'mailcow_alias.log')
     
     handlers = [logging.StreamHandler()]
@@ -58,6 +145,347 @@ else:
     )
 logger = logging.getLogger(__name__)
 
+# --- Shared state ---
+# Rate-limit counters and short-lived markers (alias reservations, ...) live in
+# a backend chosen by STATE_STORAGE_URI so that every gunicorn worker sees the
+# same values:
+#   memory://                 per-process (single worker / development)
+#   sqlite:///relative/path   SQLite file shared by all workers on one host
+#   sqlite:////absolute/path  (no external service required)
+#   redis://host:6379/0       Redis, shared across hosts (needs `pip install redis`)
+# Values must be JSON-serialisable. Expiry times are wall-clock (time.time())
+# since they are shared between processes.
+
+
+class StateStoreFull(Exception):
+    """A pinned key could not be stored without dropping a live one"""
+
+
+class MemoryStateBackend:
+    """Per-process state with TTLs, bounded to `max_entries` keys.
+
+    Expired entries are dropped as writes come in, from a heap of expiry
+    times (no scan of the whole store). When still full, the least recently
+    written entries go.
+
+    Keys starting with one of `pinned_prefixes` are never evicted early: they
+    are kept apart, up to `max_pinned` of them, and storing a new one while
+    that many are live raises StateStoreFull.
+    """
+
+    def __init__(self, max_entries=100000, clock=time.time, pinned_prefixes=(), max_pinned=0):
+        self.max_entries = max_entries
+        self.pinned_prefixes = tuple(pinned_prefixes)
+        self.max_pinned = max_pinned
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._pinned = {}  # same, for keys under pinned_prefixes
+        # (expires_at, key), including stale pairs of keys since rewritten or
+        # deleted: they are skipped when popped, and dropped by _compact().
+        self._expiries = []
+
+    def _table(self, key):
+        return self._pinned if key.startswith(self.pinned_prefixes) else self._data
+
+    def _live(self, key, now):
+        table = self._table(key)
+        entry = table.get(key)
+        if entry is not None and entry[1] <= now:
+            del table[key]
+            return None
+        return entry
+
+    def _expire(self, now):
+        expiries = self._expiries
+        while expiries and expiries[0][0] <= now:
+            expires_at, key = heapq.heappop(expiries)
+            table = self._table(key)
+            entry = table.get(key)
+            if entry is not None and entry[1] == expires_at:
+                del table[key]
+
+    def _compact(self):
+        self._expiries = [(entry[1], key) for table in (self._data, self._pinned)
+                          for key, entry in table.items()]
+        heapq.heapify(self._expiries)
+
+    def _store(self, key, value, expires_at):
+        self._expire(self._clock())
+        table = self._table(key)
+        if table is self._pinned and key not in table and len(table) >= self.max_pinned:
+            raise StateStoreFull(key)
+        table[key] = (value, expires_at)
+        heapq.heappush(self._expiries, (expires_at, key))
+        if table is self._data:
+            table.move_to_end(key)
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+        if len(self._expiries) > 2 * (len(self._data) + len(self._pinned)) + 1024:
+            self._compact()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live(key, self._clock())
+        return default if entry is None else entry[0]
+
+    def expiry(self, key):
+        """Wall-clock expiry time of key, or None if it is not set"""
+        with self._lock:
+            entry = self._live(key, self._clock())
+        return None if entry is None else entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store(key, value, self._clock() + ttl)
+
+    def add(self, key, value, ttl):
+        """Set key only if it is not already set; True if it was set"""
+        now = self._clock()
+        with self._lock:
+            if self._live(key, now) is not None:
+                return False
+            self._store(key, value, now + ttl)
+            return True
+
+    def incr(self, key, ttl, amount=1):
+        """Increment a counter; the expiry is fixed when the counter is created"""
+        now = self._clock()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                self._store(key, amount, now + ttl)
+                return amount
+            value = entry[0] + amount
+            self._table(key)[key] = (value, entry[1])
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._table(key).pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._pinned.clear()
+            self._expiries.clear()
+
+
+class SQLiteStateBackend:
+    """State in a SQLite file, shared by all workers on the host.
+
+    Read-modify-write operations run inside BEGIN IMMEDIATE transactions, so
+    increments from concurrent workers are not lost. Expired rows are purged
+    every `PURGE_EVERY` writes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_state_expires ON state(expires_at);
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly below.
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    self._schema_ready = True
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM state WHERE expires_at <= ?', (self._clock(),))
+
+    def _row(self, conn, key, now):
+        return conn.execute(
+            'SELECT value, expires_at FROM state WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+
+    def get(self, key, default=None):
+        row = self._row(self._connect(), key, self._clock())
+        return default if row is None else json.loads(row[0])
+
+    def expiry(self, key):
+        row = self._row(self._connect(), key, self._clock())
+        return None if row is None else row[1]
+
+    def set(self, key, value, ttl):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), self._clock() + ttl),
+            )
+
+    def add(self, key, value, ttl):
+        now = self._clock()
+        with self._transaction() as conn:
+            if self._row(conn, key, now) is not None:
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), now + ttl),
+            )
+            return True
+
+    def incr(self, key, ttl, amount=1):
+        now = self._clock()
+        with self._transaction() as conn:
+            row = self._row(conn, key, now)
+            if row is None:
+                value, expires_at = amount, now + ttl
+            else:
+                value, expires_at = json.loads(row[0]) + amount, row[1]
+            conn.execute(
+                'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), expires_at),
+            )
+            return value
+
+    def delete(self, key):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM state')
+
+
+class RedisStateBackend:
+    """State in Redis, shared across hosts. Keys are namespaced with `prefix`."""
+
+    def __init__(self, uri, prefix='mailcow-alias:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(f"{uri.split(':', 1)[0]}:// state storage requires the 'redis' package")
+        self._redis = redis.Redis.from_url(uri)
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self._redis.get(self.prefix + key)
+        return default if value is None else json.loads(value)
+
+    def expiry(self, key):
+        ttl_ms = self._redis.pttl(self.prefix + key)
+        return None if ttl_ms < 0 else time.time() + ttl_ms / 1000
+
+    def set(self, key, value, ttl):
+        self._redis.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def add(self, key, value, ttl):
+        return bool(self._redis.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)), nx=True))
+
+    def incr(self, key, ttl, amount=1):
+        # Create the counter with its expiry first; INCRBY keeps the TTL.
+        pipe = self._redis.pipeline()
+        pipe.set(self.prefix + key, 0, px=max(1, int(ttl * 1000)), nx=True)
+        pipe.incrby(self.prefix + key, amount)
+        return pipe.execute()[1]
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._redis.scan_iter(match=self.prefix + '*'):
+            self._redis.delete(key)
+
+
+def _sqlite_path(uri):
+    """File path of a sqlite:// URI (sqlite:///relative, sqlite:////absolute)"""
+    path = uri.split('://', 1)[1]
+    return path[1:] if path.startswith('/') else path
+
+
+def create_state_backend(uri):
+    """Backend for a STATE_STORAGE_URI value"""
+    scheme = uri.split('://', 1)[0] if '://' in uri else ''
+    if scheme == 'memory':
+        # Replay markers must outlive their challenge, so they are not evicted.
+        return MemoryStateBackend(
+            pinned_prefixes=('altcha-used:',),
+            max_pinned=ALTCHA_VERIFICATIONS_PER_SECOND * ALTCHA_CHALLENGE_TTL,
+        )
+    if scheme == 'sqlite':
+        return SQLiteStateBackend(_sqlite_path(uri))
+    if scheme in ('redis', 'rediss', 'redis+unix'):
+        return RedisStateBackend(uri)
+    raise ValueError(f"Unsupported state storage URI: {uri!r}")
+
+
+class SQLiteLimiterStorage(Storage):
+    """flask-limiter storage for sqlite:// URIs, backed by SQLiteStateBackend.
+
+    memory:// and redis:// URIs use the storages bundled with `limits`.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.backend = SQLiteStateBackend(_sqlite_path(uri))
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key, expiry, amount=1):
+        return self.backend.incr(key, expiry, amount)
+
+    def get(self, key):
+        return self.backend.get(key, 0)
+
+    def get_expiry(self, key):
+        return self.backend.expiry(key) or time.time()
+
+    def check(self):
+        try:
+            self.backend.get('limiter:check')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        self.backend.clear()
+
+    def clear(self, key):
+        self.backend.delete(key)
+
+
+STATE_STORAGE_URI = os.getenv('STATE_STORAGE_URI', 'memory://')
+state_backend = create_state_backend(STATE_STORAGE_URI)
+
+
 # Prefixes used by Werkzeug-generated password hashes.
 _HASH_PREFIXES = ('pbkdf2:', 'scrypt:', 'argon2')
 
@@ -65,17 +493,45 @@ app = Flask(__name__)
 CORS(app)
 
 # Rate limiting (brute-force protection). Limits are opt-in per route via the
-# decorator below. Uses in-memory storage by default — note that with multiple
-# gunicorn workers each worker keeps its own counters, so the effective limit is
-# multiplied by the worker count. Set RATELIMIT_STORAGE_URI (e.g. a redis:// URL)
-# for a shared, strict limit across workers.
+# decorators below. Counters live in the shared state storage (see
+# STATE_STORAGE_URI) so that the limit holds across gunicorn workers; with
+# memory:// each worker keeps its own counters and the effective limit is
+# multiplied by the worker count. RATELIMIT_STORAGE_URI still overrides the
+# limiter storage on its own.
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
     default_limits=[],
-    storage_uri=os.getenv('RATELIMIT_STORAGE_URI', 'memory://'),
+    storage_uri=os.getenv('RATELIMIT_STORAGE_URI', STATE_STORAGE_URI),
 )
 
+# Per-endpoint limits, overridable with the "rate_limits" config key. The
+# alias endpoints count per signed-in user (per client IP for requests without
+# a valid session token); logins and ALTCHA challenges count per client IP.
+DEFAULT_RATE_LIMITS = {
+    'create_alias': '30 per minute; 500 per day',
+    'create_aliases': '5 per minute; 50 per day',
+    'generate_alias': '60 per minute',
+    'altcha_challenge': '30 per minute',
+    'auth': '10 per minute; 50 per hour',
+    'manage_alias': '60 per minute',
+}
+
+
+def rate_limit_key():
+    """Rate-limit bucket: the session user, or the client IP when there is none"""
+    config = load_config()
+    user_id = session_user(config) if config else None
+    return f"user:{user_id}" if user_id else get_remote_address()
+
+
+def configured_rate_limit(name):
+    """Limit string provider for `name`, read from the current configuration"""
+    def limit():
+        config = load_config() or {}
+        return config.get('rate_limits', {}).get(name, DEFAULT_RATE_LIMITS[name])
+    return limit
+
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
@@ -97,7 +553,10 @@ DEFAULT_CONFIG = {
     # Only used when altcha_provider == "gatecha":
     "gatecha_url": "https://gatecha.example.com",
     "gatecha_api_key": "gk_your_api_key",
+    "_comment_session_secret": "Recommended: add \"session_secret\" (output of: head -c32 /dev/urandom | base64) to sign login session tokens. Without it a key is derived from api_key.",
     "port": 5000,
+    # Ask for a username at login: one hash verification instead of one per user.
+    "username_login": False,
     "users": {
         "user1": {
             "password": "password_user1",
@@ -112,10 +571,11 @@ DEFAULT_CONFIG = {
     }
 }
 
-def load_config():
-    """Load configuration from config.json file"""
-    config_file = 'config.json'
-    
+CONFIG_FILE = 'config.json'
+
+
+def _read_config(config_file):
+    """Parse and validate the configuration file, returning None if it is unusable"""
     if not os.path.exists(config_file):
         logger.warning(f"Configuration file {config_file} not found. Creating sample file.")
         with open('config.sample.json', 'w', encoding='utf-8') as f:
@@ -141,6 +601,17 @@ def load_config():
                 logger.error(f"Parameter '{key}' missing or not configured in config.json")
                 return None
 
+        # Check the additional Mailcow instances
+        instances = config.get('mailcow_instances', {})
+        if not isinstance(instances, dict) or DEFAULT_MAILCOW_INSTANCE in instances:
+            logger.error(f"Parameter 'mailcow_instances' must map names other than "
+                         f"'{DEFAULT_MAILCOW_INSTANCE}' to instances in config.json")
+            return None
+        for name, instance in instances.items():
+            if not isinstance(instance, dict) or not instance.get('url') or not instance.get('api_key'):
+                logger.error(f"Mailcow instance '{name}' needs a 'url' and an 'api_key' in config.json")
+                return None
+
         # Check domains configuration
         if not config.get('domains') or not isinstance(config['domains'], list) or len(config['domains']) == 0:
             logger.error("Parameter 'domains' missing or not configured properly in config.json")
@@ -150,6 +621,14 @@ def load_config():
         if not config.get('default_domain'):
             config['default_domain'] = config['domains'][0]
 
+        # Drop unparsable rate limits so the endpoint keeps its default.
+        for name, value in list(config.get('rate_limits', {}).items()):
+            try:
+                parse_many(value)
+            except (TypeError, ValueError):
+                logger.warning(f"Invalid rate limit {value!r} for '{name}', using the default")
+                del config['rate_limits'][name]
+
         # Warn if any user still uses a plaintext password instead of a hash.
         plaintext_users = [
             uid for uid, uc in config.get('users', {}).items()
@@ -171,30 +650,284 @@ def load_config():
         logger.error(f"Error loading configuration: {e}")
         return None
 
+
+def _freeze(value):
+    """Return a read-only copy of a parsed JSON value (dicts and lists, recursively)"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class ConfigStore:
+    """Validated, read-only snapshot of the configuration file.
+
+    The file is parsed and validated once; later calls only stat() it and
+    re-parse when its identity (inode, mtime, size) changes or a reload was
+    requested with SIGHUP. Validation warnings are therefore logged once per
+    reload rather than once per request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reload_count = 0
+        self._lock = threading.Lock()
+        self._stamp = object()  # never equal to a real stamp: forces the first load
+        self._snapshot = None
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self):
+        """Return the current snapshot (None if the configuration is invalid)"""
+        stamp = self._file_stamp()
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    config = _read_config(self.path)
+                    self._snapshot = _freeze(config) if config else None
+                    self._stamp = stamp
+                    self.reload_count += 1
+                    CONFIG_RELOADS.inc()
+                    CACHE_LOOKUPS.labels(cache='config', result='miss').inc()
+                    if config:
+                        logger.info(f"Configuration loaded from {self.path}")
+                    return self._snapshot
+        CACHE_LOOKUPS.labels(cache='config', result='hit').inc()
+        return self._snapshot
+
+    def invalidate(self):
+        """Force a re-read on the next get(), even if the file looks unchanged"""
+        self._stamp = object()
+
+
+config_store = ConfigStore(CONFIG_FILE)
+
+
+def load_config():
+    """Return the current configuration snapshot (None if invalid)"""
+    return config_store.get()
+
+
+# Values derived from a configuration snapshot (lookup tables, validators),
+# built on first use and dropped with the snapshot. Entries hold a reference to
+# their snapshot, so an id() cannot be reused while it is cached.
+_derived_cache = {}
+_derived_lock = threading.Lock()
+_MAX_DERIVED_SNAPSHOTS = 8
+
+
+def derived(config, name, build):
+    """Return build(config), computed once per configuration snapshot"""
+    entry = _derived_cache.get(id(config))
+    if entry is None or entry[0] is not config:
+        with _derived_lock:
+            entry = _derived_cache.get(id(config))
+            if entry is None or entry[0] is not config:
+                if len(_derived_cache) >= _MAX_DERIVED_SNAPSHOTS:
+                    _derived_cache.pop(next(iter(_derived_cache)))
+                entry = (config, {})
+                _derived_cache[id(config)] = entry
+    values = entry[1]
+    if name not in values:
+        CACHE_LOOKUPS.labels(cache='derived', result='miss').inc()
+        values[name] = build(config)
+    else:
+        CACHE_LOOKUPS.labels(cache='derived', result='hit').inc()
+    return values[name]
+
+
+def _handle_sighup(signum, frame):
+    # Only flag the snapshot as stale: logging or file I/O inside a signal
+    # handler can deadlock. The next request performs the reload.
+    config_store.invalidate()
+
+
+if hasattr(signal, 'SIGHUP'):
+    try:
+        signal.signal(signal.SIGHUP, _handle_sighup)
+    except ValueError:
+        # Not imported from the main thread; mtime checks still apply.
+        pass
+
+class MailcowClient:
+    """Mailcow API client over a pooled, keep-alive HTTP session.
+
+    One client is shared by all requests of a worker (see get_mailcow_client),
+    so alias creation reuses a warm TCP/TLS connection instead of paying a new
+    handshake each time. Idempotent GETs are retried with exponential backoff
+    on connection errors and 502/503/504; POSTs are only retried when the
+    connection could not be established (the request never reached Mailcow).
+    """
+
+    def __init__(self, base_url, api_key, timeout=10, pool_size=10, retries=2, backoff=0.3):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'X-API-Key': api_key,
+            'Content-Type': 'application/json',
+        })
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, endpoint, timeout=None, label=None, **kwargs):
+        """Call /api/v1/{endpoint} and return the raw response.
+
+        Metrics are labelled with `label` (default: the endpoint), which must
+        not vary per call: pass a template for paths that embed a value.
+        """
+        url = f"{self.base_url}/api/v1/{endpoint}"
+        label = label or endpoint
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            MAILCOW_ERRORS.labels(endpoint=label, error=type(e).__name__).inc()
+            raise
+        finally:
+            MAILCOW_LATENCY.labels(endpoint=label).observe(time.perf_counter() - start)
+        if response.status_code >= 400:
+            MAILCOW_ERRORS.labels(endpoint=label, error=f'HTTP {response.status_code}').inc()
+        return response
+
+    def add_alias(self, address, goto, sogo_visible=True, active=True):
+        return self.request('POST', 'add/alias', json={
+            'address': address,
+            'goto': goto,
+            'active': 1 if active else 0,
+            'sogo_visible': 1 if sogo_visible else 0,
+        })
+
+    def get_aliases(self):
+        """Streamed: read the body with iter_aliases() rather than .json()"""
+        return self.request('GET', 'get/alias/all', stream=True)
+
+    def get_alias(self, address):
+        """One alias, looked up by address (or id)"""
+        return self.request('GET', f"get/alias/{quote(address, safe='@')}", label='get/alias/{address}')
+
+    def edit_aliases(self, alias_ids, attr):
+        return self.request('POST', 'edit/alias', json={
+            'items': [str(alias_id) for alias_id in alias_ids],
+            'attr': attr,
+        })
+
+    def delete_aliases(self, alias_ids):
+        """Delete several aliases in one call"""
+        return self.request('POST', 'delete/alias', json=[str(alias_id) for alias_id in alias_ids])
+
+    def get_version(self, timeout=None):
+        """Cheapest authenticated endpoint, used as a health probe"""
+        return self.request('GET', 'get/status/version', timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+# Name of the instance described by the top-level mailcow_url/api_key keys.
+DEFAULT_MAILCOW_INSTANCE = 'default'
+
+
+def mailcow_instance_names(config):
+    """All configured Mailcow instances, the default one first"""
+    return [DEFAULT_MAILCOW_INSTANCE] + list(config.get('mailcow_instances', {}))
+
+
+def mailcow_instance_settings(config, instance=DEFAULT_MAILCOW_INSTANCE):
+    """(url, api_key, timeout, pool_size, retries, backoff) of a Mailcow instance.
+
+    Entries of "mailcow_instances" fall back to the top-level mailcow_timeout,
+    mailcow_pool_size, ... for the settings they leave out.
+    """
+    defaults = (
+        config.get('mailcow_timeout', 10),
+        config.get('mailcow_pool_size', 10),
+        config.get('mailcow_retries', 2),
+        config.get('mailcow_retry_backoff', 0.3),
+    )
+    if instance == DEFAULT_MAILCOW_INSTANCE:
+        return (config['mailcow_url'], config['api_key']) + defaults
+    entry = config['mailcow_instances'][instance]
+    return (entry['url'], entry['api_key']) + tuple(
+        entry.get(name, default)
+        for name, default in zip(('timeout', 'pool_size', 'retries', 'retry_backoff'), defaults)
+    )
+
+
+# Per-process client cache, keyed on everything that shapes the client so a
+# config reload with new settings gets a fresh pool. The PID is part of the key
+# because pooled sockets must never be shared across a fork. Each instance has
+# its own entry, hence its own connection pool.
+_mailcow_clients = {}
+_mailcow_clients_lock = threading.Lock()
+_MAX_MAILCOW_CLIENTS = 64
+
+
+def get_mailcow_client(config, instance=DEFAULT_MAILCOW_INSTANCE):
+    """Return the shared MailcowClient for this worker, configuration and instance"""
+    settings = mailcow_instance_settings(config, instance)
+    key = (os.getpid(),) + settings
+    client = _mailcow_clients.get(key)
+    if client is None:
+        with _mailcow_clients_lock:
+            client = _mailcow_clients.get(key)
+            if client is None:
+                if len(_mailcow_clients) >= _MAX_MAILCOW_CLIENTS:
+                    _mailcow_clients.pop(next(iter(_mailcow_clients))).close()
+                url, api_key, timeout, pool_size, retries, backoff = settings
+                client = MailcowClient(url, api_key, timeout=timeout, pool_size=pool_size,
+                                       retries=retries, backoff=backoff)
+                _mailcow_clients[key] = client
+    return client
+
+
+def for_each_instance(config, func):
+    """{instance: func(instance)} over all Mailcow instances, called in parallel"""
+    names = mailcow_instance_names(config)
+    if len(names) == 1:
+        return {names[0]: func(names[0])}
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        return dict(zip(names, pool.map(func, names)))
+
+
+# create_mailcow_alias() messages for failures where Mailcow may accept the
+# same request later (see is_transient_error).
+MAILCOW_TIMEOUT = "Connection timeout"
+MAILCOW_UNREACHABLE = "Unable to connect to Mailcow server"
+# Aliases cannot be looked up before the alias index is first loaded.
+ALIAS_INDEX_LOADING = "Alias list is still loading, please retry in a moment"
+
+
+def is_transient_error(message):
+    """True if a create_mailcow_alias() failure is worth retrying later"""
+    return message in (MAILCOW_TIMEOUT, MAILCOW_UNREACHABLE) or bool(re.fullmatch(r'HTTP error 5\d\d', message))
+
+
 def create_mailcow_alias(alias_email, redirect_to, config):
     """Create an alias in Mailcow via API"""
     
-    # Mailcow API URL for aliases
-    api_url = f"{config['mailcow_url'].rstrip('/')}/api/v1/add/alias"
-    
-    # Headers for authentication
-    headers = {
-        'X-API-Key': config['api_key'],
-        'Content-Type': 'application/json'
-    }
-    
-    # Data to create the alias
-    data = {
-        'address': alias_email,
-        'goto': redirect_to,
-        'active': 1,
-        'sogo_visible': 1 if config.get('sogo_visible', True) else 0
-    }
-    
     try:
         logger.info(f"Creating alias {alias_email} -> {redirect_to}")
         
-        response = requests.post(api_url, headers=headers, json=data, timeout=10)
+        response = mailcow_client_for(alias_email, config).add_alias(
+            alias_email, redirect_to, sogo_visible=config.get('sogo_visible', True)
+        )
         
         if response.status_code == 200:
             result = response.json()
@@ -229,215 +962,2064 @@ def create_mailcow_alias(alias_email, redirect_to, config):
             
     except requests.exceptions.Timeout:
         logger.error("Timeout connecting to Mailcow")
-        return False, "Connection timeout"
+        return False, MAILCOW_TIMEOUT
     except requests.exceptions.ConnectionError:
         logger.error("Unable to connect to Mailcow")
-        return False, "Unable to connect to Mailcow server"
+        return False, MAILCOW_UNREACHABLE
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         return False, "Unexpected error while creating the alias"
 
-def check_alias_exists(alias_email, config):
-    """Check if an alias already exists"""
-    
-    api_url = f"{config['mailcow_url'].rstrip('/')}/api/v1/get/alias/all"
-    
-    headers = {
-        'X-API-Key': config['api_key'],
-        'Content-Type': 'application/json'
-    }
-    
-    try:
-        response = requests.get(api_url, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            aliases_data = response.json()
-            
-            # Handle different response formats from Mailcow API
-            if isinstance(aliases_data, list):
-                aliases = aliases_data
-            elif isinstance(aliases_data, dict):
-                # Sometimes the API returns a dict with aliases in a specific key
-                aliases = aliases_data.get('data', aliases_data.get('aliases', []))
-                if not isinstance(aliases, list):
-                    aliases = []
-            else:
-                aliases = []
-            
-            # Check if alias exists
-            for alias in aliases:
-                if isinstance(alias, dict) and alias.get('address') == alias_email:
-                    return True
-        
-        return False
-        
-    except Exception as e:
-        logger.warning(f"Unable to check alias existence: {e}")
-        return False
+def _alias_list(aliases_data):
+    """Extract the list of alias objects from a get/alias/all response body"""
+    # Handle different response formats from Mailcow API
+    if isinstance(aliases_data, list):
+        return aliases_data
+    if isinstance(aliases_data, dict):
+        # Sometimes the API returns a dict with aliases in a specific key
+        aliases = aliases_data.get('data', aliases_data.get('aliases', []))
+        if isinstance(aliases, list):
+            return aliases
+    return []
 
-def create_altcha_challenge(config):
-    """Create a new ALTCHA challenge"""
-    try:
-        altcha_hmac_key = config.get('altcha_hmac_key')
-        if not altcha_hmac_key:
-            logger.error("ALTCHA HMAC key not configured")
-            return None, "ALTCHA not configured"
-        
-        # Create challenge options
-        options = ChallengeOptionsV1(
-            expires=datetime.now() + timedelta(hours=1),
-            max_number=ALTCHA_MAX_NUMBER,
-            hmac_key=altcha_hmac_key,
-        )
 
-        # Create the challenge
-        challenge = create_challenge_v1(options)
-        logger.info("ALTCHA challenge created successfully")
-        
-        return challenge, None
-        
-    except Exception as e:
-        logger.error(f"Error creating ALTCHA challenge: {e}")
-        return None, "ALTCHA error"
+def _alias_domain(address):
+    return address.rpartition('@')[2]
 
-def verify_altcha_via_gatecha(payload, config):
-    """Verify an ALTCHA solution against a self-hosted GateCHA server.
 
-    GateCHA (https://gatecha.org) exposes an ALTCHA-compatible verify endpoint:
-        POST {gatecha_url}/api/v1/verify?apiKey=gk_xxx   body: {"payload": "..."}
-        -> {"ok": true|false, ...}
-    """
-    gatecha_url = config.get('gatecha_url')
-    api_key = config.get('gatecha_api_key')
+class AliasRecord:
+    """The fields of a Mailcow alias the app uses, without the rest of the API object"""
 
-    if not gatecha_url or not api_key:
-        logger.error("GateCHA URL or API key not configured")
-        return False, "GateCHA not configured"
+    __slots__ = ('id', 'address', 'goto', 'active')
 
-    verify_url = f"{gatecha_url.rstrip('/')}/api/v1/verify"
+    def __init__(self, alias_id, address, goto, active):
+        self.id = alias_id
+        self.address = address
+        self.goto = goto
+        self.active = active
 
-    try:
-        response = requests.post(
-            verify_url,
-            params={'apiKey': api_key},
-            json={'payload': payload},
-            timeout=10,
-        )
+    @classmethod
+    def from_entry(cls, entry):
+        """Record of a get/alias/all entry, or None if it has no address"""
+        if not isinstance(entry, dict) or not entry.get('address'):
+            return None
+        return cls(entry.get('id'), str(entry['address']).lower(), str(entry.get('goto') or '').lower(),
+                   entry.get('active', 1) in (1, '1', True))
 
-        if response.status_code == 200 and response.json().get('ok'):
-            logger.info("ALTCHA solution verified successfully via GateCHA")
-            return True, "Valid solution"
 
-        logger.warning(
-            f"GateCHA rejected the solution (HTTP {response.status_code})"
-        )
-        return False, "Invalid solution"
+def fetch_alias_record(address, config):
+    """AliasRecord of one alias, from get/alias/<address>, or None if Mailcow has none.
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error contacting GateCHA server: {e}")
-        return False, "GateCHA verification error"
+    Raises RuntimeError on an HTTP error, and request or JSON errors as they come.
+    """
+    response = mailcow_client_for(address, config).get_alias(address)
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP error {response.status_code}")
+    record = AliasRecord.from_entry(response.json())
+    return record if record and record.address == address else None
 
 
-def verify_altcha_solution(payload, config, check_expires=True):
-    """Verify an ALTCHA solution using the configured provider"""
-    # Delegate to GateCHA when configured as the provider.
-    if config.get('altcha_provider', 'local') == 'gatecha':
-        return verify_altcha_via_gatecha(payload, config)
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
 
-    try:
-        altcha_hmac_key = config.get('altcha_hmac_key')
-        if not altcha_hmac_key:
-            logger.error("ALTCHA HMAC key not configured")
-            return False, "ALTCHA not configured"
-        
-        # Verify the solution
-        ok, err = verify_solution_v1(payload, altcha_hmac_key, check_expires=check_expires)
-        
-        if err:
-            logger.warning(f"ALTCHA verification error: {err}")
-            return False, str(err)
-        elif ok:
-            logger.info("ALTCHA solution verified successfully")
-            return True, "Valid solution"
-        else:
-            logger.warning("Invalid ALTCHA solution")
-            return False, "Invalid solution"
-            
-    except Exception as e:
-        logger.error(f"Error verifying ALTCHA solution: {e}")
-        return False, "ALTCHA verification error"
 
-def password_matches(stored, provided):
-    """Compare a provided password against the stored value in constant time.
+def iter_aliases(response, chunk_size=64 * 1024):
+    """AliasRecords of a (streamed) get/alias/all response, parsed incrementally.
 
-    Recommended: store a Werkzeug hash (see generate_password_hash.py), e.g.
-    "pbkdf2:sha256:...". For backward compatibility, legacy plaintext passwords
-    are still accepted and compared with a constant-time check to avoid timing
-    attacks. Plaintext storage is discouraged.
+    The body runs to tens of MB on large servers; it is never held whole.
+    Each chunk is decoded and the complete array elements it holds are parsed
+    one at a time, keeping only AliasRecord's fields; an element cut by the
+    chunk boundary waits for the next chunk. A body that is not a JSON array
+    (an object wrapping the list) falls back to a full parse. Raises
+    ValueError on malformed or truncated bodies.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size)
+    buffer, pos, in_array = '', 0, False
+    try:
+        for chunk in chunks:
+            buffer = buffer[pos:] + text.decode(chunk)
+            pos = 0
+            if not in_array:
+                pos = _JSON_SEPARATORS.match(buffer).end()
+                if pos == len(buffer):
+                    continue
+                if buffer[pos] != '[':
+                    break
+                pos += 1
+                in_array = True
+            while True:
+                pos = _JSON_SEPARATORS.match(buffer, pos).end()
+                if pos == len(buffer):
+                    break
+                if buffer[pos] == ']':
+                    return
+                try:
+                    entry, pos = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    break  # incomplete element: read on
+                record = AliasRecord.from_entry(entry)
+                if record is not None:
+                    yield record
+        if in_array:
+            raise ValueError("Truncated alias list")
+        rest = buffer[pos:] + ''.join(text.decode(chunk) for chunk in chunks) + text.decode(b'', final=True)
+        for entry in _alias_list(json.loads(rest)):
+            record = AliasRecord.from_entry(entry)
+            if record is not None:
+                yield record
+    finally:
+        response.close()
+
+
+class AliasIndex:
+    """Per-worker index of existing alias addresses, grouped by domain.
+
+    Built from a single get/alias/all download per Mailcow instance (run in
+    parallel, parsed as it streams in) instead of one download per existence
+    check. Once older than the TTL it is rebuilt in a background thread while
+    lookups keep being served from the previous data. Aliases created by this
+    app are added write-through, and those added while a rebuild was in
+    flight are carried over into the new data.
+    """
+
+    # After a failed download, wait this long before trying again.
+    RETRY_DELAY = 30
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._by_domain = {}  # domain -> {address: Mailcow alias id (None if unknown)}
+        self._loaded_at = None
+        self._next_attempt = 0
+        self._refreshing = False
+        self._recent = {}  # write-through additions: address -> clock time
+
+    def refresh(self, config):
+        """Download the alias list and swap it in. Returns False on failure."""
+        started = self._clock()
+        try:
+            by_domain = {}
+            for part in for_each_instance(config, lambda name: self._download(config, name)).values():
+                for domain, addresses in part.items():
+                    by_domain.setdefault(domain, {}).update(addresses)
+        except Exception as e:
+            logger.warning(f"Unable to refresh alias index: {e}")
+            with self._lock:
+                self._next_attempt = self._clock() + self.RETRY_DELAY
+                self._refreshing = False
+            return False
+
+        with self._lock:
+            for address, added_at in list(self._recent.items()):
+                if added_at >= started:
+                    by_domain.setdefault(_alias_domain(address), {}).setdefault(address, None)
+                else:
+                    del self._recent[address]
+            self._by_domain = by_domain
+            self._loaded_at = started
+            self._refreshing = False
+        logger.info(f"Alias index refreshed ({sum(len(a) for a in by_domain.values())} aliases)")
+        return True
+
+    @staticmethod
+    def _download(config, instance):
+        """{domain: {address: id}} of one Mailcow instance"""
+        response = get_mailcow_client(config, instance).get_aliases()
+        if response.status_code != 200:
+            response.close()
+            raise RuntimeError(f"HTTP error {response.status_code}")
+        by_domain = {}
+        for record in iter_aliases(response):
+            by_domain.setdefault(_alias_domain(record.address), {})[record.address] = record.id
+        return by_domain
+
+    def _claim_refresh(self):
+        """Single-flight guard: True if the caller should run the refresh"""
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+            return True
+
+    def contains(self, address, config):
+        """True/False if the alias exists, or None when no index could be loaded"""
+        now = self._clock()
+        if self._loaded_at is None:
+            # First use: load synchronously (once), other threads don't wait.
+            if now < self._next_attempt or not self._claim_refresh() or not self.refresh(config):
+                return None
+        elif now - self._loaded_at > config.get('alias_index_ttl', 300) and now >= self._next_attempt:
+            if self._claim_refresh():
+                threading.Thread(target=self.refresh, args=(config,), daemon=True).start()
+
+        address = address.lower()
+        return address in self._by_domain.get(_alias_domain(address), ())
+
+    def add(self, address, alias_id=None):
+        """Record an alias this app just created"""
+        address = address.lower()
+        with self._lock:
+            self._by_domain.setdefault(_alias_domain(address), {})[address] = alias_id
+            self._recent[address] = self._clock()
+
+    def discard(self, address):
+        """Forget an alias this app just deleted"""
+        address = address.lower()
+        with self._lock:
+            self._by_domain.get(_alias_domain(address), {}).pop(address, None)
+            self._recent.pop(address, None)
+
+    @property
+    def loading(self):
+        """True while the first download is in flight (lookups return None meanwhile)"""
+        return self._loaded_at is None and self._refreshing
+
+    def alias_id(self, address, config):
+        """Mailcow id of an alias, or None if it is unknown (see contains() to tell why).
+
+        Aliases created since the last download have no id yet: it is fetched
+        with a get/alias call for that address alone and remembered.
+        """
+        address = address.lower()
+        if not self.contains(address, config):
+            return None
+        alias_id = self._by_domain.get(_alias_domain(address), {}).get(address)
+        if alias_id is None:
+            alias_id = self._lookup_id(address, config)
+            if alias_id is not None:
+                with self._lock:
+                    addresses = self._by_domain.get(_alias_domain(address), {})
+                    if address in addresses:
+                        addresses[address] = alias_id
+        return alias_id
+
+    def _lookup_id(self, address, config):
+        try:
+            record = fetch_alias_record(address, config)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError) as e:
+            logger.warning(f"Unable to look up alias {address}: {e}")
+            return None
+        if record is None:
+            self.discard(address)  # Mailcow no longer has it
+            return None
+        return record.id
+
+
+alias_index = AliasIndex()
+
+
+def check_alias_exists(alias_email, config):
+    """Check if an alias already exists (via the local alias index)"""
+    if not config.get('alias_index_enabled', True):
+        return False
+    # An index that could not be loaded must not block alias creation:
+    # Mailcow still rejects real duplicates.
+    exists = alias_index.contains(alias_email, config)
+    CACHE_LOOKUPS.labels(cache='alias_index', result='miss' if exists is None else 'hit').inc()
+    return exists is True
+
+_LOCAL_PART_RE = re.compile(r"^[a-z0-9!#$%&'*+/=?^_`{|}~-]+(\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*$")
+_DOMAIN_LABEL_RE = re.compile(r'^(?!-)[a-z0-9-]{1,63}(?<!-)$')
+
+
+def normalize_domain(domain):
+    """Lowercase, IDNA-encoded (punycode) form of a domain, or None if invalid"""
+    domain = str(domain or '').strip().rstrip('.').lower()
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+    labels = domain.split('.')
+    if len(domain) > 253 or len(labels) < 2 or not all(_DOMAIN_LABEL_RE.match(label) for label in labels):
+        return None
+    return domain
+
+
+def parse_email(address):
+    """Split and normalize an address in one pass: (local part, domain) or None"""
+    local, sep, domain = str(address or '').strip().lower().rpartition('@')
+    if not sep or len(local) > 64 or not _LOCAL_PART_RE.match(local):
+        return None
+    domain = normalize_domain(domain)
+    return (local, domain) if domain else None
+
+
+class DomainValidator:
+    """Allowed alias domains, compiled once per configuration snapshot.
+
+    Plain entries go in a frozenset (one hash lookup). Entries such as
+    "*.example.com" allow any subdomain of example.com and are stored in a
+    trie of reversed labels, walked label by label. A user may be restricted
+    to a subset with a "domains" list in their users entry.
+    """
+
+    _WILDCARD = '*'
+
+    def __init__(self, domains, user_domains=None):
+        self.exact, self.trie = self._compile(domains)
+        self.user_rules = {user_id: self._compile(entries)
+                           for user_id, entries in (user_domains or {}).items()}
+        self.listing = [d for d in domains if not d.startswith('*.')]
+        # A user's list only shows the entries they can actually use.
+        self.user_listing = {
+            user_id: [d for d in entries
+                      if not d.startswith('*.') and self.allows(normalize_domain(d), user_id)]
+            for user_id, entries in (user_domains or {}).items()
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        users = config.get('users', {})
+        return cls(
+            config.get('domains', []),
+            {user_id: user_config['domains'] for user_id, user_config in users.items()
+             if user_config.get('domains')},
+        )
+
+    @classmethod
+    def _compile(cls, entries):
+        exact, trie = set(), {}
+        for entry in entries:
+            if entry.startswith('*.'):
+                domain = normalize_domain(entry[2:])
+                if domain:
+                    node = trie
+                    for label in reversed(domain.split('.')):
+                        node = node.setdefault(label, {})
+                    node[cls._WILDCARD] = True
+            else:
+                domain = normalize_domain(entry)
+                if domain:
+                    exact.add(domain)
+        return frozenset(exact), trie
+
+    @classmethod
+    def _matches(cls, rules, domain):
+        exact, trie = rules
+        if domain in exact:
+            return True
+        node = trie
+        labels = domain.split('.')
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                return False
+            if cls._WILDCARD in node and depth < len(labels):
+                return True
+        return False
+
+    def allows(self, domain, user_id=None):
+        """True if aliases may be created on (normalized) domain"""
+        if not domain or not self._matches((self.exact, self.trie), domain):
+            return False
+        rules = self.user_rules.get(user_id)
+        return rules is None or self._matches(rules, domain)
+
+    def allowed_list(self, user_id=None):
+        """Domains to show in error messages and the domain dropdown"""
+        return self.user_listing.get(user_id, self.listing)
+
+
+def domain_validator(config):
+    return derived(config, 'domain_validator', DomainValidator.from_config)
+
+
+def default_domain(config, user_id=None):
+    """Domain to use when a request names none: "default_domain", or the
+    user's first allowed domain when they may not use that one"""
+    domain = config.get('default_domain', config.get('domains', ['example.com'])[0])
+    validator = domain_validator(config)
+    domains = validator.allowed_list(user_id)
+    if user_id and domains and not validator.allows(normalize_domain(domain), user_id):
+        return domains[0]
+    return domain
+
+
+def _domain_error(config, user_id):
+    domains_list = ', '.join(domain_validator(config).allowed_list(user_id))
+    return f'Alias must use one of the allowed domains: {domains_list}'
+
+
+class MailcowRouter:
+    """Mailcow instance hosting each alias domain, compiled once per configuration snapshot.
+
+    Entries of "mailcow_instances" list the domains they host, with the same
+    syntax as "domains" ("*.example.com" included). Domains no entry claims
+    go to the default instance; the first entry listing a domain wins.
+    """
+
+    def __init__(self, instances):
+        self.rules = [(name, DomainValidator._compile(entry.get('domains', ())))
+                      for name, entry in instances.items()]
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('mailcow_instances', {}))
+
+    def route(self, domain):
+        """Name of the instance hosting (normalized) domain"""
+        for name, rules in self.rules:
+            if DomainValidator._matches(rules, domain):
+                return name
+        return DEFAULT_MAILCOW_INSTANCE
+
+
+def mailcow_router(config):
+    return derived(config, 'mailcow_router', MailcowRouter.from_config)
+
+
+def mailcow_client_for(address, config):
+    """Shared client of the Mailcow instance hosting address's domain"""
+    return get_mailcow_client(config, mailcow_router(config).route(_alias_domain(address)))
+
+
+class AliasReservations:
+    """Aliases handed out by the generator but possibly not created yet.
+
+    Keeps two concurrent generate requests, in any worker, from being given the
+    same address before either has reached Mailcow. Entries live in the shared
+    state backend and expire after `ttl` seconds.
+    """
+
+    def __init__(self, backend=None, ttl=600):
+        self._backend = backend
+        self.ttl = ttl
+
+    def reserve(self, address):
+        """Reserve address; False if someone else holds it"""
+        backend = self._backend or state_backend
+        return backend.add(f'alias-reservation:{address}', 1, self.ttl)
+
+
+alias_reservations = AliasReservations()
+
+# Attempts before giving up on finding a free suffix (only reachable when the
+# suffix space for a service name is nearly exhausted).
+_GENERATE_ATTEMPTS = 20
+
+
+def normalize_service_name(service):
+    """Service name as used in aliases: lowercase letters and digits only"""
+    return re.sub(r'[^a-z0-9]', '', str(service or '').lower())
+
+
+def generate_alias(service, domain, config):
+    """Return a free, reserved alias "<service><random suffix>@<domain>" or None"""
+    length = config.get('alias_suffix_length', 4)
+    alphabet = config.get('alias_suffix_alphabet', '0123456789')
+    for _ in range(_GENERATE_ATTEMPTS):
+        suffix = ''.join(secrets.choice(alphabet) for _ in range(length))
+        candidate = f"{service}{suffix}@{domain}"
+        if not check_alias_exists(candidate, config) and alias_reservations.reserve(candidate):
+            return candidate
+    logger.warning(f"No free alias suffix found for {service}@{domain}")
+    return None
+
+
+def resolve_generated_alias(item, config, user_id=None):
+    """Fill in item['alias'] for "generate for me" requests ({"service": ..., "domain": ...}).
+
+    Returns (item, error). Items that already name an alias are returned as is.
+    """
+    if not isinstance(item, dict) or item.get('alias') or 'service' not in item:
+        return item, None
+
+    service = normalize_service_name(item.get('service'))
+    if not service:
+        return item, 'Invalid service name'
+    domain = normalize_domain(item.get('domain') or default_domain(config, user_id))
+    if not domain or not domain_validator(config).allows(domain, user_id):
+        return item, _domain_error(config, user_id)
+
+    alias_email = generate_alias(service, domain, config)
+    if not alias_email:
+        return item, 'Unable to find a free alias for this service name, please try another one'
+    return dict(item, alias=alias_email), None
+
+
+def probe_mailcow(config, instance=DEFAULT_MAILCOW_INSTANCE):
+    """Check Mailcow connectivity. Returns (ok, message, latency in seconds)."""
+    started = time.monotonic()
+    try:
+        response = get_mailcow_client(config, instance).get_version(timeout=5)
+        latency = time.monotonic() - started
+        if response.status_code == 200:
+            return True, 'success', latency
+        return False, f'Mailcow connection error: {response.status_code}', latency
+    except Exception as e:
+        logger.error(f"Unable to connect to Mailcow: {e}")
+        return False, 'Unable to connect to Mailcow', time.monotonic() - started
+
+
+class HealthMonitor:
+    """Caches the Mailcow probe result, refreshed by a background thread.
+
+    Health checks (Docker, load balancers, the status page) read the cached
+    result, so their frequency no longer turns into Mailcow API traffic: each
+    worker probes once per health_check_interval seconds, whatever the load.
+    """
+
+    def __init__(self, background=True):
+        self._background = background
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last = None  # dict describing the latest probe
+
+    def probe(self, config):
+        """Probe every Mailcow instance (in parallel); ok only if all of them answer"""
+        results = for_each_instance(config, lambda name: probe_mailcow(config, name))
+        failed = [(name, message) for name, (ok, message, _) in results.items() if not ok]
+        if not failed:
+            message = 'success'
+        elif len(results) == 1:
+            message = failed[0][1]
+        else:
+            message = '; '.join(f'{name}: {message}' for name, message in failed)
+        self.last = {
+            'ok': not failed,
+            'message': message,
+            'checked_at': datetime.now().isoformat(),
+            'checked_monotonic': time.monotonic(),
+            'latency_ms': round(max(latency for _, _, latency in results.values()) * 1000, 1),
+            'instances': {
+                name: {'ok': ok, 'message': message, 'latency_ms': round(latency * 1000, 1)}
+                for name, (ok, message, latency) in results.items()
+            },
+        }
+        return self.last
+
+    def _interval(self):
+        config = load_config()
+        return max(1, config.get('health_check_interval', 30)) if config else 30
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval())
+            config = load_config()
+            if config:
+                self.probe(config)
+
+    def result(self, config):
+        """Latest probe result; probes synchronously until one exists"""
+        if self._background and self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        return self.last or self.probe(config)
+
+
+health_monitor = HealthMonitor()
+
+
+def _failure_scopes(client_ip):
+    """Keys under which a failed login from client_ip is counted"""
+    scopes = {'global': '*'}
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except (TypeError, ValueError):
+        return scopes
+    prefix = 24 if address.version == 4 else 64
+    scopes['ip'] = str(address)
+    scopes['subnet'] = str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+    return scopes
+
+
+def record_auth_failure(client_ip, config, reason='password'):
+    """Count a failed login for the client, its subnet and globally"""
+    AUTH_FAILURES.labels(reason=reason).inc()
+    window = config.get('altcha_failure_window', AUTH_FAILURE_WINDOW)
+    current = int(time.time() // window)
+    for scope, value in _failure_scopes(client_ip).items():
+        state_backend.incr(f'auth-fail:{scope}:{value}:{current}', 2 * window)
+
+
+def auth_failure_counts(client_ip, config):
+    """Failed logins in the last window per scope (sliding-window estimate).
+
+    Counts are kept per fixed window; the previous window is weighted by the
+    share of it that still falls inside the sliding window.
+    """
+    window = config.get('altcha_failure_window', AUTH_FAILURE_WINDOW)
+    now = time.time()
+    current = int(now // window)
+    overlap = 1 - (now % window) / window
+    counts = {}
+    for scope, value in _failure_scopes(client_ip).items():
+        key = f'auth-fail:{scope}:{value}'
+        counts[scope] = (state_backend.get(f'{key}:{current}', 0)
+                         + state_backend.get(f'{key}:{current - 1}', 0) * overlap)
+    return counts
+
+
+def altcha_max_number(client_ip, config):
+    """Challenge difficulty for client_ip given recent failed logins"""
+    thresholds = dict(DEFAULT_ALTCHA_FAILURE_THRESHOLDS, **config.get('altcha_failure_thresholds', {}))
+    cap = config.get('altcha_max_number_cap', ALTCHA_MAX_NUMBER_CAP)
+    level = max(
+        (int(count // thresholds[scope]) for scope, count in auth_failure_counts(client_ip, config).items()
+         if thresholds.get(scope, 0) > 0),
+        default=0,
+    )
+    return min(cap, ALTCHA_MAX_NUMBER << min(level, 32))
+
+
+def _sign_altcha_challenge(hmac_key, max_number, ttl):
+    options = ChallengeOptionsV1(
+        expires=datetime.now() + timedelta(seconds=ttl),
+        max_number=max_number,
+        hmac_key=hmac_key,
+    )
+    return create_challenge_v1(options)
+
+
+class ChallengePool:
+    """Pre-signed ALTCHA challenges, one pool per (key, difficulty, TTL).
+
+    Serving a challenge is a pop from a deque; a background thread refills a
+    pool back to `altcha_pool_size` once it drops below
+    `altcha_pool_low_watermark`. Pools are per worker process. Challenges
+    older than a quarter of their TTL are discarded rather than served, so a
+    client always gets most of the validity window.
+    """
+
+    MAX_POOLS = 16
+
+    def __init__(self, background=True, clock=time.monotonic):
+        self._background = background
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._pools = OrderedDict()  # key -> deque of (created, challenge)
+        self._wanted = {}  # key -> depth to refill to
+        self._thread = None
+        self._pid = None
+
+    def _reset_after_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pools.clear()
+            self._wanted.clear()
+            self._thread = None
+
+    def get(self, hmac_key, max_number, ttl, depth, low):
+        """A challenge from the pool, or a freshly signed one if it is empty"""
+        key = (hmac_key, max_number, ttl)
+        challenge = None
+        with self._cond:
+            self._reset_after_fork()
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = deque()
+                while len(self._pools) > self.MAX_POOLS:
+                    self._pools.popitem(last=False)
+            self._pools.move_to_end(key)
+            oldest = self._clock() - ttl / 4
+            while pool and pool[0][0] < oldest:
+                pool.popleft()
+            if pool:
+                challenge = pool.popleft()[1]
+            if len(pool) < low:
+                self._wanted[key] = depth
+                if self._background and self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+        return challenge or _sign_altcha_challenge(hmac_key, max_number, ttl)
+
+    def refill(self):
+        """Fill every pool that asked for it back to its depth"""
+        with self._cond:
+            wanted, self._wanted = self._wanted, {}
+        for key, depth in wanted.items():
+            with self._cond:
+                pool = self._pools.get(key)
+                missing = depth - len(pool) if pool is not None else 0
+            if missing <= 0:
+                continue
+            batch = [(self._clock(), _sign_altcha_challenge(*key)) for _ in range(missing)]
+            with self._cond:
+                if self._pools.get(key) is pool:
+                    pool.extend(batch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._wanted:
+                    self._cond.wait()
+            try:
+                self.refill()
+            except Exception as e:
+                logger.error(f"Error refilling the ALTCHA challenge pool: {e}")
+                time.sleep(1)
+
+
+altcha_pool = ChallengePool()
+
+
+def create_altcha_challenge(config, client_ip=None):
+    """Create a new ALTCHA challenge, harder when client_ip or the site sees failed logins"""
+    try:
+        altcha_hmac_key = config.get('altcha_hmac_key')
+        if not altcha_hmac_key:
+            logger.error("ALTCHA HMAC key not configured")
+            return None, "ALTCHA not configured"
+        
+        max_number = altcha_max_number(client_ip, config)
+        ALTCHA_DIFFICULTY.observe(max_number)
+        ttl = config.get('altcha_challenge_ttl', ALTCHA_CHALLENGE_TTL)
+
+        depth = config.get('altcha_pool_size', 256)
+        if depth > 0:
+            challenge = altcha_pool.get(
+                altcha_hmac_key, max_number, ttl, depth,
+                config.get('altcha_pool_low_watermark', depth // 4),
+            )
+        else:
+            challenge = _sign_altcha_challenge(altcha_hmac_key, max_number, ttl)
+        logger.debug("ALTCHA challenge issued")
+        
+        return challenge, None
+        
+    except Exception as e:
+        logger.error(f"Error creating ALTCHA challenge: {e}")
+        return None, "ALTCHA error"
+
+class GatechaClient:
+    """GateCHA verify client over a pooled, keep-alive HTTP session.
+
+    Shared by all requests of a worker (see get_gatecha_client). Verification
+    is not retried: GateCHA may record a payload as used on the first call.
+    """
+
+    def __init__(self, base_url, api_key, timeout=5, pool_size=10):
+        self.verify_url = f"{base_url.rstrip('/')}/api/v1/verify"
+        self.timeout = timeout
+        self.session = requests.Session()
+        # GateCHA only takes the key as a query parameter; set it once here.
+        self.session.params = {'apiKey': api_key}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def verify(self, payload):
+        return self.session.post(self.verify_url, json={'payload': payload}, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_gatecha_clients = {}
+_gatecha_clients_lock = threading.Lock()
+
+
+def get_gatecha_client(config):
+    """Return the shared GatechaClient for this worker and configuration"""
+    key = (
+        os.getpid(),
+        config['gatecha_url'],
+        config['gatecha_api_key'],
+        config.get('gatecha_timeout', 5),
+        config.get('gatecha_pool_size', 10),
+    )
+    client = _gatecha_clients.get(key)
+    if client is None:
+        with _gatecha_clients_lock:
+            client = _gatecha_clients.get(key)
+            if client is None:
+                for old in _gatecha_clients.values():
+                    old.close()
+                _gatecha_clients.clear()
+                client = _gatecha_clients[key] = GatechaClient(*key[1:])
+    return client
+
+
+class CircuitBreaker:
+    """Fail fast while a dependency is down.
+
+    Opens after `threshold` consecutive failures. Once `reset_timeout` seconds
+    have passed, a single trial call is let through (half-open): success
+    closes the breaker, failure re-opens it for another `reset_timeout`.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial else 'open'
+
+    def allow(self, reset_timeout):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or self._clock() - self.opened_at < reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self, threshold):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= threshold:
+                if self.opened_at is None or self._trial:
+                    logger.warning(f"GateCHA circuit breaker open after {self.failures} failure(s)")
+                self.opened_at = self._clock()
+                self._trial = False
+
+
+gatecha_breaker = CircuitBreaker()
+
+def _gatecha_unavailable(config):
+    """Verdict when GateCHA cannot be reached, per gatecha_fail_open"""
+    if config.get('gatecha_fail_open', False):
+        logger.warning("GateCHA unavailable, accepting the solution unverified (gatecha_fail_open)")
+        return True, "GateCHA unavailable, verification skipped"
+    return False, "GateCHA verification error"
+
+
+def verify_altcha_via_gatecha(payload, config):
+    """Verify an ALTCHA solution against a self-hosted GateCHA server.
+
+    GateCHA (https://gatecha.org) exposes an ALTCHA-compatible verify endpoint:
+        POST {gatecha_url}/api/v1/verify?apiKey=gk_xxx   body: {"payload": "..."}
+        -> {"ok": true|false, ...}
+
+    Verdicts are cached for gatecha_cache_ttl seconds, keyed on the payload
+    hash. While GateCHA is failing, a circuit breaker answers immediately
+    (rejecting, or accepting with gatecha_fail_open) instead of waiting for
+    timeouts.
+    """
+    if not config.get('gatecha_url') or not config.get('gatecha_api_key'):
+        logger.error("GateCHA URL or API key not configured")
+        return False, "GateCHA not configured"
+
+    cache_key = 'gatecha-verdict:' + hashlib.sha256(str(payload).encode()).hexdigest()
+    cached = state_backend.get(cache_key)
+    if cached is not None:
+        CACHE_LOOKUPS.labels(cache='gatecha_verdict', result='hit').inc()
+        return (True, "Valid solution") if cached else (False, "Invalid solution")
+    CACHE_LOOKUPS.labels(cache='gatecha_verdict', result='miss').inc()
+
+    if not gatecha_breaker.allow(config.get('gatecha_breaker_reset', 30)):
+        GATECHA_SHORT_CIRCUITS.inc()
+        return _gatecha_unavailable(config)
+
+    start = time.perf_counter()
+    try:
+        response = get_gatecha_client(config).verify(payload)
+    except requests.exceptions.RequestException as e:
+        GATECHA_LATENCY.labels(outcome='error').observe(time.perf_counter() - start)
+        gatecha_breaker.failure(config.get('gatecha_breaker_threshold', 5))
+        logger.error(f"Error contacting GateCHA server: {e}")
+        return _gatecha_unavailable(config)
+
+    if response.status_code >= 500:
+        GATECHA_LATENCY.labels(outcome='error').observe(time.perf_counter() - start)
+        gatecha_breaker.failure(config.get('gatecha_breaker_threshold', 5))
+        logger.error(f"GateCHA server error (HTTP {response.status_code})")
+        return _gatecha_unavailable(config)
+    gatecha_breaker.success()
+
+    try:
+        ok = response.status_code == 200 and bool(response.json().get('ok'))
+    except (ValueError, AttributeError):
+        ok = False
+    GATECHA_LATENCY.labels(outcome='valid' if ok else 'invalid').observe(time.perf_counter() - start)
+    state_backend.set(cache_key, ok, config.get('gatecha_cache_ttl', 30))
+
+    if ok:
+        logger.info("ALTCHA solution verified successfully via GateCHA")
+        return True, "Valid solution"
+
+    logger.warning(
+        f"GateCHA rejected the solution (HTTP {response.status_code})"
+    )
+    return False, "Invalid solution"
+
+
+def _altcha_challenge_id(payload):
+    """(challenge hash, expiry timestamp or None) of an ALTCHA payload, or (None, None)"""
+    try:
+        data = json.loads(base64.b64decode(payload))
+        challenge = str(data['challenge'])
+        params = parse_qs(str(data.get('salt', '')).partition('?')[2])
+        expires = int(params['expires'][0]) if 'expires' in params else None
+        return challenge, expires
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None, None
+
+
+def verify_altcha_solution(payload, config, check_expires=True):
+    """Verify an ALTCHA solution using the configured provider.
+
+    Each challenge is accepted once: solved challenges are recorded in the
+    shared state store until they expire, and a replayed payload is rejected
+    with a single lookup before any signature check.
+    """
+    provider = config.get('altcha_provider', 'local')
+    start = time.perf_counter()
+    challenge, expires = _altcha_challenge_id(payload)
+    key = f'altcha-used:{challenge}'
+    if challenge and state_backend.get(key) is not None:
+        logger.warning("Replayed ALTCHA solution rejected")
+        ALTCHA_VERIFY_LATENCY.labels(provider=provider, result='replay').observe(time.perf_counter() - start)
+        return False, "Challenge already used"
+
+    # Delegate to GateCHA when configured as the provider.
+    if provider == 'gatecha':
+        ok, message = verify_altcha_via_gatecha(payload, config)
+    else:
+        ok, message = _verify_altcha_local(payload, config, check_expires)
+    ALTCHA_VERIFY_LATENCY.labels(provider=provider, result='valid' if ok else 'invalid').observe(
+        time.perf_counter() - start)
+
+    if ok and challenge:
+        remaining = (expires - time.time()) if expires else 0
+        ttl = remaining if remaining > 0 else config.get('altcha_challenge_ttl', ALTCHA_CHALLENGE_TTL)
+        # add() is atomic, so of two concurrent submissions only one wins.
+        try:
+            claimed = state_backend.add(key, 1, ttl)
+        except StateStoreFull:
+            logger.warning("ALTCHA replay store full, verification refused")
+            return False, "Too many verifications, please try again later"
+        if not claimed:
+            logger.warning("Replayed ALTCHA solution rejected")
+            return False, "Challenge already used"
+    return ok, message
+
+
+def _verify_altcha_local(payload, config, check_expires=True):
+    """Verify an ALTCHA solution with the local HMAC key"""
+    try:
+        altcha_hmac_key = config.get('altcha_hmac_key')
+        if not altcha_hmac_key:
+            logger.error("ALTCHA HMAC key not configured")
+            return False, "ALTCHA not configured"
+        
+        # Verify the solution
+        ok, err = verify_solution_v1(payload, altcha_hmac_key, check_expires=check_expires)
+        
+        if err:
+            logger.warning(f"ALTCHA verification error: {err}")
+            return False, str(err)
+        elif ok:
+            logger.info("ALTCHA solution verified successfully")
+            return True, "Valid solution"
+        else:
+            logger.warning("Invalid ALTCHA solution")
+            return False, "Invalid solution"
+            
+    except Exception as e:
+        logger.error(f"Error verifying ALTCHA solution: {e}")
+        return False, "ALTCHA verification error"
+
+def password_matches(stored, provided):
+    """Compare a provided password against the stored value in constant time.
+
+    Recommended: store a Werkzeug hash (see generate_password_hash.py), e.g.
+    "pbkdf2:sha256:...". For backward compatibility, legacy plaintext passwords
+    are still accepted and compared with a constant-time check to avoid timing
+    attacks. Plaintext storage is discouraged.
     """
     if not stored or provided is None:
         return False
 
-    if stored.startswith(_HASH_PREFIXES):
-        try:
-            return check_password_hash(stored, provided)
-        except Exception as e:
-            logger.error(f"Error checking password hash: {e}")
-            return False
+    if stored.startswith(_HASH_PREFIXES):
+        try:
+            return check_password_hash(stored, provided)
+        except Exception as e:
+            logger.error(f"Error checking password hash: {e}")
+            return False
+
+    # Legacy plaintext password — constant-time comparison.
+    return hmac.compare_digest(str(stored), str(provided))
+
+
+@lru_cache(maxsize=8)
+def _dummy_password_hash(method):
+    """A hash of a random secret, verified in place of an unknown user's hash"""
+    return generate_password_hash(secrets.token_urlsafe(16), method=method)
+
+
+def _dummy_hash_method(users):
+    """Hash method (with cost parameters) of the configured users, e.g. 'pbkdf2:sha256:600000'.
+
+    The dummy hash mirrors it so that an unknown username costs the same
+    verification time as a known one.
+    """
+    for user_config in users.values():
+        stored = str(user_config.get('password') or '')
+        if stored.startswith(_HASH_PREFIXES) and '$' in stored:
+            return stored.split('$', 1)[0]
+    return 'pbkdf2:sha256'
+
+
+def _user_info(user_id, user_config):
+    return {
+        'user_id': user_id,
+        'default_redirect': user_config.get('default_redirect', 'user@example.com'),
+        'description': user_config.get('description', f'User {user_id}')
+    }
+
+
+def authenticate_user(password, config, username=None):
+    """Authenticate user and return user info if successful.
+
+    With a username, the user is looked up directly and exactly one password
+    verification runs (against a dummy hash for unknown usernames, so timing
+    does not reveal which usernames exist). Without one, the password is
+    checked against every user.
+    """
+    # Check multi-user configuration
+    users = config.get('users', {})
+
+    if username is not None:
+        user_config = users.get(username)
+        if user_config is None:
+            password_matches(_dummy_password_hash(_dummy_hash_method(users)), password)
+            return None
+        if password_matches(user_config.get('password'), password):
+            return _user_info(username, user_config)
+        return None
+
+    matched_user = None
+    # Iterate over every user (no early break) so authentication time does not
+    # depend on which entry matched, preventing user enumeration via timing.
+    for user_id, user_config in users.items():
+        if password_matches(user_config.get('password'), password):
+            matched_user = (user_id, user_config)
+
+    if matched_user:
+        return _user_info(*matched_user)
+
+    return None
+
+def _session_key(config):
+    """HMAC key for session tokens: session_secret, or one derived from api_key"""
+    secret = config.get('session_secret')
+    if secret:
+        return str(secret).encode('utf-8')
+    logger.warning("session_secret not set in config.json; deriving the session key from api_key")
+    return hmac.new(str(config['api_key']).encode('utf-8'), b'mailcow-alias-generator session',
+                    hashlib.sha256).digest()
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def issue_session_token(user_id, config):
+    """Short-lived stateless token: base64url(JSON claims) "." base64url(HMAC-SHA256)"""
+    now = int(time.time())
+    claims = {'sub': user_id, 'iat': now, 'exp': now + config.get('session_ttl', 3600)}
+    body = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    key = derived(config, 'session_key', _session_key)
+    signature = _b64encode(hmac.new(key, body.encode('ascii'), hashlib.sha256).digest())
+    return f"{body}.{signature}"
+
+
+def verify_session_token(token, config):
+    """Return the user id of a valid, unexpired token for an existing user, else None"""
+    try:
+        body, signature = str(token).split('.')
+        key = derived(config, 'session_key', _session_key)
+        expected = hmac.new(key, body.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return None
+        claims = json.loads(_b64decode(body))
+    except (ValueError, UnicodeError, TypeError):
+        return None
+    if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int) or claims['exp'] < time.time():
+        return None
+    user_id = claims.get('sub')
+    # Tokens of users removed from config.json stop working immediately.
+    return user_id if user_id in config.get('users', {}) else None
+
+
+def session_user(config):
+    """User id from the request's "Authorization: Bearer <token>" header, or None"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return verify_session_token(token.strip(), config)
+
+
+def _session_response(user_id, config):
+    return {
+        'token': issue_session_token(user_id, config),
+        'expires_in': config.get('session_ttl', 3600)
+    }
+
+
+# Encodings are only kept when they save at least this share of the size.
+MIN_COMPRESSION_SAVING = 0.1
+
+
+def encode_variants(data):
+    """(SHA-256 hex digest, {encoding: body}) of data, with the worthwhile compressed encodings"""
+    variants = {'identity': data}
+    candidates = [('gzip', lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        candidates.insert(0, ('br', lambda: brotli.compress(data, quality=11)))
+    for encoding, compress in candidates:
+        encoded = compress()
+        if len(encoded) <= len(data) * (1 - MIN_COMPRESSION_SAVING):
+            variants[encoding] = encoded
+    return hashlib.sha256(data).hexdigest(), variants
+
+
+class StaticAsset:
+    """A file of the app directory served from memory.
+
+    The file is read once, along with its gzip (and, when the brotli module is
+    installed, br) encodings and a SHA-256 digest used as strong ETag and as
+    version of content-hashed URLs. Requests re-stat the file at most every
+    CHECK_INTERVAL seconds and reload it when it changed, so edits show up
+    without a restart. `render` rewrites the raw bytes before hashing (used to
+    point the pages at the current altcha.js URL); assets listed in `depends`
+    reload this one when their own content changes.
+    """
+
+    CHECK_INTERVAL = 2.0
+
+    def __init__(self, name, mimetype, render=None, depends=(), root=None, clock=time.monotonic):
+        self.name = name
+        self._root = root
+        self.mimetype = mimetype
+        self._render = render
+        self._depends = depends
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = None  # (stamp, digest, {encoding: bytes})
+        self._checked = 0.0
+
+    @property
+    def path(self):
+        return os.path.join(self._root or app.root_path, self.name)
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size) + tuple(dep.digest for dep in self._depends)
+
+    def _load(self, stamp):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if self._render:
+            data = self._render(data)
+        self._state = (stamp,) + encode_variants(data)
+        logger.debug(f"Loaded static asset {self.name} ({len(data)} bytes, {sorted(self._state[2])})")
+
+    def current(self):
+        """(digest, {encoding: body}) of the file's current content"""
+        now = self._clock()
+        if self._state is None or now - self._checked >= self.CHECK_INTERVAL:
+            with self._lock:
+                if self._state is None or now - self._checked >= self.CHECK_INTERVAL:
+                    stamp = self._stamp()
+                    if self._state is None or stamp != self._state[0]:
+                        self._load(stamp)
+                    self._checked = now
+        return self._state[1], self._state[2]
+
+    @property
+    def digest(self):
+        return self.current()[0]
+
+    @property
+    def version(self):
+        """Short content hash used in versioned URLs"""
+        return self.digest[:16]
+
+
+# Caching policies. Pages must revalidate (they name the current altcha.js
+# URL), versioned URLs never change content.
+CACHE_REVALIDATE = 'no-cache'
+CACHE_ICON = 'public, max-age=86400'
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _altcha_js_url():
+    return f'/altcha.{static_assets["altcha.js"].version}.js'
+
+
+def _render_page(data):
+    return data.replace(b'src="/altcha.js"', f'src="{_altcha_js_url()}"'.encode('ascii'))
+
+
+def _build_static_assets():
+    altcha_js = StaticAsset('altcha.js', 'text/javascript')
+    return {
+        'altcha.js': altcha_js,
+        'index.html': StaticAsset('index.html', 'text/html', render=_render_page, depends=(altcha_js,)),
+        'login.html': StaticAsset('login.html', 'text/html', render=_render_page, depends=(altcha_js,)),
+        'favicon.ico': StaticAsset('favicon.ico', 'image/vnd.microsoft.icon'),
+        'favicon.svg': StaticAsset('favicon.svg', 'image/svg+xml'),
+    }
+
+
+static_assets = _build_static_assets()
+
+
+def _preferred_encoding(variants):
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted[encoding]:
+            return encoding
+    return 'identity'
+
+
+def _variant_response(digest, variants, mimetype, cache_control):
+    encoding = _preferred_encoding(variants)
+    # Each encoding is a different representation, hence its own strong tag.
+    etag = digest[:32] if encoding == 'identity' else f'{digest[:32]}-{encoding}'
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(variants[encoding], mimetype=mimetype, headers=headers)
+
+
+def send_static_asset(name, cache_control):
+    """Response for a static asset: negotiated encoding, strong ETag, 304 when unchanged"""
+    try:
+        digest, variants = static_assets[name].current()
+    except FileNotFoundError:
+        return jsonify({'error': 'Not found'}), 404
+    return _variant_response(digest, variants, static_assets[name].mimetype, cache_control)
+
+
+# Placeholder in the pages replaced by the public configuration, so they can
+# render without waiting for /api/config.
+CONFIG_BOOTSTRAP_MARKER = b'<!-- config-bootstrap -->'
+
+
+def _bootstrap_script(config):
+    if not config:
+        return b''
+    body = public_config_document(config)[1]
+    # Inside <script> only "</script" would end the element; escaping "<", ">"
+    # and "&" (all inside JSON strings) rules that out without changing the value.
+    for char, escaped in ((b'<', b'\\u003c'), (b'>', b'\\u003e'), (b'&', b'\\u0026')):
+        body = body.replace(char, escaped)
+    return b'<script id="config-bootstrap" type="application/json">' + body + b'</script>'
+
+
+def send_page(name):
+    """Response for an HTML page with the public configuration inlined.
+
+    The rendered page and its encodings are cached per configuration snapshot
+    and page version, so the common case costs a dictionary lookup.
+    """
+    try:
+        digest, variants = static_assets[name].current()
+    except FileNotFoundError:
+        return jsonify({'error': 'Not found'}), 404
+    config = load_config()
+    if not config:
+        return _variant_response(digest, variants, 'text/html', CACHE_REVALIDATE)
+    pages = derived(config, 'pages', lambda c: {})
+    page = pages.get((name, digest))
+    if page is None:
+        data = variants['identity'].replace(CONFIG_BOOTSTRAP_MARKER, _bootstrap_script(config), 1)
+        page = pages[(name, digest)] = encode_variants(data)
+    return _variant_response(page[0], page[1], 'text/html', CACHE_REVALIDATE)
+
+
+@app.route('/')
+def index():
+    """Home page"""
+    return send_page('index.html')
+
+@app.route('/login')
+def login():
+    """Login page"""
+    return send_page('login.html')
+
+@app.route('/favicon.ico')
+def favicon():
+    """Serve favicon.ico"""
+    return send_static_asset('favicon.ico', CACHE_ICON)
+
+@app.route('/favicon.svg')
+def favicon_svg():
+    """Serve favicon.svg"""
+    return send_static_asset('favicon.svg', CACHE_ICON)
+
+@app.route('/altcha.js')
+def altcha_js():
+    """Serve altcha.js (unversioned URL, revalidated on every use)"""
+    return send_static_asset('altcha.js', CACHE_REVALIDATE)
+
+@app.route('/altcha.<version>.js')
+def altcha_js_versioned(version):
+    """Serve altcha.js under its content-hashed URL, cached for good.
+
+    A page loaded before altcha.js changed may still ask for the old hash: it
+    gets the current file, but without the immutable caching.
+    """
+    if version != static_assets['altcha.js'].version:
+        return send_static_asset('altcha.js', CACHE_REVALIDATE)
+    return send_static_asset('altcha.js', CACHE_IMMUTABLE)
+
+
+class AuditLog:
+    """Buffered, rotating writer for the alias activity log (alias_log.json).
+
+    Request threads only append to an in-memory buffer. A background thread
+    writes the buffer in one batch when audit_log_batch_size entries are
+    waiting or every audit_log_flush_interval seconds, and whatever is left is
+    flushed at exit. Writes and rotation happen under an exclusive flock on a
+    sidecar lock file, so several gunicorn workers can share the same log.
+
+    Rotation (audit_log_rotate) is by size ("size", past audit_log_max_bytes),
+    by day ("daily") or disabled ("none"). Rotated files are renamed to
+    alias_log-YYYYmmdd-HHMMSS-ffffff.json, gzipped when audit_log_compress is
+    set, and only the newest audit_log_backups are kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._buffer = []
+        self._thread = None
+
+    def _settings(self):
+        config = load_config() or {}
+        return {
+            'batch_size': config.get('audit_log_batch_size', 100),
+            'flush_interval': config.get('audit_log_flush_interval', 1.0),
+            'rotate': config.get('audit_log_rotate', 'size'),
+            'max_bytes': config.get('audit_log_max_bytes', 10 * 1024 * 1024),
+            'backups': config.get('audit_log_backups', 10),
+            'compress': config.get('audit_log_compress', True),
+        }
+
+    def write(self, entry):
+        """Queue one entry; never blocks on disk I/O"""
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._cond:
+            self._buffer.append(line)
+            if len(self._buffer) >= self._settings()['batch_size']:
+                self._cond.notify()
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            settings = self._settings()
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) >= settings['batch_size'],
+                                    timeout=settings['flush_interval'])
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered so far"""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            data = ''.join(batch).encode('utf-8')
+            try:
+                with self._locked():
+                    self._rotate_if_needed(len(data))
+                    with open(self.path, 'ab') as f:
+                        f.write(data)
+            except Exception as e:
+                logger.warning(f"Unable to save log: {e}")
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rotate_if_needed(self, incoming):
+        settings = self._settings()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if settings['rotate'] == 'size':
+            due = st.st_size > 0 and st.st_size + incoming > settings['max_bytes']
+        elif settings['rotate'] == 'daily':
+            due = datetime.fromtimestamp(st.st_mtime).date() != datetime.now().date()
+        else:
+            due = False
+        if due:
+            self._rotate(settings)
+
+    def _rotate(self, settings):
+        base, ext = os.path.splitext(self.path)
+        while True:
+            # Microseconds keep names unique and in chronological order.
+            target = f"{base}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{ext}"
+            if not (os.path.exists(target) or os.path.exists(target + '.gz')):
+                break
+        os.rename(self.path, target)
+
+        if settings['compress']:
+            with open(target, 'rb') as src, gzip.open(target + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(target)
+
+        # Timestamped names sort chronologically; drop the oldest backups.
+        backups = sorted(glob.glob(f"{glob.escape(base)}-*{ext}") + glob.glob(f"{glob.escape(base)}-*{ext}.gz"))
+        for old in backups[:-settings['backups']] if settings['backups'] > 0 else backups:
+            os.remove(old)
+
+
+audit_log = AuditLog(os.path.join(log_dir, 'alias_log.json'))
+atexit.register(audit_log.flush)
+
+
+def add_missing_columns(conn, table, columns):
+    """ALTER TABLE in the columns ({name: definition}) an older database lacks"""
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+
+class AliasHistory:
+    """Queryable history of created aliases, in an embedded SQLite database.
+
+    Indexed by alias, redirect address, user and creation time so lookups such
+    as "aliases created by X" or "what points at Y" do not scan the activity
+    log. Each thread gets its own connection; WAL mode lets gunicorn workers
+    write concurrently with readers.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS aliases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            alias TEXT NOT NULL,
+            redirect_to TEXT NOT NULL,
+            user_id TEXT,
+            status TEXT NOT NULL DEFAULT 'success'
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_aliases_alias ON aliases(alias, created_at);
+        CREATE INDEX IF NOT EXISTS idx_aliases_redirect ON aliases(redirect_to, id);
+        CREATE INDEX IF NOT EXISTS idx_aliases_user ON aliases(user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_aliases_created ON aliases(created_at);
+    """
+
+    # Lifecycle columns, added to databases created before they existed.
+    COLUMNS = {
+        'active': 'INTEGER NOT NULL DEFAULT 1',
+        'expires_at': 'TEXT',
+        'deleted_at': 'TEXT',
+    }
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS idx_aliases_expires ON aliases(expires_at)
+            WHERE expires_at IS NOT NULL AND deleted_at IS NULL;
+    """
+
+    # Filters accepted by query(), mapped to their column.
+    FILTERS = {'alias': 'alias', 'redirect': 'redirect_to', 'user': 'user_id'}
+    FIELDS = 'id, created_at, alias, redirect_to, user_id, status, active, expires_at, deleted_at'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    add_missing_columns(conn, 'aliases', self.COLUMNS)
+                    conn.executescript(self.INDEXES)
+                    self._schema_ready = True
+        return conn
+
+    def add(self, alias, redirect_to, user_id=None, created_at=None, status='success', expires_at=None):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO aliases (created_at, alias, redirect_to, user_id, status, expires_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (created_at or datetime.now().isoformat(), alias, redirect_to, user_id, status, expires_at),
+            )
+
+    def get(self, row_id):
+        row = self._connect().execute(f'SELECT {self.FIELDS} FROM aliases WHERE id = ?', (row_id,)).fetchone()
+        return dict(row) if row else None
+
+    def set_active(self, row_id, active):
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE aliases SET active = ? WHERE id = ?', (int(active), row_id))
+
+    def mark_deleted(self, row_ids):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                'UPDATE aliases SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL',
+                [(datetime.now().isoformat(), row_id) for row_id in row_ids],
+            )
+
+    def expired(self, now, limit=100):
+        """Aliases whose TTL ran out before `now` (ISO timestamp) and not deleted yet, oldest first"""
+        rows = self._connect().execute(
+            f'SELECT {self.FIELDS} FROM aliases WHERE expires_at IS NOT NULL AND expires_at <= ? '
+            'AND deleted_at IS NULL '
+            # An alias created again since then is not expired
+            'AND id = (SELECT MAX(id) FROM aliases AS newer WHERE newer.alias = aliases.alias) '
+            'ORDER BY expires_at LIMIT ?',
+            (now, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def import_log(self, lines):
+        """Import alias_log.json lines; entries already present are skipped.
+
+        Returns the number of rows inserted.
+        """
+        conn = self._connect()
+        before = conn.total_changes
+        with conn:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(entry, dict) or not entry.get('alias'):
+                    continue
+                conn.execute(
+                    'INSERT OR IGNORE INTO aliases (created_at, alias, redirect_to, user_id, status) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (entry.get('timestamp') or '', entry['alias'], entry.get('redirect_to') or '',
+                     entry.get('user_id'), entry.get('status') or 'success'),
+                )
+        return conn.total_changes - before
+
+    def query(self, limit=50, cursor=None, current=False, **filters):
+        """Newest first, keyset-paginated on id; `current` leaves out deleted aliases.
+
+        Returns (rows, next_cursor); pass next_cursor back to get the next page.
+        """
+        clauses, params = [], []
+        for name, value in filters.items():
+            if value is not None:
+                clauses.append(f'{self.FILTERS[name]} = ?')
+                params.append(value)
+        if current:
+            clauses.append('deleted_at IS NULL')
+        if cursor is not None:
+            clauses.append('id < ?')
+            params.append(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self._connect().execute(
+            f'SELECT {self.FIELDS} FROM aliases {where} ORDER BY id DESC LIMIT ?',
+            params + [limit + 1],
+        ).fetchall()
+        next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+        return [dict(row) for row in rows[:limit]], next_cursor
+
+
+alias_history = AliasHistory(os.path.join(log_dir, 'alias_history.sqlite3'))
+
+
+class AliasJobQueue:
+    """Durable queue of alias creations to retry while Mailcow is slow or down.
+
+    Jobs live in an SQLite file shared by all workers. A job is claimed by
+    moving it to "running" with a lease (next_attempt_at in the future), so a
+    worker that dies mid-attempt only delays it. Jobs may carry an
+    idempotency key (scoped to the user), unique across the table: a client
+    retrying with the same key gets the original job back.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            idempotency_key TEXT UNIQUE,
+            user_id TEXT,
+            alias TEXT,
+            redirect_to TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            may_exist INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs(status, next_attempt_at);
+    """
+
+    # Columns added after the first release of the table.
+    COLUMNS = {'expires_at': 'TEXT'}
+
+    # Seconds a claimed job stays reserved for the worker attempting it.
+    LEASE = 120
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    add_missing_columns(conn, 'jobs', self.COLUMNS)
+                    self._schema_ready = True
+        return conn
+
+    def get(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find(self, idempotency_key):
+        row = self._connect().execute(
+            'SELECT * FROM jobs WHERE idempotency_key = ?', (idempotency_key,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def begin(self, idempotency_key, user_id):
+        """Claim an idempotency key for a request being handled now.
+
+        Returns (job, True) for a new, running job, or (existing job, False).
+        """
+        now = datetime.now().isoformat()
+        job_id = secrets.token_hex(16)
+        try:
+            self._connect().execute(
+                'INSERT INTO jobs (id, idempotency_key, user_id, status, next_attempt_at, created_at, updated_at) '
+                "VALUES (?, ?, ?, 'running', ?, ?, ?)",
+                (job_id, idempotency_key, user_id, self._clock() + self.LEASE, now, now),
+            )
+        except sqlite3.IntegrityError:
+            job = self.find(idempotency_key)
+            # A request that died before queueing anything leaves a running
+            # job without an alias; once its lease is over, take it over.
+            if job['status'] == 'running' and job['alias'] is None and job['next_attempt_at'] <= self._clock():
+                taken = self._connect().execute(
+                    'UPDATE jobs SET next_attempt_at = ? WHERE id = ? AND next_attempt_at = ?',
+                    (self._clock() + self.LEASE, job['id'], job['next_attempt_at']),
+                ).rowcount
+                if taken:
+                    return self.get(job['id']), True
+            return job, False
+        return self.get(job_id), True
+
+    def enqueue(self, alias_email, redirect_to, user_id, message, delay, job_id=None, may_exist=False,
+                expires_at=None):
+        """Queue (or re-queue job_id) for a retry in `delay` seconds; returns the job id"""
+        now = datetime.now().isoformat()
+        conn = self._connect()
+        if job_id is None:
+            job_id = secrets.token_hex(16)
+            conn.execute(
+                'INSERT INTO jobs (id, user_id, status, next_attempt_at, created_at, updated_at) '
+                "VALUES (?, ?, 'pending', 0, ?, ?)",
+                (job_id, user_id, now, now),
+            )
+        conn.execute(
+            "UPDATE jobs SET alias = ?, redirect_to = ?, status = 'pending', attempts = attempts + 1, "
+            'next_attempt_at = ?, may_exist = may_exist OR ?, message = ?, '
+            'expires_at = COALESCE(?, expires_at), updated_at = ? WHERE id = ?',
+            (alias_email, redirect_to, self._clock() + delay, int(may_exist), message, expires_at, now, job_id),
+        )
+        return job_id
+
+    def finish(self, job_id, status, message, alias_email=None, redirect_to=None):
+        """Record the final outcome ("succeeded" or "failed") of a job"""
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, message = ?, alias = COALESCE(?, alias), '
+            'redirect_to = COALESCE(?, redirect_to), updated_at = ? WHERE id = ?',
+            (status, message, alias_email, redirect_to, datetime.now().isoformat(), job_id),
+        )
+
+    def claim_due(self):
+        """Claim the next job whose retry is due (or whose lease expired), or None"""
+        now = self._clock()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status IN ('pending', 'running') AND next_attempt_at <= ? "
+                'AND alias IS NOT NULL ORDER BY next_attempt_at LIMIT 1',
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', next_attempt_at = ? WHERE id = ?",
+                    (now + self.LEASE, row['id']),
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return dict(row, status='running') if row else None
+
+    def purge(self, older_than):
+        """Delete finished jobs last updated before `older_than` (ISO timestamp)"""
+        self._connect().execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?", (older_than,)
+        )
+
+
+alias_jobs = AliasJobQueue(os.path.join(log_dir, 'alias_jobs.sqlite3'))
+
+
+def _retry_delay(attempts, config):
+    """Exponential backoff before retry number `attempts` (1-based)"""
+    base = config.get('alias_queue_backoff', 5)
+    return min(config.get('alias_queue_max_backoff', 600), base * 2 ** (attempts - 1))
+
+
+def _alias_exists_upstream(alias_email, redirect_to, config):
+    """True if Mailcow already has alias_email pointing at redirect_to.
+
+    After a timeout Mailcow may have created the alias even though we never
+    saw its answer; a retry then fails as a duplicate.
+    """
+    try:
+        record = fetch_alias_record(alias_email, config)
+    except (requests.exceptions.RequestException, RuntimeError, ValueError):
+        return False
+    return record is not None and redirect_to in record.goto.split(',')
+
 
-    # Legacy plaintext password — constant-time comparison.
-    return hmac.compare_digest(str(stored), str(provided))
+def process_alias_job(job, config):
+    """One retry attempt of a queued alias creation"""
+    alias_email, redirect_to = job['alias'], job['redirect_to']
+    success, message = create_mailcow_alias(alias_email, redirect_to, config)
+    if not success and job['may_exist'] and not is_transient_error(message):
+        if _alias_exists_upstream(alias_email, redirect_to, config):
+            success, message = True, "Alias created successfully"
+    if success:
+        record_created_alias(alias_email, redirect_to, user_id=job['user_id'], expires_at=job['expires_at'])
+        alias_jobs.finish(job['id'], 'succeeded', message)
+        logger.info(f"Queued alias {alias_email} created after {job['attempts'] + 1} attempt(s)")
+    elif is_transient_error(message) and job['attempts'] + 1 < config.get('alias_queue_max_attempts', 8):
+        alias_jobs.enqueue(alias_email, redirect_to, job['user_id'], message,
+                           _retry_delay(job['attempts'] + 1, config), job_id=job['id'],
+                           may_exist=message != MAILCOW_UNREACHABLE)
+    else:
+        alias_jobs.finish(job['id'], 'failed', message)
+        logger.warning(f"Queued alias {alias_email} failed: {message}")
 
 
-def authenticate_user(password, config):
-    """Authenticate user and return user info if successful"""
-    # Check multi-user configuration
-    users = config.get('users', {})
+class AliasJobWorker:
+    """Background thread retrying due jobs of the alias queue (one per worker process)"""
 
-    matched_user = None
-    # Iterate over every user (no early break) so authentication time does not
-    # depend on which entry matched, preventing user enumeration via timing.
-    for user_id, user_config in users.items():
-        if password_matches(user_config.get('password'), password):
-            matched_user = (user_id, user_config)
+    POLL_INTERVAL = 1.0
 
-    if matched_user:
-        user_id, user_config = matched_user
-        return {
-            'user_id': user_id,
-            'default_redirect': user_config.get('default_redirect', 'user@example.com'),
-            'description': user_config.get('description', f'User {user_id}')
-        }
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._wake = threading.Event()
 
-    return None
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
 
-@app.route('/')
-def index():
-    """Home page"""
-    return send_from_directory('.', 'index.html')
+    def wake(self):
+        self._wake.set()
 
-@app.route('/login')
-def login():
-    """Login page"""
-    return send_from_directory('.', 'login.html')
+    def _run(self):
+        last_purge = 0
+        while True:
+            config = load_config()
+            job = None
+            try:
+                if config and config.get('alias_queue_enabled', False):
+                    if time.monotonic() - last_purge > 3600:
+                        retention = timedelta(days=config.get('alias_queue_retention_days', 7))
+                        alias_jobs.purge((datetime.now() - retention).isoformat())
+                        last_purge = time.monotonic()
+                    job = alias_jobs.claim_due()
+                    if job:
+                        process_alias_job(job, config)
+            except Exception as e:
+                logger.error(f"Error processing queued alias job: {e}")
+            if job is None:
+                self._wake.wait(self.POLL_INTERVAL)
+                self._wake.clear()
 
-@app.route('/favicon.ico')
-def favicon():
-    """Serve favicon.ico"""
-    return send_from_directory('.', 'favicon.ico')
 
-@app.route('/favicon.svg')
-def favicon_svg():
-    """Serve favicon.svg"""
-    return send_from_directory('.', 'favicon.svg')
+alias_job_worker = AliasJobWorker()
 
-@app.route('/altcha.js')
-def altcha_js():
-    """Serve altcha.js"""
-    return send_from_directory('.', 'altcha.js')
+
+def _job_response(job):
+    """API view of a queued job, with the HTTP status matching its state"""
+    body = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'alias': job['alias'],
+        'redirect_to': job['redirect_to'],
+        'attempts': job['attempts'],
+        'message': job['message'],
+    }
+    if job['status'] == 'succeeded':
+        return jsonify(dict(body, success=True)), 200
+    if job['status'] == 'failed':
+        return jsonify(dict(body, error=job['message'])), 400
+    body['retry_in'] = max(0, round(job['next_attempt_at'] - time.time())) if job['status'] == 'pending' else None
+    return jsonify(dict(body, queued=True, status_url=f"/api/jobs/{job['id']}")), 202
+
+
+def validate_alias_request(item, config, user_id=None):
+    """Normalize and validate one alias request.
+
+    Returns (alias_email, redirect_to, None) or (None, None, error message).
+    Addresses are returned lowercased with IDNA (punycode) domains.
+    """
+    if not isinstance(item, dict):
+        return None, None, 'Alias and redirect address required'
+
+    alias = item.get('alias')
+    redirect = item.get('redirectTo')
+
+    # Data validation
+    if not str(alias or '').strip() or not str(redirect or '').strip():
+        return None, None, 'Alias and redirect address required'
+
+    # Check email format
+    alias_parts, redirect_parts = parse_email(alias), parse_email(redirect)
+    if not alias_parts or not redirect_parts:
+        return None, None, 'Invalid email format'
+
+    # Check that alias uses one of the allowed domains
+    if not domain_validator(config).allows(alias_parts[1], user_id):
+        return None, None, _domain_error(config, user_id)
+
+    return '@'.join(alias_parts), '@'.join(redirect_parts), None
+
+
+def record_created_alias(alias_email, redirect_to, user_id=None, expires_at=None):
+    """Bookkeeping after Mailcow accepted an alias: index, activity log and history"""
+    alias_index.add(alias_email)
+
+    # Activity log
+    log_entry = {
+        'timestamp': datetime.now().isoformat(),
+        'alias': alias_email,
+        'redirect_to': redirect_to,
+        'user_id': user_id,
+        'status': 'success'
+    }
+    
+    # Save to JSON log file (buffered, written by a background thread)
+    audit_log.write(log_entry)
+
+    try:
+        alias_history.add(alias_email, redirect_to, user_id=user_id, created_at=log_entry['timestamp'],
+                          expires_at=expires_at)
+    except Exception as e:
+        logger.warning(f"Unable to save alias history: {e}")
+
+
+def alias_expiry(item, config):
+    """(expires_at ISO timestamp or None, error) from an alias request's optional "ttl" (seconds)"""
+    ttl = item.get('ttl') if isinstance(item, dict) else None
+    if ttl is None:
+        return None, None
+    max_ttl = config.get('alias_max_ttl', 365 * 86400)
+    if isinstance(ttl, bool) or not isinstance(ttl, int) or not 60 <= ttl <= max_ttl:
+        return None, f'ttl must be a number of seconds between 60 and {max_ttl}'
+    return (datetime.now() + timedelta(seconds=ttl)).isoformat(), None
+
+
+def _mailcow_outcome(response):
+    """(success, message) of an edit/delete call: every entry of the answer must be a success"""
+    if response.status_code != 200:
+        return False, f"HTTP error {response.status_code}"
+    result = response.json()
+    for entry in result if isinstance(result, list) else [result]:
+        if not isinstance(entry, dict):
+            return False, "Unexpected API response format"
+        if entry.get('type') != 'success':
+            error_msg = entry.get('msg', 'Unknown error')
+            if isinstance(error_msg, list):
+                error_msg = ' '.join(str(x) for x in error_msg)
+            return False, error_msg
+    return True, 'success'
+
+
+def _unknown_alias_error(alias_email, config):
+    exists = alias_index.contains(alias_email, config)
+    if exists is False:
+        return 'Alias not found in Mailcow'
+    if exists is None and alias_index.loading:
+        return ALIAS_INDEX_LOADING
+    return MAILCOW_UNREACHABLE
+
+
+def _manage_error_status(message):
+    """HTTP status of a failed enable/disable/delete: 503 when worth retrying shortly"""
+    return 503 if message == ALIAS_INDEX_LOADING else 400
+
+
+def set_mailcow_alias_active(alias_email, active, config):
+    """Enable or disable an alias in Mailcow. Returns (success, message)."""
+    alias_id = alias_index.alias_id(alias_email, config)
+    if alias_id is None:
+        return False, _unknown_alias_error(alias_email, config)
+    try:
+        return _mailcow_outcome(mailcow_client_for(alias_email, config).edit_aliases(
+            [alias_id], {'active': '1' if active else '0'}
+        ))
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Unable to update alias {alias_email}: {e}")
+        return False, MAILCOW_UNREACHABLE
+
+
+def _delete_batch(client, entries):
+    """Delete [(address, id)] with one call. Returns {address: error} for the failures."""
+    try:
+        success, message = _mailcow_outcome(client.delete_aliases([alias_id for _, alias_id in entries]))
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Unable to delete aliases: {e}")
+        return {address: MAILCOW_UNREACHABLE for address, _ in entries}
+    if success:
+        return {}
+    if len(entries) == 1:
+        return {entries[0][0]: message}
+    # One bad entry fails the whole call: retry one by one to isolate it.
+    errors = {}
+    for entry in entries:
+        errors.update(_delete_batch(client, [entry]))
+    return errors
+
+
+def delete_mailcow_aliases(addresses, config):
+    """Delete aliases in Mailcow, with one delete/alias call per instance.
+
+    Returns (deleted, errors): the addresses Mailcow no longer has (including
+    those it did not have to begin with) and {address: message} for the others.
+    """
+    batches, deleted, errors = {}, [], {}
+    router = mailcow_router(config)
+    for address in addresses:
+        alias_id = alias_index.alias_id(address, config)
+        if alias_id is not None:
+            batches.setdefault(router.route(_alias_domain(address)), []).append((address, alias_id))
+        elif alias_index.contains(address, config) is False:
+            deleted.append(address)
+        else:
+            errors[address] = _unknown_alias_error(address, config)
+    for instance, entries in batches.items():
+        failed = _delete_batch(get_mailcow_client(config, instance), entries)
+        errors.update(failed)
+        for address, _ in entries:
+            if address not in failed:
+                alias_index.discard(address)
+                deleted.append(address)
+    return deleted, errors
+
+
+def reap_expired_aliases(config):
+    """Delete one batch of aliases whose TTL ran out. Returns the number deleted."""
+    rows = alias_history.expired(datetime.now().isoformat(), config.get('alias_reaper_batch_size', 100))
+    if not rows:
+        return 0
+    row_ids = {}
+    for row in rows:
+        row_ids.setdefault(row['alias'], []).append(row['id'])
+    deleted, errors = delete_mailcow_aliases(list(row_ids), config)
+    alias_history.mark_deleted([row_id for address in deleted for row_id in row_ids[address]])
+    if errors:
+        logger.warning(f"Unable to delete {len(errors)} expired alias(es), will retry: "
+                       f"{', '.join(sorted(errors))}")
+    logger.info(f"Deleted {len(deleted)} expired alias(es)")
+    return len(deleted)
+
+
+class AliasReaper:
+    """Background thread deleting expired aliases in Mailcow (one per worker process).
+
+    A round runs every alias_reaper_interval seconds, in one worker at a time:
+    the first to claim the round in the shared state store runs it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            config = load_config()
+            interval = max(1, config.get('alias_reaper_interval', 60)) if config else 60
+            try:
+                if config and state_backend.add('alias-reaper', os.getpid(), interval):
+                    reap_expired_aliases(config)
+            except Exception as e:
+                logger.error(f"Error deleting expired aliases: {e}")
+            time.sleep(interval)
+
+
+alias_reaper = AliasReaper()
 
 
 @app.route('/api/create-alias', methods=['POST'])
+@limiter.limit(configured_rate_limit('create_alias'), key_func=rate_limit_key)
 def create_alias():
     """Endpoint to create an alias"""
     
@@ -446,66 +3028,304 @@ def create_alias():
     if not config:
         return jsonify({'error': 'Invalid configuration'}), 500
     
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+    
+    # With the retry queue enabled, an Idempotency-Key makes resubmissions
+    # return the first request's outcome instead of creating another alias.
+    queue_enabled = config.get('alias_queue_enabled', False)
+    idempotency_key = request.headers.get('Idempotency-Key', '').strip()[:200]
+    job = None
+    if queue_enabled and idempotency_key:
+        job, created = alias_jobs.begin(f'{user_id}:{idempotency_key}', user_id)
+        if not created:
+            return _job_response(job)
+
     try:
         data = request.get_json()
         
         if not data:
-            return jsonify({'error': 'Missing JSON data'}), 400
-        
-        alias_email = data.get('alias', '').strip().lower()
-        redirect_to = data.get('redirectTo', '').strip().lower()
-
-        # Data validation
-        if not alias_email or not redirect_to:
-            return jsonify({'error': 'Alias and redirect address required'}), 400
-
-        # Check email format
-        if '@' not in alias_email or '@' not in redirect_to:
-            return jsonify({'error': 'Invalid email format'}), 400
-
-        # Check that alias uses one of the allowed domains
-        allowed_domains = config.get('domains', [])
-        if not any(alias_email.endswith(f"@{domain}") for domain in allowed_domains):
-            domains_list = ', '.join(allowed_domains)
-            return jsonify({'error': f'Alias must use one of the allowed domains: {domains_list}'}), 400
-        
-        # Check if alias already exists (temporarily disabled due to API format issues)
-        # if check_alias_exists(alias_email, config):
-        #     return jsonify({'error': 'This alias already exists'}), 409
+            error, status = 'Missing JSON data', 400
+        else:
+            data, error = resolve_generated_alias(data, config, user_id)
+            status = 400
+            if not error:
+                alias_email, redirect_to, error = validate_alias_request(data, config, user_id)
+            if not error:
+                expires_at, error = alias_expiry(data, config)
+            # Check if alias already exists
+            if not error and check_alias_exists(alias_email, config):
+                error, status = 'This alias already exists', 409
+        if error:
+            if job:
+                alias_jobs.finish(job['id'], 'failed', error)
+            return jsonify({'error': error}), status
         
         # Create alias
         success, message = create_mailcow_alias(alias_email, redirect_to, config)
         
         if success:
-            # Activity log
-            log_entry = {
-                'timestamp': datetime.now().isoformat(),
-                'alias': alias_email,
-                'redirect_to': redirect_to,
-                'status': 'success'
-            }
-            
-            # Save to JSON log file
-            try:
-                alias_log_file = os.path.join(log_dir, 'alias_log.json')
-                with open(alias_log_file, 'a', encoding='utf-8') as f:
-                    f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
-            except Exception as e:
-                logger.warning(f"Unable to save log: {e}")
+            record_created_alias(alias_email, redirect_to, user_id=user_id, expires_at=expires_at)
+            if job:
+                alias_jobs.finish(job['id'], 'succeeded', message, alias_email, redirect_to)
             
             return jsonify({
                 'success': True,
                 'message': message,
                 'alias': alias_email,
-                'redirect_to': redirect_to
+                'redirect_to': redirect_to,
+                'expires_at': expires_at
             })
+        elif queue_enabled and is_transient_error(message):
+            job_id = alias_jobs.enqueue(
+                alias_email, redirect_to, user_id, message, _retry_delay(1, config),
+                job_id=job and job['id'], may_exist=message != MAILCOW_UNREACHABLE, expires_at=expires_at,
+            )
+            logger.warning(f"Mailcow unavailable ({message}), alias {alias_email} queued for retry")
+            return _job_response(alias_jobs.get(job_id))
         else:
+            if job:
+                alias_jobs.finish(job['id'], 'failed', message, alias_email, redirect_to)
             return jsonify({'error': message}), 400
             
     except Exception as e:
         logger.error(f"Error creating alias: {e}")
+        if job:
+            alias_jobs.finish(job['id'], 'failed', 'Internal server error')
+        return jsonify({'error': 'Internal server error'}), 500
+
+
+def _create_one(index, alias_email, redirect_to, expires_at, user_id, config):
+    """Create one alias of a bulk request and describe the outcome"""
+    result = {'index': index, 'alias': alias_email, 'redirect_to': redirect_to}
+    try:
+        if check_alias_exists(alias_email, config):
+            return dict(result, success=False, error='This alias already exists')
+        success, message = create_mailcow_alias(alias_email, redirect_to, config)
+        if success:
+            record_created_alias(alias_email, redirect_to, user_id=user_id, expires_at=expires_at)
+            return dict(result, success=True, message=message)
+        return dict(result, success=False, error=message)
+    except Exception as e:
+        logger.error(f"Error creating alias {alias_email}: {e}")
+        return dict(result, success=False, error='Internal server error')
+
+
+@app.route('/api/create-aliases', methods=['POST'])
+@limiter.limit(configured_rate_limit('create_aliases'), key_func=rate_limit_key)
+def create_aliases():
+    """Endpoint to create many aliases in one request.
+
+    Body: {"aliases": [{"alias": ..., "redirectTo": ...}, ...], "stream": false}.
+    All items are validated before anything is sent to Mailcow; valid batches
+    are then created concurrently over the pooled Mailcow connection. With
+    "stream": true (or ?stream=1, or Accept: application/x-ndjson) results are
+    streamed as NDJSON in completion order instead of one JSON document.
+    """
+    config = load_config()
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    data = request.get_json(silent=True)
+    items = data.get('aliases') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'A non-empty "aliases" list is required'}), 400
+
+    max_items = config.get('bulk_max_items', 500)
+    if len(items) > max_items:
+        return jsonify({'error': f'Too many aliases in one request (maximum {max_items})'}), 400
+
+    batch, errors, seen = [], [], set()
+    for index, item in enumerate(items):
+        item, error = resolve_generated_alias(item, config, user_id)
+        if not error:
+            alias_email, redirect_to, error = validate_alias_request(item, config, user_id)
+        if not error:
+            expires_at, error = alias_expiry(item, config)
+        if not error and alias_email in seen:
+            error = 'Duplicate alias in request'
+        if error:
+            errors.append({'index': index, 'success': False, 'error': error})
+        else:
+            seen.add(alias_email)
+            batch.append((index, alias_email, redirect_to, expires_at))
+    if errors:
+        return jsonify({'error': 'Invalid aliases in request, nothing was created', 'results': errors}), 400
+
+    workers = max(1, min(config.get('bulk_workers', 4), len(batch)))
+
+    def results():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_create_one, *entry, user_id, config) for entry in batch]
+            for future in as_completed(futures):
+                yield future.result()
+
+    stream = (
+        data.get('stream') is True
+        or request.args.get('stream') in ('1', 'true')
+        or request.accept_mimetypes.best == 'application/x-ndjson'
+    )
+    if stream:
+        lines = (json.dumps(result, ensure_ascii=False) + '\n' for result in results())
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    ordered = sorted(results(), key=lambda result: result['index'])
+    created = sum(1 for result in ordered if result['success'])
+    return jsonify({
+        'success': created == len(ordered),
+        'created': created,
+        'failed': len(ordered) - created,
+        'results': ordered
+    })
+
+
+@app.route('/api/aliases')
+def list_alias_history():
+    """Endpoint to query the signed-in user's alias history.
+
+    Optional filters: ?redirect=, ?alias=, and ?current=1 to leave out
+    deleted aliases. Results are newest first; ?limit= sets the page size
+    (max 500) and ?cursor= (the next_cursor of the previous page) fetches the
+    next page.
+    """
+    config = load_config()
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        cursor = request.args.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'limit and cursor must be integers'}), 400
+
+    filters = {name: request.args.get(name) for name in AliasHistory.FILTERS}
+    for name in ('alias', 'redirect'):
+        if filters[name]:
+            filters[name] = filters[name].strip().lower()
+    filters['user'] = user_id
+
+    try:
+        rows, next_cursor = alias_history.query(limit=limit, cursor=cursor,
+                                                current=request.args.get('current') in ('1', 'true'), **filters)
+    except Exception as e:
+        logger.error(f"Error querying alias history: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+    return jsonify({'aliases': rows, 'next_cursor': next_cursor})
+
+
+def _owned_alias(alias_id, user_id):
+    """History row alias_id if it belongs to user_id and is not deleted, else None"""
+    row = alias_history.get(alias_id)
+    return row if row and row['user_id'] == user_id and not row['deleted_at'] else None
+
+
+@app.route('/api/aliases/<int:alias_id>', methods=['PATCH'])
+@limiter.limit(configured_rate_limit('manage_alias'), key_func=rate_limit_key)
+def update_alias(alias_id):
+    """Endpoint to enable or disable one of the signed-in user's aliases ({"active": true|false})"""
+    config = load_config()
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('active'), bool):
+        return jsonify({'error': 'Boolean "active" required'}), 400
+    row = _owned_alias(alias_id, user_id)
+    if not row:
+        return jsonify({'error': 'Alias not found'}), 404
+
+    success, message = set_mailcow_alias_active(row['alias'], data['active'], config)
+    if not success:
+        return jsonify({'error': message}), _manage_error_status(message)
+    alias_history.set_active(alias_id, data['active'])
+    logger.info(f"Alias {row['alias']} {'enabled' if data['active'] else 'disabled'} by {user_id}")
+    return jsonify({'success': True, 'alias': dict(row, active=int(data['active']))})
+
+
+@app.route('/api/aliases/<int:alias_id>', methods=['DELETE'])
+@limiter.limit(configured_rate_limit('manage_alias'), key_func=rate_limit_key)
+def delete_alias(alias_id):
+    """Endpoint to delete one of the signed-in user's aliases in Mailcow"""
+    config = load_config()
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    row = _owned_alias(alias_id, user_id)
+    if not row:
+        return jsonify({'error': 'Alias not found'}), 404
+
+    _, errors = delete_mailcow_aliases([row['alias']], config)
+    if errors:
+        return jsonify({'error': errors[row['alias']]}), _manage_error_status(errors[row['alias']])
+    alias_history.mark_deleted([alias_id])
+    logger.info(f"Alias {row['alias']} deleted by {user_id}")
+    return jsonify({'success': True})
+
+
+@app.route('/api/jobs/<job_id>')
+def get_alias_job(job_id):
+    """Endpoint to poll a queued alias creation (202 while pending)"""
+    config = load_config()
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    job = alias_jobs.get(job_id)
+    if not job or job['user_id'] != user_id:
+        return jsonify({'error': 'Job not found'}), 404
+    return _job_response(job)
+
+
+@app.route('/api/generate-alias', methods=['POST'])
+@limiter.limit(configured_rate_limit('generate_alias'), key_func=rate_limit_key)
+def generate_alias_endpoint():
+    """Endpoint to reserve a free alias for a service name.
+
+    Body: {"service": "github", "domain": "example.com"} (domain optional).
+    The returned alias is checked against the alias index and reserved for a
+    few minutes, so creating it right after will not collide.
+    """
+    config = load_config()
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'service' not in data:
+        return jsonify({'error': 'Service name required'}), 400
+
+    item, error = resolve_generated_alias({'service': data['service'], 'domain': data.get('domain')},
+                                          config, user_id)
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify({'alias': item['alias']})
+
+
 @app.route('/api/status')
 def status():
     """Endpoint to check API status"""
@@ -517,54 +3337,107 @@ def status():
             'message': 'Invalid configuration'
         }), 500
     
-    # Test connection to Mailcow
-    try:
-        api_url = f"{config['mailcow_url'].rstrip('/')}/api/v1/get/domain/all"
-        headers = {'X-API-Key': config['api_key']}
-        
-        response = requests.get(api_url, headers=headers, timeout=5)
-        
-        if response.status_code == 200:
-            return jsonify({
-                'status': 'ok',
-                'mailcow_url': config['mailcow_url'],
-                'domains': config.get('domains', []),
-                'default_domain': config.get('default_domain'),
-                'connection': 'success'
-            })
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': f'Mailcow connection error: {response.status_code}'
-            }), 500
-            
-    except Exception as e:
-        logger.error(f"Unable to connect to Mailcow: {e}")
+    # Connection to Mailcow, as last probed by the background health monitor
+    result = health_monitor.result(config)
+    if result['ok']:
         return jsonify({
-            'status': 'error',
-            'message': 'Unable to connect to Mailcow'
-        }), 500
+            'status': 'ok',
+            'mailcow_url': config['mailcow_url'],
+            'domains': config.get('domains', []),
+            'default_domain': config.get('default_domain'),
+            'connection': 'success',
+            'instances': result['instances'],
+            'checked_at': result['checked_at']
+        })
+    return jsonify({
+        'status': 'error',
+        'message': result['message'],
+        'instances': result['instances'],
+        'checked_at': result['checked_at']
+    }), 500
 
-@app.route('/api/config')
-def get_config():
-    """Endpoint to get public configuration information"""
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving. Never leaves the process."""
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: configuration is valid and the last Mailcow probe succeeded"""
     config = load_config()
-    
+
     if not config:
         return jsonify({
             'status': 'error',
             'message': 'Invalid configuration'
-        }), 500
-    
-    # Get user info from query parameter if provided (for authenticated requests)
-    user_id = request.args.get('user_id')
+        }), 503
+
+    result = health_monitor.result(config)
+    body = {
+        'status': 'ok' if result['ok'] else 'error',
+        'message': result['message'],
+        'checked_at': result['checked_at'],
+        'age_seconds': round(time.monotonic() - result['checked_monotonic'], 1),
+        'latency_ms': result['latency_ms']
+    }
+    return jsonify(body), 200 if result['ok'] else 503
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def _start_alias_reaper():
+    alias_reaper.ensure_started()
+
+
+@app.before_request
+def _start_alias_job_worker():
+    # On any request, so jobs queued before a restart are retried without
+    # waiting for their user to come back.
+    config = load_config()
+    if config and config.get('alias_queue_enabled', False):
+        alias_job_worker.ensure_started()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # The URL rule, not the path, keeps the label set bounded.
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(route=route, method=request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(route=route, method=request.method, status=response.status_code).inc()
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, summed over all workers in multiprocess mode"""
+    config = load_config() or {}
+    token = config.get('metrics_token')
+    if token:
+        scheme, _, provided = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(provided.strip(), token):
+            return jsonify({'error': 'Authentication required'}), 401
+
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def _public_config(config, user_id):
+    # Signed-in users (valid session token) get their own defaults
     default_redirect = 'user@example.com'
-    
-    # If user_id is provided, get user-specific default redirect
-    if user_id and config.get('users', {}).get(user_id):
-        user_config = config['users'][user_id]
-        default_redirect = user_config.get('default_redirect', default_redirect)
-    
+    if user_id:
+        default_redirect = config['users'][user_id].get('default_redirect', default_redirect)
+
     # Tell the frontend which URL the ALTCHA widget should use for its challenge.
     # Local provider serves it from this app; GateCHA serves it from its own host.
     altcha_provider = config.get('altcha_provider', 'local')
@@ -575,18 +3448,55 @@ def get_config():
     else:
         altcha_challenge_url = '/api/altcha/challenge'
 
-    return jsonify({
+    return {
         'version': __version__,
-        'domains': config.get('domains', [config.get('domain', 'example.com')]),
-        'default_domain': config.get('default_domain', config.get('domains', ['example.com'])[0]),
+        'domains': domain_validator(config).allowed_list(user_id),
+        'default_domain': default_domain(config, user_id),
         'default_redirect': default_redirect,
         'altcha_enabled': config.get('altcha_enabled', False),
         'altcha_provider': altcha_provider,
         'altcha_challenge_url': altcha_challenge_url,
-        'multi_user_enabled': bool(config.get('users'))
-    })
+        'multi_user_enabled': bool(config.get('users')),
+        'username_login': config.get('username_login', False),
+        'alias_suffix_length': config.get('alias_suffix_length', 4)
+    }
+
+
+def public_config_document(config, user_id=None):
+    """(dict, JSON body, ETag) of /api/config for user_id (None: signed out).
+
+    Built once per configuration snapshot and user; the snapshot is replaced
+    on every config.json change, which drops the cached documents with it.
+    """
+    documents = derived(config, 'public_config', lambda c: {})
+    document = documents.get(user_id)
+    if document is None:
+        data = _public_config(config, user_id)
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        document = documents[user_id] = (data, body, hashlib.sha256(body).hexdigest()[:32])
+    return document
+
+
+@app.route('/api/config')
+def get_config():
+    """Endpoint to get public configuration information"""
+    config = load_config()
+    
+    if not config:
+        return jsonify({
+            'status': 'error',
+            'message': 'Invalid configuration'
+        }), 500
+
+    _, body, etag = public_config_document(config, session_user(config))
+    # The body depends on the session token, so shared caches must not reuse it.
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache', 'Vary': 'Authorization'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
 
 @app.route('/api/altcha/challenge', methods=['GET'])
+@limiter.limit(configured_rate_limit('altcha_challenge'))
 def get_altcha_challenge():
     """Endpoint to get an ALTCHA challenge"""
     config = load_config()
@@ -604,7 +3514,7 @@ def get_altcha_challenge():
         return jsonify({'error': 'Challenges are served by the GateCHA server'}), 400
 
     try:
-        challenge, error = create_altcha_challenge(config)
+        challenge, error = create_altcha_challenge(config, get_remote_address())
         
         if error:
             return jsonify({'error': error}), 500
@@ -612,6 +3522,7 @@ def get_altcha_challenge():
         return jsonify({
             'algorithm': challenge.algorithm,
             'challenge': challenge.challenge,
+            'maxnumber': challenge.max_number,
             'salt': challenge.salt,
             'signature': challenge.signature
         })
@@ -621,7 +3532,7 @@ def get_altcha_challenge():
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/auth', methods=['POST'])
-@limiter.limit("10 per minute; 50 per hour")
+@limiter.limit(configured_rate_limit('auth'))
 def authenticate():
     """Endpoint to authenticate with password"""
     config = load_config()
@@ -643,15 +3554,23 @@ def authenticate():
             # Verify ALTCHA solution
             valid, error_msg = verify_altcha_solution(altcha_payload, config)
             if not valid:
+                record_auth_failure(get_remote_address(), config, reason='altcha')
                 return jsonify({'error': f'ALTCHA verification failed: {error_msg}'}), 400
         
         provided_password = data['password']
+        username = data.get('username')
+        if username is not None and not isinstance(username, str):
+            return jsonify({'error': 'Username must be a string'}), 400
+        if config.get('username_login', False) and not username:
+            return jsonify({'error': 'Username and password required'}), 400
         
         # Authenticate user with new multi-user system
-        user_info = authenticate_user(provided_password, config)
+        user_info = authenticate_user(provided_password, config, username=username or None)
         
         if user_info:
+            AUTH_SUCCESSES.inc()
             logger.info(f"User authenticated: {user_info['user_id']} ({user_info['description']})")
+            user_config, _, config_etag = public_config_document(config, user_info['user_id'])
             return jsonify({
                 'success': True,
                 'message': 'Authentication successful',
@@ -659,16 +3578,36 @@ def authenticate():
                     'id': user_info['user_id'],
                     'default_redirect': user_info['default_redirect'],
                     'description': user_info['description']
-                }
+                },
+                # The user's /api/config, so the alias page needs no extra request
+                'config': user_config,
+                'config_etag': config_etag,
+                **_session_response(user_info['user_id'], config)
             })
         else:
             logger.warning("Failed authentication attempt")
+            record_auth_failure(get_remote_address(), config)
+            if username:
+                return jsonify({'error': 'Invalid username or password'}), 401
             return jsonify({'error': 'Invalid password'}), 401
             
     except Exception as e:
         logger.error(f"Authentication error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def refresh_session():
+    """Endpoint to exchange a valid session token for a fresh one"""
+    config = load_config()
+
+    if not config:
+        return jsonify({'error': 'Invalid configuration'}), 500
+
+    user_id = session_user(config)
+    if not user_id:
+        return jsonify({'error': 'Authentication required'}), 401
+    return jsonify(_session_response(user_id, config))
+
 if __name__ == '__main__':
     # Load configuration to get port
     config = load_config()
@@ -0,0 +1,127 @@
+"""Peak memory and time of building the alias index from get/alias/all.
+
+Compares parsing the whole body with response.json() (the previous
+approach) against the streaming parser, iter_aliases(), on synthetic
+listings shaped like Mailcow's (every field of an alias, not just the
+address). Each measurement runs in a fresh process, so peak RSS is its own:
+
+    python benchmarks/bench_alias_listing.py [--sizes 10000,100000,1000000]
+
+Peak RSS is reported above the process's footprint after importing the app.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ('json', 'stream')
+
+
+class FileResponse:
+    """Stands in for a streamed requests.Response whose body is a file"""
+
+    status_code = 200
+
+    def __init__(self, path):
+        self.path = path
+
+    def json(self):
+        # What requests does: the whole body, decoded, then parsed.
+        with open(self.path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def iter_content(self, chunk_size):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def close(self):
+        pass
+
+
+def write_listing(path, count):
+    """Write a get/alias/all body with `count` aliases, without holding it in memory"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for n in range(count):
+            domain = f'example{n % 50}.com'
+            alias = {
+                'id': n + 1, 'domain': domain, 'public_comment': '', 'private_comment': '',
+                'goto': f'user{n % 1000}@{domain}', 'address': f'service{n}@{domain}',
+                'is_catch_all': 0, 'active': '1', 'active_int': 1, 'sogo_visible': '1',
+                'sogo_visible_int': 1, 'created': '2026-01-01 12:00:00', 'modified': None,
+            }
+            f.write((',' if n else '') + json.dumps(alias))
+        f.write(']')
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def child(mode, path):
+    import app as app_module
+
+    baseline = peak_rss_mb()
+    response = FileResponse(path)
+    start = time.perf_counter()
+    by_domain = {}
+    if mode == 'json':
+        for alias in app_module._alias_list(response.json()):
+            if isinstance(alias, dict) and alias.get('address'):
+                address = str(alias['address']).lower()
+                by_domain.setdefault(app_module._alias_domain(address), {})[address] = alias.get('id')
+    else:
+        for record in app_module.iter_aliases(response):
+            by_domain.setdefault(app_module._alias_domain(record.address), {})[record.address] = record.id
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'seconds': elapsed,
+        'peak_rss_mb': peak_rss_mb() - baseline,
+        'aliases': sum(len(addresses) for addresses in by_domain.values()),
+    }))
+
+
+def measure(mode, path):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', mode, path],
+        check=True, capture_output=True, text=True, cwd=ROOT,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma-separated alias counts')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    print(f"{'aliases':>9}{'body MB':>9}  {'mode':<8}{'seconds':>9}{'peak RSS MB':>13}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for count in (int(size) for size in args.sizes.split(',')):
+            path = os.path.join(workdir, f'aliases-{count}.json')
+            write_listing(path, count)
+            body_mb = os.path.getsize(path) / 1e6
+            for mode in MODES:
+                result = measure(mode, path)
+                assert result['aliases'] == count, result
+                print(f"{count:>9}{body_mb:>9.1f}  {mode:<8}{result['seconds']:>9.2f}{result['peak_rss_mb']:>13.1f}")
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Throughput of GET /api/altcha/challenge with and without the challenge pool.
+
+Runs the endpoint in-process through Flask's test client, so the numbers are
+the app's own cost per challenge (no network, no Gunicorn), and times
+create_altcha_challenge() on its own:
+
+    python benchmarks/bench_altcha_challenge.py [requests]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+CONFIG = {
+    "mailcow_url": "https://mail.test",
+    "api_key": "BENCH_KEY",
+    "domains": ["example.com"],
+    "default_domain": "example.com",
+    "altcha_enabled": True,
+    "altcha_provider": "local",
+    "altcha_hmac_key": "k" * 32,
+    "users": {},
+}
+
+
+def run_direct(config, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        app_module.create_altcha_challenge(config, "192.0.2.1")
+    return requests / (time.perf_counter() - start)
+
+
+def run(client, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get("/api/altcha/challenge")
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    app_module.limiter.enabled = False
+    client = app_module.app.test_client()
+
+    results = {}
+    for label, pool_size in (("signed per request", 0), ("pool", 1024)):
+        config = dict(CONFIG, altcha_pool_size=pool_size)
+        app_module.load_config = lambda: config
+        app_module.altcha_pool = app_module.ChallengePool()
+        if pool_size:
+            # Warm the pool as a running worker would have, then let the
+            # background thread keep it topped up during the run.
+            app_module.create_altcha_challenge(config)
+            app_module.altcha_pool.refill()
+        run(client, 200)  # warm-up
+        results[label] = (run(client, requests), run_direct(config, requests))
+        print(f"{label:>20}: {results[label][0]:8.0f} requests/s  {results[label][1]:8.0f} calls/s")
+
+    before, after = results["signed per request"], results["pool"]
+    print(f"{'speed-up':>20}: {after[0] / before[0]:8.2f}x            {after[1] / before[1]:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Stand-in for the Mailcow API, for benchmarks and local development.
+
+Implements the endpoints the app calls (get/alias/all, add/alias,
+get/status/version) with a configurable response latency, error rate and
+alias table size:
+
+    python benchmarks/fake_mailcow.py --port 8081 --latency 0.05 --error-rate 0.01 --aliases 20000
+
+Point "mailcow_url" at http://127.0.0.1:8081 and use the --api-key value as
+"api_key".
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeMailcow(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api_key='BENCH_KEY', latency=0.0, jitter=0.0,
+                 error_rate=0.0, alias_count=1000, domain='example.com'):
+        super().__init__(address, FakeMailcowHandler)
+        self.api_key = api_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.aliases = [
+            {'id': n + 1, 'address': f'existing{n}@{domain}', 'goto': f'user@{domain}', 'active': 1}
+            for n in range(alias_count)
+        ]
+        self._listing = None  # cached get/alias/all body
+        self.calls = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def listing(self):
+        with self.lock:
+            if self._listing is None:
+                self._listing = json.dumps(self.aliases).encode()
+            return self._listing
+
+    def add(self, address, goto):
+        with self.lock:
+            if any(a['address'] == address for a in self.aliases[-1000:]):
+                return False
+            self.aliases.append({'id': len(self.aliases) + 1, 'address': address, 'goto': goto, 'active': 1})
+            self._listing = None
+            return True
+
+
+class FakeMailcowHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like Mailcow behind nginx
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        endpoint = self.path.split('?', 1)[0].removeprefix('/api/v1/')
+        with server.lock:
+            server.calls[endpoint] = server.calls.get(endpoint, 0) + 1
+
+        if server.latency or server.jitter:
+            time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        if self.headers.get('X-API-Key') != server.api_key:
+            return self._send(401, {'type': 'error', 'msg': 'authentication failed'})
+        if random.random() < server.error_rate:
+            return self._send(500, {'type': 'error', 'msg': 'internal error'})
+
+        if method == 'GET' and endpoint == 'get/alias/all':
+            return self._send(200, server.listing())
+        if method == 'GET' and endpoint == 'get/status/version':
+            return self._send(200, {'version': 'fake'})
+        if method == 'POST' and endpoint == 'add/alias':
+            data = json.loads(body or b'{}')
+            address = str(data.get('address', '')).lower()
+            if not server.add(address, data.get('goto')):
+                return self._send(200, [{'type': 'danger', 'msg': ['alias_invalid', address]}])
+            return self._send(200, [{'type': 'success', 'msg': ['alias_added', address]}])
+        return self._send(404, {'type': 'error', 'msg': 'route not found'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def start(port=0, **options):
+    """Start a FakeMailcow on 127.0.0.1 in a background thread and return it"""
+    server = FakeMailcow(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--api-key', default='BENCH_KEY')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with HTTP 500')
+    parser.add_argument('--aliases', type=int, default=1000, help='size of the alias table')
+    args = parser.parse_args()
+
+    server = FakeMailcow(('127.0.0.1', args.port), api_key=args.api_key, latency=args.latency,
+                         jitter=args.jitter, error_rate=args.error_rate, alias_count=args.aliases)
+    print(f'Fake Mailcow listening on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
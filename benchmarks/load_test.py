@@ -0,0 +1,230 @@
+"""Load test of the real Gunicorn entry point against a fake Mailcow.
+
+Starts benchmarks/fake_mailcow.py in-process, writes a throw-away config.json
+into a temporary working directory, launches `gunicorn app:app` there (same
+worker model as docker-start.sh) and drives /api/auth, /api/create-alias,
+/api/altcha/challenge and /api/status at a fixed concurrency. Reports
+throughput and p50/p95/p99 latency per endpoint:
+
+    python benchmarks/load_test.py --concurrency 16 --duration 10 --mailcow-latency 0.05
+
+Save a run with --json results.json and compare a later one against it with
+--baseline results.json (exits 1 when an endpoint's throughput drops or its
+p95 rises by more than --tolerance).
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_mailcow  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'bench-password'
+UNLIMITED = '1000000 per second'
+
+SCENARIOS = ('auth', 'create-alias', 'altcha-challenge', 'status')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_config(workdir, mailcow_url, api_key, altcha_enabled=False):
+    config = {
+        'mailcow_url': mailcow_url,
+        'api_key': api_key,
+        'domains': ['example.com'],
+        'default_domain': 'example.com',
+        'session_secret': 'bench-session-secret',
+        'altcha_enabled': altcha_enabled,
+        'altcha_hmac_key': 'k' * 32,
+        # The limits would otherwise throttle the load generator (one IP).
+        'rate_limits': {name: UNLIMITED for name in
+                        ('auth', 'create_alias', 'create_aliases', 'generate_alias', 'altcha_challenge')},
+        'users': {
+            'bench': {
+                'password': generate_password_hash(PASSWORD),
+                'default_redirect': 'bench@example.com',
+                'description': 'Benchmark user',
+            },
+        },
+    }
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+
+def start_gunicorn(workdir, port, args):
+    env = dict(
+        os.environ,
+        LOG_DIR=os.path.join(workdir, 'logs'),
+        STATE_STORAGE_URI=f"sqlite:///{os.path.join(workdir, 'state.sqlite3')}",
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'prometheus'),
+    )
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    command = [
+        sys.executable, '-m', 'gunicorn', '--config', os.path.join(ROOT, 'gunicorn.conf.py'),
+        '--chdir', workdir, '--pythonpath', ROOT, '--bind', f'127.0.0.1:{port}',
+        '--workers', str(args.workers), '--worker-class', args.worker_class, '--threads', str(args.threads),
+        '--log-level', 'warning', 'app:app',
+    ]
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{base}/healthz', timeout=1).ok:
+                return process, base
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def make_request(scenario, session, base, token):
+    if scenario == 'auth':
+        return session.post(f'{base}/api/auth', json={'password': PASSWORD})
+    if scenario == 'create-alias':
+        return session.post(
+            f'{base}/api/create-alias',
+            json={'alias': f'bench{uuid.uuid4().hex[:12]}@example.com', 'redirectTo': 'bench@example.com'},
+            headers={'Authorization': f'Bearer {token}'},
+        )
+    if scenario == 'altcha-challenge':
+        return session.get(f'{base}/api/altcha/challenge')
+    return session.get(f'{base}/api/status')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_scenario(scenario, base, token, concurrency, duration):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        local, local_errors = [], 0
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                ok = make_request(scenario, session, base, token).status_code < 400
+            except requests.exceptions.RequestException:
+                ok = False
+            local.append(time.perf_counter() - start)
+            local_errors += not ok
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against baseline, as printable lines"""
+    regressions = []
+    for scenario, current in results.items():
+        before = baseline.get(scenario)
+        if not before:
+            continue
+        if current['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{scenario}: throughput {before['throughput']:.0f} -> {current['throughput']:.0f} req/s")
+        if current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {before['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per scenario')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--worker-class', default='gthread')
+    parser.add_argument('--mailcow-latency', type=float, default=0.02)
+    parser.add_argument('--mailcow-jitter', type=float, default=0.005)
+    parser.add_argument('--mailcow-error-rate', type=float, default=0.0)
+    parser.add_argument('--aliases', type=int, default=10000, help='alias table size of the fake Mailcow')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    mailcow = fake_mailcow.start(latency=args.mailcow_latency, jitter=args.mailcow_jitter,
+                                 error_rate=args.mailcow_error_rate, alias_count=args.aliases)
+    with tempfile.TemporaryDirectory() as workdir:
+        write_config(workdir, mailcow.url, mailcow.api_key)
+        process, base = start_gunicorn(workdir, free_port(), args)
+        try:
+            token = requests.post(f'{base}/api/auth', json={'password': PASSWORD}).json()['token']
+            results = {}
+            print(f"{'endpoint':<18}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+            for scenario in args.scenarios.split(','):
+                # Challenges are only served with ALTCHA enabled, but logins would
+                # then need a solved one: toggle it around that scenario (the
+                # workers pick up config.json changes on the next request).
+                altcha = scenario == 'altcha-challenge'
+                if altcha:
+                    write_config(workdir, mailcow.url, mailcow.api_key, altcha_enabled=True)
+                r = results[scenario] = run_scenario(scenario, base, token, args.concurrency, args.duration)
+                if altcha:
+                    write_config(workdir, mailcow.url, mailcow.api_key)
+                print(f"{scenario:<18}{r['requests']:>9}{r['errors']:>8}{r['throughput']:>9.0f}"
+                      f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            mailcow.shutdown()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
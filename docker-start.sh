@@ -13,5 +13,29 @@ PORT=$DOCKER_PORT
 echo "🌐 Starting server on port $PORT"
 echo "📝 Make sure you have configured the config.json file"
 
+# Worker model. "gthread" (default) serves each request on a thread, so a
+# worker keeps answering while other requests wait on Mailcow or GateCHA; the
+# number of in-flight upstream calls is WORKERS x THREADS. Set
+# WORKER_CLASS=sync for the previous one-request-per-worker behaviour.
+WORKER_CLASS=${WORKER_CLASS:-gthread}
+WORKERS=${WORKERS:-2}
+THREADS=${THREADS:-8}
+
+# Gunicorn turns a sync worker into gthread whenever --threads is above 1, so
+# the flag is only passed to gthread workers.
+THREAD_ARGS=()
+if [ "$WORKER_CLASS" = "gthread" ]; then
+    THREAD_ARGS=(--threads "$THREADS")
+fi
+
+# Prometheus metrics from all workers are aggregated through files in this
+# directory; start from an empty one so counters of a previous run are dropped.
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+echo "⚙️  Gunicorn: $WORKERS $WORKER_CLASS worker(s)$([ "$WORKER_CLASS" = "gthread" ] && echo " x $THREADS threads")"
+
 # Start Gunicorn with the configured port
-exec gunicorn --bind "0.0.0.0:$PORT" --workers 2 --timeout 120 --access-logfile - --error-logfile - app:app
\ No newline at end of file
+exec gunicorn --config gunicorn.conf.py --bind "0.0.0.0:$PORT" --workers "$WORKERS" --worker-class "$WORKER_CLASS" "${THREAD_ARGS[@]}" \
+    --timeout 120 --access-logfile - --error-logfile - app:app
\ No newline at end of file
@@ -0,0 +1,8 @@
+# Gunicorn settings loaded by docker-start.sh (command-line flags set the rest).
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    """Drop the live-gauge samples of a worker that exited"""
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Import existing alias_log.json files into the alias history database.
+
+Usage:
+    python import_alias_log.py                         # logs/alias_log.json
+    python import_alias_log.py logs/alias_log*.json*   # rotated logs, .gz too
+
+Entries already present in the history are skipped, so running the import
+again (or on overlapping files) does not create duplicates.
+"""
+
+import gzip
+import sys
+
+from app import alias_history, audit_log
+
+
+def main():
+    paths = sys.argv[1:] or [audit_log.path]
+    total = 0
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt', encoding='utf-8') as f:
+                imported = alias_history.import_log(f)
+        except OSError as e:
+            print(f"❌ Cannot read {path}: {e}", file=sys.stderr)
+            return 1
+        print(f"✅ {path}: {imported} alias(es) imported")
+        total += imported
+
+    print(f"📦 {total} alias(es) imported into {alias_history.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
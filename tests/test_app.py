@@ -1,7 +1,13 @@
 """Tests for the Mailcow Alias Generator Flask app."""
 
 import base64
+import gzip
 import json
+import os
+import re
+import shutil
+import subprocess
+import sys
 from types import SimpleNamespace
 
 import pytest
@@ -35,14 +41,206 @@ TEST_CONFIG = {
 }
 
 
+class FakeResponse:
+    def __init__(self, status_code=200, payload=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+    def iter_content(self, chunk_size=1):
+        body = self.text.encode("utf-8")
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeMailcow:
+    """Stands in for MailcowClient so no test talks to the network."""
+
+    def __init__(self, aliases=()):
+        self.aliases = [{"id": i, "address": a, "goto": "me@example.com", "active": 1}
+                        for i, a in enumerate(aliases, 1)]
+        self.calls = []
+        self.add_errors = []  # exceptions/responses returned by the next add_alias calls
+
+    def get_aliases(self):
+        self.calls.append("get_aliases")
+        return FakeResponse(payload=self.aliases)
+
+    def get_alias(self, address):
+        self.calls.append(("get_alias", address))
+        return FakeResponse(payload=next((a for a in self.aliases if a["address"] == address), []))
+
+    def get_version(self, timeout=None):
+        self.calls.append("get_version")
+        return FakeResponse(payload={"version": "2026-01"})
+
+    def add_alias(self, address, goto, sogo_visible=True, active=True):
+        self.calls.append("add_alias")
+        if self.add_errors:
+            error = self.add_errors.pop(0)
+            if isinstance(error, Exception):
+                raise error
+            return error
+        self.aliases.append({"id": len(self.aliases) + 1, "address": address, "goto": goto, "active": 1})
+        return FakeResponse(payload=[{"type": "success", "msg": ["alias_added", address]}])
+
+    def edit_aliases(self, alias_ids, attr):
+        self.calls.append(("edit_aliases", list(alias_ids), attr))
+        return FakeResponse(payload=[{"type": "success", "msg": ["alias_modified"]}])
+
+    def delete_aliases(self, alias_ids):
+        self.calls.append(("delete_aliases", list(alias_ids)))
+        known = {a["id"] for a in self.aliases}
+        if any(alias_id not in known for alias_id in alias_ids):
+            return FakeResponse(payload=[{"type": "danger", "msg": ["access_denied"]}])
+        self.aliases = [a for a in self.aliases if a["id"] not in alias_ids]
+        return FakeResponse(payload=[{"type": "success", "msg": ["alias_removed"]}])
+
+
+@pytest.fixture
+def mailcow(monkeypatch):
+    fake = FakeMailcow(aliases=["taken1234@example.com"])
+    monkeypatch.setattr(app_module, "get_mailcow_client", lambda config, instance=None: fake)
+    monkeypatch.setattr(app_module, "alias_index", app_module.AliasIndex())
+    monkeypatch.setattr(app_module, "health_monitor", app_module.HealthMonitor(background=False))
+    monkeypatch.setattr(app_module, "alias_reservations", app_module.AliasReservations())
+    return fake
+
+
+@pytest.fixture(autouse=True, scope="session")
+def isolated_workdir(tmp_path_factory):
+    """Run from an empty directory: a real load_config() (from a background
+    thread) then finds no config.json and writes its config.sample.json
+    there, not over the tracked sample."""
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("workdir"))
+    yield
+    os.chdir(previous)
+
+
+@pytest.fixture(autouse=True)
+def state_backend(monkeypatch):
+    backend = app_module.create_state_backend("memory://")
+    monkeypatch.setattr(app_module, "state_backend", backend)
+    return backend
+
+
+@pytest.fixture(autouse=True)
+def challenge_pool(monkeypatch):
+    pool = app_module.ChallengePool(background=False)
+    monkeypatch.setattr(app_module, "altcha_pool", pool)
+    return pool
+
+
+@pytest.fixture(autouse=True)
+def audit_log(monkeypatch, tmp_path):
+    log = app_module.AuditLog(str(tmp_path / "alias_log.json"))
+    monkeypatch.setattr(app_module, "audit_log", log)
+    return log
+
+
+@pytest.fixture(autouse=True)
+def alias_history(monkeypatch, tmp_path):
+    history = app_module.AliasHistory(str(tmp_path / "alias_history.sqlite3"))
+    monkeypatch.setattr(app_module, "alias_history", history)
+    return history
+
+
+@pytest.fixture(autouse=True)
+def alias_jobs(monkeypatch, tmp_path):
+    queue = app_module.AliasJobQueue(str(tmp_path / "alias_jobs.sqlite3"))
+    monkeypatch.setattr(app_module, "alias_jobs", queue)
+    # Tests run retries by hand with process_alias_job(), and reaper rounds
+    # with reap_expired_aliases().
+    monkeypatch.setattr(app_module.alias_job_worker, "ensure_started", lambda: None)
+    monkeypatch.setattr(app_module.alias_reaper, "ensure_started", lambda: None)
+    return queue
+
+
 @pytest.fixture
-def client(monkeypatch):
+def anon_client(monkeypatch, mailcow):
     app_module.app.config["TESTING"] = True
     app_module.limiter.enabled = False  # disabled by default; one test re-enables it
     monkeypatch.setattr(app_module, "load_config", lambda: TEST_CONFIG)
     return app_module.app.test_client()
 
 
+@pytest.fixture
+def client(anon_client):
+    """Test client signed in as alice (session token on every request)."""
+    token = app_module.issue_session_token("alice", TEST_CONFIG)
+    anon_client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+    return anon_client
+
+
+# --- ConfigStore ------------------------------------------------------------
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(TEST_CONFIG))
+    return path
+
+
+def test_config_store_parses_once(config_file, monkeypatch):
+    calls = []
+    real_read = app_module._read_config
+    monkeypatch.setattr(app_module, "_read_config", lambda p: calls.append(p) or real_read(p))
+    store = app_module.ConfigStore(str(config_file))
+
+    first = store.get()
+    assert store.get() is first
+    assert len(calls) == 1 and store.reload_count == 1
+    assert first["domains"] == ("example.com", "example2.com")
+
+
+def test_config_store_snapshot_is_read_only(config_file):
+    config = app_module.ConfigStore(str(config_file)).get()
+    with pytest.raises(TypeError):
+        config["api_key"] = "other"
+    with pytest.raises(TypeError):
+        config["users"]["alice"]["password"] = "x"
+
+
+def test_config_store_reloads_on_change(config_file):
+    store = app_module.ConfigStore(str(config_file))
+    assert store.get()["default_domain"] == "example.com"
+
+    config_file.write_text(json.dumps(dict(TEST_CONFIG, default_domain="example2.com")))
+    assert store.get()["default_domain"] == "example2.com"
+    assert store.reload_count == 2
+
+
+def test_config_store_invalidate_forces_reload(config_file):
+    store = app_module.ConfigStore(str(config_file))
+    first = store.get()
+    store.invalidate()  # what the SIGHUP handler does
+    assert store.get() is not first
+    assert store.reload_count == 2
+
+
+def test_config_store_warns_about_plaintext_once(config_file, caplog):
+    store = app_module.ConfigStore(str(config_file))
+    for _ in range(3):
+        store.get()
+    warnings = [r for r in caplog.records if "Plaintext password" in r.getMessage()]
+    assert len(warnings) == 1
+
+
+def test_config_store_invalid_file(config_file):
+    config_file.write_text("{not json")
+    store = app_module.ConfigStore(str(config_file))
+    assert store.get() is None
+    config_file.write_text(json.dumps(TEST_CONFIG))
+    assert store.get() is not None
+
+
 # --- password_matches -------------------------------------------------------
 
 def test_password_matches_hashed():
@@ -69,6 +267,99 @@ def test_authenticate_user_hashed_and_legacy():
     assert app_module.authenticate_user("bad", TEST_CONFIG) is None
 
 
+def test_authenticate_user_by_username_verifies_once(monkeypatch):
+    calls = []
+    real = app_module.password_matches
+    monkeypatch.setattr(app_module, "password_matches",
+                        lambda stored, provided: calls.append(stored) or real(stored, provided))
+
+    assert app_module.authenticate_user("hashed-pass", TEST_CONFIG, username="alice")["user_id"] == "alice"
+    assert app_module.authenticate_user("plain-pass", TEST_CONFIG, username="alice") is None
+    assert len(calls) == 2  # one verification per attempt, not one per user
+
+
+def test_authenticate_user_unknown_username_checks_dummy_hash(monkeypatch):
+    calls = []
+    real = app_module.password_matches
+    monkeypatch.setattr(app_module, "password_matches",
+                        lambda stored, provided: calls.append(stored) or real(stored, provided))
+
+    assert app_module.authenticate_user("hashed-pass", TEST_CONFIG, username="mallory") is None
+    assert len(calls) == 1
+    # Same hash method and cost as the configured users, so timing stays flat.
+    alice_method = TEST_CONFIG["users"]["alice"]["password"].split("$", 1)[0]
+    assert calls[0].split("$", 1)[0] == alice_method
+
+
+# --- static assets ----------------------------------------------------------
+
+@pytest.mark.skipif(not shutil.which("node"), reason="needs node to parse JavaScript")
+@pytest.mark.parametrize("page", ["index.html", "login.html"])
+def test_page_scripts_parse(page, tmp_path):
+    html = open(os.path.join(os.path.dirname(app_module.__file__), page), encoding="utf-8").read()
+    scripts = re.findall(r"<script>(.*?)</script>", html, re.S)
+    assert scripts
+    for n, script in enumerate(scripts):
+        path = tmp_path / f"script{n}.js"
+        path.write_text(script, encoding="utf-8")
+        result = subprocess.run(["node", "--check", str(path)], capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+
+def test_page_is_served_compressed_with_etag(anon_client):
+    response = anon_client.get("/login", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert b"Access Required" in gzip.decompress(response.data)
+
+    plain = anon_client.get("/login")
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["ETag"] != response.headers["ETag"]
+
+
+def test_unchanged_asset_answers_304(anon_client):
+    etag = anon_client.get("/favicon.svg").headers["ETag"]
+    response = anon_client.get("/favicon.svg", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    assert anon_client.get("/favicon.svg", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_altcha_js_has_content_hashed_url(anon_client):
+    version = app_module.static_assets["altcha.js"].version
+    page = anon_client.get("/login").get_data(as_text=True)
+    assert f'src="/altcha.{version}.js"' in page
+
+    response = anon_client.get(f"/altcha.{version}.js")
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert response.data == anon_client.get("/altcha.js").data
+    # An outdated hash still gets the script, but not cached for good.
+    assert anon_client.get("/altcha.0123456789abcdef.js").headers["Cache-Control"] == "no-cache"
+
+
+def test_static_asset_reloads_on_change(tmp_path):
+    now = [0.0]
+    script = tmp_path / "app.js"
+    page = tmp_path / "page.html"
+    script.write_text("console.log(1)")
+    page.write_text('<script src="/app.js"></script>')
+    js = app_module.StaticAsset("app.js", "text/javascript", root=str(tmp_path), clock=lambda: now[0])
+    html = app_module.StaticAsset(
+        "page.html", "text/html", root=str(tmp_path), depends=(js,), clock=lambda: now[0],
+        render=lambda data: data.replace(b"/app.js", f"/app.{js.version}.js".encode()))
+    first = html.current()[1]["identity"]
+    assert f"/app.{js.version}.js".encode() in first
+
+    script.write_text("console.log(2); // changed")
+    assert html.current()[1]["identity"] == first  # not re-checked yet
+    now[0] += app_module.StaticAsset.CHECK_INTERVAL
+    assert f"/app.{js.version}.js".encode() in html.current()[1]["identity"]
+    assert html.current()[1]["identity"] != first
+
+
 # --- /api/config ------------------------------------------------------------
 
 def test_config_local_provider(client):
@@ -89,6 +380,51 @@ def test_config_gatecha_provider(client, monkeypatch):
     assert data["altcha_challenge_url"] == "https://gate.test/api/v1/challenge?apiKey=gk_abc"
 
 
+def test_config_is_built_once_per_snapshot_and_user(client, anon_client, monkeypatch):
+    cfg = dict(TEST_CONFIG)
+    monkeypatch.setattr(app_module, "load_config", lambda: cfg)
+    calls = []
+    build = app_module._public_config
+    monkeypatch.setattr(app_module, "_public_config",
+                        lambda config, user_id: calls.append(user_id) or build(config, user_id))
+    signed_in = client.get("/api/config")
+    assert client.get("/api/config").data == signed_in.data
+    assert calls == ["alice"]
+    assert signed_in.get_json()["default_redirect"] == "alice@example.com"
+    assert signed_in.headers["Vary"] == "Authorization"
+
+    del anon_client.environ_base["HTTP_AUTHORIZATION"]
+    anonymous = anon_client.get("/api/config")
+    assert anonymous.get_json()["default_redirect"] == "user@example.com"
+    assert anonymous.headers["ETag"] != signed_in.headers["ETag"]
+    assert calls == ["alice", None]
+
+
+def test_config_answers_304_when_unchanged(client):
+    etag = client.get("/api/config").headers["ETag"]
+    response = client.get("/api/config", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_pages_inline_public_config(anon_client, monkeypatch):
+    cfg = dict(TEST_CONFIG, default_domain="</script><b>.example.com")
+    monkeypatch.setattr(app_module, "load_config", lambda: cfg)
+    page = anon_client.get("/login").get_data(as_text=True)
+    start = page.index('<script id="config-bootstrap" type="application/json">')
+    inlined = page[start:page.index("</script>", start)].split(">", 1)[1]
+    assert "<" not in inlined
+    assert json.loads(inlined) == anon_client.get("/api/config").get_json()
+    assert "<!-- config-bootstrap -->" not in anon_client.get("/").get_data(as_text=True)
+
+
+def test_auth_returns_user_config(anon_client):
+    data = anon_client.post("/api/auth", json={"password": "hashed-pass"}).get_json()
+    assert data["config"]["default_redirect"] == "alice@example.com"
+    headers = {"Authorization": f"Bearer {data['token']}", "If-None-Match": f'"{data["config_etag"]}"'}
+    assert anon_client.get("/api/config", headers=headers).status_code == 304
+
+
 # --- /api/create-alias ------------------------------------------------------
 
 def test_create_alias_missing_fields(client):
@@ -125,6 +461,720 @@ def test_create_alias_does_not_leak_exception(client, monkeypatch):
     assert "Traceback" not in str(r.get_json())
 
 
+# --- alias retry queue ------------------------------------------------------
+
+QUEUE_CONFIG = dict(TEST_CONFIG, alias_queue_enabled=True)
+
+
+@pytest.fixture
+def queue_client(client, monkeypatch):
+    monkeypatch.setattr(app_module, "load_config", lambda: QUEUE_CONFIG)
+    return client
+
+
+def timeout():
+    import requests
+    return requests.exceptions.ReadTimeout("slow")
+
+
+def test_transient_failure_is_queued_and_retried(queue_client, mailcow, alias_jobs):
+    mailcow.add_errors = [timeout()]
+    body = {"alias": "q1@example.com", "redirectTo": "dest@example.com"}
+    response = queue_client.post("/api/create-alias", json=body)
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data["queued"] is True and data["status"] == "pending" and data["attempts"] == 1
+    assert data["status_url"] == f"/api/jobs/{data['job_id']}"
+
+    assert alias_jobs.claim_due() is None  # backoff not over yet
+    alias_jobs._clock = lambda: app_module.time.time() + 10
+    job = alias_jobs.claim_due()
+    app_module.process_alias_job(job, QUEUE_CONFIG)
+
+    status = queue_client.get(data["status_url"])
+    assert status.status_code == 200 and status.get_json()["status"] == "succeeded"
+    rows, _ = app_module.alias_history.query(alias="q1@example.com")
+    assert rows and rows[0]["user_id"] == "alice"
+
+
+def test_job_worker_starts_on_any_request(anon_client, monkeypatch):
+    started = []
+    monkeypatch.setattr(app_module.alias_job_worker, "ensure_started", lambda: started.append(1))
+    anon_client.get("/api/config")
+    assert not started  # queue disabled
+    monkeypatch.setattr(app_module, "load_config", lambda: QUEUE_CONFIG)
+    anon_client.get("/api/config")  # not a create or a poll: jobs left by a restart get retried
+    assert started
+
+
+def test_permanent_failures_are_not_queued(queue_client, mailcow):
+    mailcow.add_errors = [FakeResponse(payload=[{"type": "danger", "msg": ["alias_invalid"]}])]
+    body = {"alias": "q2@example.com", "redirectTo": "dest@example.com"}
+    assert queue_client.post("/api/create-alias", json=body).status_code == 400
+
+
+def test_queue_disabled_reports_timeout(client, mailcow):
+    mailcow.add_errors = [timeout()]
+    response = client.post("/api/create-alias", json={"alias": "q3@example.com", "redirectTo": "d@example.com"})
+    assert response.status_code == 400 and response.get_json()["error"] == "Connection timeout"
+
+
+def test_retries_back_off_then_fail(mailcow, alias_jobs):
+    config = dict(QUEUE_CONFIG, alias_queue_max_attempts=3, alias_queue_backoff=2)
+    mailcow.add_errors = [timeout(), timeout()]
+    job_id = alias_jobs.enqueue("q4@example.com", "d@example.com", "alice", "Connection timeout", 0)
+    now = [app_module.time.time()]
+    alias_jobs._clock = lambda: now[0]
+
+    app_module.process_alias_job(alias_jobs.claim_due(), config)
+    job = alias_jobs.get(job_id)
+    assert job["status"] == "pending" and job["attempts"] == 2
+    assert job["next_attempt_at"] == pytest.approx(now[0] + 4)  # 2 * 2**1
+
+    now[0] += 4
+    app_module.process_alias_job(alias_jobs.claim_due(), config)
+    assert alias_jobs.get(job_id)["status"] == "failed"
+
+
+def test_retry_after_timeout_detects_alias_created_upstream(mailcow, alias_jobs):
+    # The first attempt timed out but Mailcow did create the alias: the retry
+    # is rejected as a duplicate, which must count as success.
+    mailcow.aliases.append({"id": 9, "address": "q5@example.com", "goto": "d@example.com", "active": 1})
+    mailcow.add_errors = [FakeResponse(payload=[{"type": "danger", "msg": ["is_alias_or_mailbox"]}])]
+    job_id = alias_jobs.enqueue("q5@example.com", "d@example.com", "alice", "Connection timeout", 0,
+                                may_exist=True)
+    app_module.process_alias_job(alias_jobs.claim_due(), QUEUE_CONFIG)
+    assert alias_jobs.get(job_id)["status"] == "succeeded"
+    assert ("get_alias", "q5@example.com") in mailcow.calls
+    assert "get_aliases" not in mailcow.calls  # one lookup, not the whole listing
+
+
+def test_idempotency_key_replays_outcome(queue_client, mailcow):
+    headers = {"Idempotency-Key": "abc-123"}
+    body = {"service": "shop", "redirectTo": "dest@example.com"}
+    first = queue_client.post("/api/create-alias", json=body, headers=headers)
+    second = queue_client.post("/api/create-alias", json=body, headers=headers)
+    assert first.status_code == 200 and second.status_code == 200
+    assert second.get_json()["alias"] == first.get_json()["alias"]
+    assert mailcow.calls.count("add_alias") == 1
+
+    # Same key while the first attempt is queued: still one job.
+    mailcow.add_errors = [timeout()]
+    headers = {"Idempotency-Key": "def-456"}
+    first = queue_client.post("/api/create-alias", json=body, headers=headers)
+    second = queue_client.post("/api/create-alias", json=body, headers=headers)
+    assert first.status_code == second.status_code == 202
+    assert first.get_json()["job_id"] == second.get_json()["job_id"]
+    assert mailcow.calls.count("add_alias") == 2
+
+
+def test_idempotency_keys_are_per_user(queue_client, mailcow):
+    body = {"alias": "q6@example.com", "redirectTo": "dest@example.com"}
+    queue_client.post("/api/create-alias", json=body, headers={"Idempotency-Key": "k"})
+    bob = app_module.issue_session_token("bob", QUEUE_CONFIG)
+    response = queue_client.post("/api/create-alias", json=dict(body, alias="q7@example.com"),
+                                 headers={"Idempotency-Key": "k", "Authorization": f"Bearer {bob}"})
+    assert response.status_code == 200 and response.get_json()["alias"] == "q7@example.com"
+
+
+def test_job_status_is_private(queue_client, mailcow, alias_jobs):
+    job_id = alias_jobs.enqueue("q8@example.com", "d@example.com", "bob", "Connection timeout", 60)
+    assert queue_client.get(f"/api/jobs/{job_id}").status_code == 404
+    assert queue_client.get("/api/jobs/nope").status_code == 404
+
+
+def test_abandoned_idempotency_claim_is_taken_over(alias_jobs):
+    job, created = alias_jobs.begin("alice:k", "alice")
+    assert created
+    assert alias_jobs.begin("alice:k", "alice") == (job, False)
+    alias_jobs._clock = lambda: app_module.time.time() + app_module.AliasJobQueue.LEASE + 1
+    again, created = alias_jobs.begin("alice:k", "alice")
+    assert created and again["id"] == job["id"]
+
+
+# --- Mailcow client ---------------------------------------------------------
+
+def test_mailcow_client_is_shared_per_config():
+    client = app_module.get_mailcow_client(TEST_CONFIG)
+    assert app_module.get_mailcow_client(TEST_CONFIG) is client
+    assert client.session.headers["X-API-Key"] == "TEST_KEY"
+    adapter = client.session.get_adapter("https://mail.test/")
+    assert adapter._pool_maxsize == 10
+
+    resized = dict(TEST_CONFIG, mailcow_pool_size=32)
+    other = app_module.get_mailcow_client(resized)
+    assert other is not client
+    assert other.session.get_adapter("https://mail.test/")._pool_maxsize == 32
+
+
+def test_create_mailcow_alias_uses_pooled_client(monkeypatch):
+    sent = []
+    client = app_module.get_mailcow_client(TEST_CONFIG)
+
+    def fake_request(method, url, timeout=None, **kwargs):
+        sent.append((method, url, kwargs["json"]))
+        return FakeResponse(payload=[{"type": "success", "msg": ["alias_added"]}])
+
+    monkeypatch.setattr(client.session, "request", fake_request)
+    ok, message = app_module.create_mailcow_alias("svc@example.com", "me@example.com", TEST_CONFIG)
+    assert ok is True, message
+    method, url, body = sent[0]
+    assert (method, url) == ("POST", "https://mail.test/api/v1/add/alias")
+    assert body == {"address": "svc@example.com", "goto": "me@example.com",
+                    "active": 1, "sogo_visible": 1}
+
+
+MULTI_CONFIG = dict(TEST_CONFIG, mailcow_instances={
+    "eu": {"url": "https://eu.mail.test", "api_key": "EU_KEY", "pool_size": 4,
+           "domains": ["example2.com", "*.eu.example.com"]},
+})
+
+
+def test_mailcow_router_routes_by_domain():
+    router = app_module.mailcow_router(MULTI_CONFIG)
+    assert router.route("example2.com") == "eu"
+    assert router.route("a.eu.example.com") == "eu"
+    assert router.route("example.com") == "default"
+    assert app_module.mailcow_router(MULTI_CONFIG) is router
+
+
+def test_mailcow_instances_have_their_own_pool():
+    default = app_module.get_mailcow_client(MULTI_CONFIG)
+    eu = app_module.mailcow_client_for("svc@example2.com", MULTI_CONFIG)
+    assert eu is not default
+    assert eu.session.headers["X-API-Key"] == "EU_KEY"
+    assert eu.session.get_adapter("https://eu.mail.test/")._pool_maxsize == 4
+    assert eu.timeout == 10  # inherited from the top-level default
+    assert app_module.mailcow_client_for("svc@example.com", MULTI_CONFIG) is default
+
+
+def test_create_alias_routes_to_instance(client, monkeypatch):
+    fakes = {"default": FakeMailcow(), "eu": FakeMailcow()}
+    monkeypatch.setattr(app_module, "load_config", lambda: MULTI_CONFIG)
+    monkeypatch.setattr(app_module, "get_mailcow_client", lambda config, instance="default": fakes[instance])
+    r = client.post("/api/create-alias", json={"alias": "svc1@example2.com", "redirectTo": "me@example.com"})
+    assert r.status_code == 200
+    assert "add_alias" in fakes["eu"].calls
+    assert "add_alias" not in fakes["default"].calls
+    # The alias index is built from every instance.
+    assert fakes["default"].calls.count("get_aliases") == 1
+
+
+def test_status_probes_every_instance(client, monkeypatch):
+    fakes = {"default": FakeMailcow(), "eu": FakeMailcow()}
+    fakes["eu"].get_version = lambda timeout=None: FakeResponse(status_code=503)
+    monkeypatch.setattr(app_module, "load_config", lambda: MULTI_CONFIG)
+    monkeypatch.setattr(app_module, "get_mailcow_client", lambda config, instance="default": fakes[instance])
+    r = client.get("/api/status")
+    assert r.status_code == 500
+    data = r.get_json()
+    assert data["message"] == "eu: Mailcow connection error: 503"
+    assert data["instances"]["default"]["ok"] is True
+    assert data["instances"]["eu"]["ok"] is False
+
+
+def test_invalid_mailcow_instance_rejects_config(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(dict(TEST_CONFIG, mailcow_instances={"eu": {"url": "https://eu.mail.test"}})))
+    assert app_module._read_config(str(path)) is None
+
+
+# --- domain validation ------------------------------------------------------
+
+def test_parse_email():
+    assert app_module.parse_email(" Svc.1+x@Example.COM ") == ("svc.1+x", "example.com")
+    assert app_module.parse_email("svc@bücher.example") == ("svc", "xn--bcher-kva.example")
+    for bad in ("no-at-sign", "@example.com", "a..b@example.com", "a@localhost", "a@-bad-.com", "a b@x.com"):
+        assert app_module.parse_email(bad) is None, bad
+
+
+def test_domain_validator_exact_and_wildcard():
+    validator = app_module.DomainValidator(["example.com", "*.corp.example", "bücher.example"])
+    assert validator.allows("example.com")
+    assert not validator.allows("sub.example.com")
+    assert validator.allows("team.corp.example")
+    assert validator.allows("a.b.corp.example")
+    assert not validator.allows("corp.example")  # the wildcard only covers subdomains
+    assert validator.allows("xn--bcher-kva.example")
+    assert validator.listing == ["example.com", "bücher.example"]
+
+
+def test_domain_validator_per_user():
+    validator = app_module.DomainValidator(
+        ["example.com", "example2.com"], {"alice": ["example2.com"]})
+    assert validator.allows("example.com", "bob")
+    assert not validator.allows("example.com", "alice")
+    assert validator.allows("example2.com", "alice")
+    assert validator.allowed_list("alice") == ["example2.com"]
+
+
+def test_domain_validator_user_listing_only_usable_domains():
+    validator = app_module.DomainValidator(
+        ["example.com", "*.corp.example"], {"alice": ["*.corp.example", "other.org", "example.com"]})
+    # Wildcards cannot be picked, and other.org is not allowed globally.
+    assert validator.allowed_list("alice") == ["example.com"]
+    assert not validator.allows("other.org", "alice")
+
+
+def test_public_config_default_domain_falls_back_to_user_domain():
+    users = dict(TEST_CONFIG["users"], alice=dict(TEST_CONFIG["users"]["alice"], domains=["example2.com"]))
+    config = dict(TEST_CONFIG, users=users)
+    assert app_module._public_config(config, "alice")["default_domain"] == "example2.com"
+    assert app_module._public_config(config, None)["default_domain"] == "example.com"
+
+
+def test_generated_alias_without_domain_uses_user_domain(client, monkeypatch):
+    users = dict(TEST_CONFIG["users"], alice=dict(TEST_CONFIG["users"]["alice"], domains=["example2.com"]))
+    monkeypatch.setattr(app_module, "load_config", lambda: dict(TEST_CONFIG, users=users))
+    r = client.post("/api/generate-alias", json={"service": "shop"})
+    assert r.status_code == 200 and r.get_json()["alias"].endswith("@example2.com")
+    r = client.post("/api/create-aliases", json={"aliases": [{"service": "shop", "redirectTo": "me@example.com"}]})
+    assert r.status_code == 200, r.get_json()
+    assert r.get_json()["results"][0]["alias"].endswith("@example2.com")
+
+
+def test_domain_validator_is_built_once_per_snapshot(monkeypatch):
+    builds = []
+    real = app_module.DomainValidator.from_config
+    monkeypatch.setattr(app_module.DomainValidator, "from_config",
+                        classmethod(lambda cls, config: builds.append(1) or real(config)))
+    config = dict(TEST_CONFIG)
+    for _ in range(3):
+        app_module.domain_validator(config)
+    assert len(builds) == 1
+    app_module.domain_validator(dict(TEST_CONFIG))  # a new snapshot
+    assert len(builds) == 2
+
+
+def test_create_alias_per_user_domains(client, monkeypatch):
+    users = dict(TEST_CONFIG["users"], alice=dict(TEST_CONFIG["users"]["alice"], domains=["example2.com"]))
+    monkeypatch.setattr(app_module, "load_config", lambda: dict(TEST_CONFIG, users=users))
+    r = client.post("/api/create-alias",
+                    json={"alias": "x@example.com", "redirectTo": "me@example.com"})
+    assert r.status_code == 400
+    assert r.get_json()["error"] == "Alias must use one of the allowed domains: example2.com"
+    r = client.post("/api/create-alias",
+                    json={"alias": "x@example2.com", "redirectTo": "me@example.com"})
+    assert r.status_code == 200
+
+
+# --- /api/create-aliases ----------------------------------------------------
+
+def test_create_aliases_bulk(client, mailcow):
+    items = [{"alias": f"svc{i}@example.com", "redirectTo": "me@example.com"} for i in range(5)]
+    items.append({"alias": "taken1234@example.com", "redirectTo": "me@example.com"})
+    r = client.post("/api/create-aliases", json={"aliases": items})
+    assert r.status_code == 200
+    body = r.get_json()
+    assert (body["created"], body["failed"]) == (5, 1)
+    assert [result["index"] for result in body["results"]] == list(range(6))
+    assert body["results"][5]["error"] == "This alias already exists"
+    assert mailcow.calls.count("add_alias") == 5
+
+
+def test_create_aliases_validates_everything_first(client, mailcow):
+    items = [
+        {"alias": "ok@example.com", "redirectTo": "me@example.com"},
+        {"alias": "bad@notallowed.com", "redirectTo": "me@example.com"},
+        {"alias": "OK@example.com", "redirectTo": "me@example.com"},
+    ]
+    r = client.post("/api/create-aliases", json={"aliases": items})
+    assert r.status_code == 400
+    assert [e["index"] for e in r.get_json()["results"]] == [1, 2]
+    assert "add_alias" not in mailcow.calls
+
+
+def test_create_aliases_limit(client, monkeypatch):
+    monkeypatch.setattr(app_module, "load_config", lambda: dict(TEST_CONFIG, bulk_max_items=2))
+    items = [{"alias": f"s{i}@example.com", "redirectTo": "me@example.com"} for i in range(3)]
+    assert client.post("/api/create-aliases", json={"aliases": items}).status_code == 400
+
+
+def test_create_aliases_streams_ndjson(client):
+    items = [{"alias": f"stream{i}@example.com", "redirectTo": "me@example.com"} for i in range(3)]
+    r = client.post("/api/create-aliases?stream=1", json={"aliases": items})
+    assert r.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
+    assert all(line["success"] for line in lines)
+
+
+# --- audit log --------------------------------------------------------------
+
+def read_log_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_audit_log_buffers_until_flush(monkeypatch, audit_log):
+    monkeypatch.setattr(app_module, "load_config",
+                        lambda: dict(TEST_CONFIG, audit_log_flush_interval=60))
+    for i in range(3):
+        audit_log.write({"alias": f"a{i}@example.com"})
+    assert not os.path.exists(audit_log.path)
+    audit_log.flush()
+    assert [e["alias"] for e in read_log_lines(audit_log.path)] == [
+        "a0@example.com", "a1@example.com", "a2@example.com"]
+
+
+def test_audit_log_rotates_and_compresses(monkeypatch, audit_log):
+    monkeypatch.setattr(app_module, "load_config", lambda: dict(
+        TEST_CONFIG, audit_log_flush_interval=60, audit_log_max_bytes=200, audit_log_backups=2))
+    for i in range(5):
+        audit_log.write({"alias": f"alias-number-{i}@example.com", "pad": "x" * 100})
+        audit_log.flush()
+
+    directory = os.path.dirname(audit_log.path)
+    backups = sorted(f for f in os.listdir(directory) if f.endswith(".json.gz"))
+    assert len(backups) == 2
+    with gzip.open(os.path.join(directory, backups[-1]), "rt", encoding="utf-8") as f:
+        assert json.loads(f.readline())["alias"] == "alias-number-3@example.com"
+    assert read_log_lines(audit_log.path)[0]["alias"] == "alias-number-4@example.com"
+
+
+def test_create_alias_is_audited(client, audit_log):
+    r = client.post("/api/create-alias",
+                    json={"alias": "logged@example.com", "redirectTo": "me@example.com"})
+    assert r.status_code == 200
+    audit_log.flush()
+    entry = read_log_lines(audit_log.path)[-1]
+    assert (entry["alias"], entry["status"]) == ("logged@example.com", "success")
+
+
+# --- alias history ----------------------------------------------------------
+
+def test_alias_history_keyset_pagination(alias_history):
+    for i in range(5):
+        alias_history.add(f"a{i}@example.com", "me@example.com", user_id="alice")
+    alias_history.add("b@example.com", "other@example.com", user_id="bob")
+
+    page, cursor = alias_history.query(limit=2, user="alice")
+    assert [r["alias"] for r in page] == ["a4@example.com", "a3@example.com"]
+    page, cursor = alias_history.query(limit=2, cursor=cursor, user="alice")
+    assert [r["alias"] for r in page] == ["a2@example.com", "a1@example.com"]
+    page, cursor = alias_history.query(limit=2, cursor=cursor, user="alice")
+    assert [r["alias"] for r in page] == ["a0@example.com"] and cursor is None
+
+    rows, _ = alias_history.query(redirect="other@example.com")
+    assert [r["user_id"] for r in rows] == ["bob"]
+
+
+def test_alias_history_import_is_idempotent(alias_history):
+    lines = [
+        json.dumps({"timestamp": "2025-01-01T10:00:00", "alias": "old1@example.com",
+                    "redirect_to": "me@example.com", "status": "success"}),
+        "not json",
+        json.dumps({"timestamp": "2025-01-02T10:00:00", "alias": "old2@example.com",
+                    "redirect_to": "me@example.com", "status": "success"}),
+    ]
+    assert alias_history.import_log(lines) == 2
+    assert alias_history.import_log(lines) == 0
+    rows, _ = alias_history.query(alias="old1@example.com")
+    assert rows[0]["created_at"] == "2025-01-01T10:00:00"
+
+
+def test_create_alias_records_history(client):
+    body = {"alias": "hist@example.com", "redirectTo": "me@example.com"}
+    assert client.post("/api/create-alias", json=body).status_code == 200
+
+    data = client.get("/api/aliases").get_json()
+    assert [r["alias"] for r in data["aliases"]] == ["hist@example.com"]
+    assert data["next_cursor"] is None
+    assert client.get("/api/aliases?cursor=abc").status_code == 400
+
+
+# --- alias lifecycle --------------------------------------------------------
+
+def create(client, alias, **extra):
+    r = client.post("/api/create-alias", json=dict(alias=alias, redirectTo="me@example.com", **extra))
+    assert r.status_code == 200, r.get_json()
+    return app_module.alias_history.query(alias=alias)[0][0]
+
+
+def test_create_alias_with_ttl(client):
+    row = create(client, "temp1@example.com", ttl=3600)
+    expires_at = app_module.datetime.fromisoformat(row["expires_at"])
+    assert 3590 < (expires_at - app_module.datetime.now()).total_seconds() <= 3600
+    assert create(client, "kept1@example.com")["expires_at"] is None
+
+    r = client.post("/api/create-alias", json={"alias": "temp2@example.com", "redirectTo": "me@example.com",
+                                               "ttl": 10})
+    assert r.status_code == 400
+    assert "ttl" in r.get_json()["error"]
+
+
+def test_toggle_alias_active(client, mailcow):
+    app_module.alias_index.refresh(TEST_CONFIG)
+    row = create(client, "toggle1@example.com")
+    r = client.patch(f"/api/aliases/{row['id']}", json={"active": False})
+    assert r.status_code == 200
+    assert r.get_json()["alias"]["active"] == 0
+    # The alias was created after the index was loaded: its id is looked up
+    # on its own, without downloading the whole list again.
+    alias_id = next(a["id"] for a in mailcow.aliases if a["address"] == "toggle1@example.com")
+    assert ("edit_aliases", [alias_id], {"active": "0"}) in mailcow.calls
+    assert app_module.alias_history.get(row["id"])["active"] == 0
+    assert client.patch(f"/api/aliases/{row['id']}", json={"active": True}).status_code == 200
+    assert mailcow.calls.count(("get_alias", "toggle1@example.com")) == 1
+    assert mailcow.calls.count("get_aliases") == 1
+
+    assert client.patch(f"/api/aliases/{row['id']}", json={"active": "no"}).status_code == 400
+
+
+def test_aliases_are_private_to_their_owner(client):
+    row = create(client, "mine1@example.com")
+    token = app_module.issue_session_token("bob", TEST_CONFIG)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.patch(f"/api/aliases/{row['id']}", json={"active": False}, headers=headers).status_code == 404
+    assert client.delete(f"/api/aliases/{row['id']}", headers=headers).status_code == 404
+
+
+def test_delete_alias(client, mailcow):
+    row = create(client, "gone1@example.com")
+    assert client.delete(f"/api/aliases/{row['id']}").status_code == 200
+    assert all(a["address"] != "gone1@example.com" for a in mailcow.aliases)
+    assert app_module.alias_history.get(row["id"])["deleted_at"]
+    assert client.delete(f"/api/aliases/{row['id']}").status_code == 404
+
+    listed = client.get("/api/aliases?current=1").get_json()["aliases"]
+    assert "gone1@example.com" not in [a["alias"] for a in listed]
+    # Deleted aliases can be created again.
+    assert client.post("/api/create-alias", json={"alias": "gone1@example.com",
+                                                  "redirectTo": "me@example.com"}).status_code == 200
+
+
+def test_manage_alias_while_index_loading(client, mailcow):
+    row = create(client, "wait1@example.com")
+    app_module.alias_index._loaded_at = None
+    app_module.alias_index._refreshing = True  # another thread is downloading
+    r = client.delete(f"/api/aliases/{row['id']}")
+    assert r.status_code == 503
+    assert r.get_json()["error"] == app_module.ALIAS_INDEX_LOADING
+
+
+def test_alias_id_lookup_forgets_vanished_alias(mailcow):
+    app_module.alias_index.refresh(TEST_CONFIG)
+    app_module.alias_index.add("ghost1@example.com")  # created, then removed outside the app
+    assert app_module.alias_index.alias_id("ghost1@example.com", TEST_CONFIG) is None
+    assert app_module.alias_index.contains("ghost1@example.com", TEST_CONFIG) is False
+
+
+def test_reaper_deletes_expired_aliases_in_one_call(mailcow, alias_history):
+    past = (app_module.datetime.now() - app_module.timedelta(minutes=1)).isoformat()
+    future = (app_module.datetime.now() + app_module.timedelta(hours=1)).isoformat()
+    for address in ("old1@example.com", "old2@example.com", "later@example.com"):
+        mailcow.add_alias(address, "me@example.com")
+    alias_history.add("old1@example.com", "me@example.com", user_id="alice", expires_at=past)
+    alias_history.add("old2@example.com", "me@example.com", user_id="alice", expires_at=past)
+    alias_history.add("later@example.com", "me@example.com", user_id="alice", expires_at=future)
+    # Expired, but deleted outside the app in the meantime.
+    alias_history.add("vanished@example.com", "me@example.com", user_id="alice", expires_at=past)
+    mailcow.calls.clear()
+
+    assert app_module.reap_expired_aliases(TEST_CONFIG) == 3
+    deletes = [call for call in mailcow.calls if call[0] == "delete_aliases"]
+    assert len(deletes) == 1 and len(deletes[0][1]) == 2
+    assert [a["address"] for a in mailcow.aliases] == ["taken1234@example.com", "later@example.com"]
+    assert app_module.reap_expired_aliases(TEST_CONFIG) == 0
+
+
+def test_reaper_isolates_failing_deletions(mailcow, alias_history, monkeypatch):
+    past = (app_module.datetime.now() - app_module.timedelta(minutes=1)).isoformat()
+    for address in ("old1@example.com", "old2@example.com"):
+        mailcow.add_alias(address, "me@example.com")
+        alias_history.add(address, "me@example.com", user_id="alice", expires_at=past)
+    app_module.alias_index.refresh(TEST_CONFIG)
+    # old2 was removed in Mailcow after the index was loaded: its stale id fails.
+    mailcow.aliases = [a for a in mailcow.aliases if a["address"] != "old2@example.com"]
+
+    assert app_module.reap_expired_aliases(TEST_CONFIG) == 1
+    rows = {row["alias"]: row for row in alias_history.query()[0]}
+    assert rows["old1@example.com"]["deleted_at"]
+    assert rows["old2@example.com"]["deleted_at"] is None
+
+
+def test_reaper_skips_recreated_alias(mailcow, alias_history):
+    past = (app_module.datetime.now() - app_module.timedelta(minutes=1)).isoformat()
+    mailcow.add_alias("again@example.com", "me@example.com")
+    alias_history.add("again@example.com", "me@example.com", created_at="2026-01-01T00:00:00", expires_at=past)
+    alias_history.add("again@example.com", "me@example.com", created_at="2026-02-01T00:00:00")
+    assert app_module.reap_expired_aliases(TEST_CONFIG) == 0
+    assert any(a["address"] == "again@example.com" for a in mailcow.aliases)
+
+
+def test_alias_history_upgrades_old_database(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    conn = app_module.sqlite3.connect(path)
+    conn.executescript(app_module.AliasHistory.SCHEMA)  # layout before the lifecycle columns
+    conn.execute("INSERT INTO aliases (created_at, alias, redirect_to) "
+                 "VALUES ('2026-01-01', 'x@example.com', 'me@example.com')")
+    conn.commit()
+    conn.close()
+
+    history = app_module.AliasHistory(str(path))
+    row = history.query()[0][0]
+    assert (row["active"], row["expires_at"], row["deleted_at"]) == (1, None, None)
+
+
+# --- alias generation -------------------------------------------------------
+
+def test_generate_alias_endpoint(client):
+    r = client.post("/api/generate-alias", json={"service": "Git-Hub!", "domain": "example2.com"})
+    assert r.status_code == 200
+    alias = r.get_json()["alias"]
+    local, _, domain = alias.partition("@")
+    assert domain == "example2.com"
+    assert local.startswith("github") and local[6:].isdigit() and len(local) == 10
+
+
+def test_generate_alias_skips_taken_and_reserved(client, monkeypatch, mailcow):
+    # A one-letter alphabet leaves exactly one candidate per service name.
+    cfg = dict(TEST_CONFIG, alias_suffix_alphabet="1")
+    monkeypatch.setattr(app_module, "load_config", lambda: cfg)
+    mailcow.aliases.append({"id": 99, "address": "taken1111@example.com"})
+
+    assert client.post("/api/generate-alias", json={"service": "taken"}).status_code == 400
+
+    first = client.post("/api/generate-alias", json={"service": "svc"})
+    assert first.get_json()["alias"] == "svc1111@example.com"
+    # Reserved for the first caller, so a second request cannot get it.
+    assert client.post("/api/generate-alias", json={"service": "svc"}).status_code == 400
+
+
+def test_generate_alias_rejects_unknown_domain(client):
+    r = client.post("/api/generate-alias", json={"service": "svc", "domain": "evil.com"})
+    assert r.status_code == 400
+
+
+def test_create_alias_generates_when_asked(client, mailcow):
+    r = client.post("/api/create-alias",
+                    json={"service": "netflix", "domain": "example.com", "redirectTo": "me@example.com"})
+    assert r.status_code == 200
+    alias = r.get_json()["alias"]
+    assert alias.startswith("netflix") and alias.endswith("@example.com")
+    assert app_module.alias_index.contains(alias, TEST_CONFIG) is True
+
+
+# --- alias index ------------------------------------------------------------
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_alias_index_single_download(mailcow):
+    index = app_module.AliasIndex()
+    assert index.contains("TAKEN1234@example.com", TEST_CONFIG) is True
+    assert index.contains("free@example.com", TEST_CONFIG) is False
+    assert index.contains("taken1234@example2.com", TEST_CONFIG) is False
+    assert mailcow.calls == ["get_aliases"]
+
+
+def test_alias_index_unavailable(monkeypatch):
+    class Down(FakeMailcow):
+        def get_aliases(self):
+            raise app_module.requests.exceptions.ConnectionError("down")
+
+    monkeypatch.setattr(app_module, "get_mailcow_client", lambda config, instance=None: Down())
+    index = app_module.AliasIndex()
+    assert index.contains("x@example.com", TEST_CONFIG) is None
+
+
+def test_alias_index_refresh_keeps_concurrent_writes(mailcow):
+    clock = FakeClock()
+    index = app_module.AliasIndex(clock=clock)
+    index.refresh(TEST_CONFIG)
+
+    # Created by this app while a refresh is in flight: the download started
+    # before Mailcow knew about it, so it must survive the swap.
+    real_get = mailcow.get_aliases
+
+    def slow_get():
+        response = real_get()
+        clock.now += 1
+        index.add("fresh@example.com")
+        return response
+
+    mailcow.get_aliases = slow_get
+    index.refresh(TEST_CONFIG)
+    assert index.contains("fresh@example.com", TEST_CONFIG) is True
+    assert index.contains("taken1234@example.com", TEST_CONFIG) is True
+
+
+def test_iter_aliases_across_chunk_boundaries():
+    payload = [{"id": i, "address": f"Ünï{i}@Example.com", "goto": "me@example.com", "active": i % 2,
+                "public_comment": "x" * i} for i in range(50)]
+    payload.insert(3, {"id": 999, "goto": "no-address@example.com"})
+    for chunk_size in (1, 7, 64, 1 << 16):
+        response = FakeResponse(payload=payload)
+        response.text = json.dumps(payload, ensure_ascii=False)  # multi-byte characters split across chunks
+        records = list(app_module.iter_aliases(response, chunk_size=chunk_size))
+        assert [r.address for r in records] == [f"ünï{i}@example.com" for i in range(50)]
+        assert [r.id for r in records][:2] == [0, 1]
+        assert [r.active for r in records][:2] == [False, True]
+
+
+def test_iter_aliases_wrapped_and_malformed_bodies():
+    wrapped = FakeResponse(payload={"data": [{"id": 1, "address": "a@example.com"}]})
+    assert [r.address for r in app_module.iter_aliases(wrapped, chunk_size=4)] == ["a@example.com"]
+    assert list(app_module.iter_aliases(FakeResponse(payload={}))) == []
+    assert list(app_module.iter_aliases(FakeResponse(payload=[]))) == []
+
+    truncated = FakeResponse(payload=[{"id": 1, "address": "a@example.com"}])
+    truncated.text = truncated.text[:-1]
+    with pytest.raises(ValueError):
+        list(app_module.iter_aliases(truncated, chunk_size=8))
+
+
+def test_create_alias_conflict_from_index(client, mailcow):
+    r = client.post("/api/create-alias",
+                    json={"alias": "taken1234@example.com", "redirectTo": "me@example.com"})
+    assert r.status_code == 409
+    assert "add_alias" not in mailcow.calls
+
+
+def test_create_alias_writes_through_to_index(client, mailcow):
+    body = {"alias": "new5678@example.com", "redirectTo": "me@example.com"}
+    assert client.post("/api/create-alias", json=body).status_code == 200
+    assert client.post("/api/create-alias", json=body).status_code == 409
+    assert mailcow.calls.count("get_aliases") == 1
+
+
+# --- health checks ----------------------------------------------------------
+
+def test_status_serves_cached_probe(client, mailcow):
+    for _ in range(3):
+        r = client.get("/api/status")
+        assert r.status_code == 200
+        assert r.get_json()["connection"] == "success"
+    assert mailcow.calls == ["get_version"]
+
+
+def test_status_reports_probe_failure(client, mailcow):
+    mailcow.get_version = lambda timeout=None: FakeResponse(status_code=401)
+    r = client.get("/api/status")
+    assert r.status_code == 500
+    assert r.get_json()["message"] == "Mailcow connection error: 401"
+
+
+def test_healthz_never_calls_mailcow(client, mailcow):
+    assert client.get("/healthz").get_json() == {"status": "ok"}
+    assert mailcow.calls == []
+
+
+def test_readyz_reports_probe_details(client, mailcow):
+    data = client.get("/readyz").get_json()
+    assert data["status"] == "ok"
+    assert {"checked_at", "age_seconds", "latency_ms"} <= set(data)
+
+    mailcow.get_version = lambda timeout=None: FakeResponse(status_code=500)
+    app_module.health_monitor.probe(TEST_CONFIG)
+    assert client.get("/readyz").status_code == 503
+
+
 # --- verify_altcha_solution provider dispatch -------------------------------
 
 def test_verify_altcha_dispatches_to_gatecha(monkeypatch):
@@ -139,6 +1189,90 @@ def test_verify_altcha_dispatches_to_gatecha(monkeypatch):
     assert ok is True and called["p"] == "PAYLOAD"
 
 
+# --- GateCHA provider -------------------------------------------------------
+
+GATECHA_CONFIG = {"altcha_provider": "gatecha", "gatecha_url": "https://gate.test/",
+                  "gatecha_api_key": "gk_abc"}
+
+
+class FakeGatecha:
+    def __init__(self, ok=True, error=None, status_code=200):
+        self.ok, self.error, self.status_code = ok, error, status_code
+        self.calls = 0
+
+    def verify(self, payload):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return FakeResponse(status_code=self.status_code, payload={"ok": self.ok})
+
+
+@pytest.fixture
+def gatecha(monkeypatch):
+    fake = FakeGatecha()
+    monkeypatch.setattr(app_module, "get_gatecha_client", lambda config: fake)
+    monkeypatch.setattr(app_module, "gatecha_breaker", app_module.CircuitBreaker())
+    return fake
+
+
+def test_gatecha_client_reuses_session():
+    client = app_module.get_gatecha_client(GATECHA_CONFIG)
+    assert app_module.get_gatecha_client(GATECHA_CONFIG) is client
+    assert client.verify_url == "https://gate.test/api/v1/verify"
+    assert client.session.params == {"apiKey": "gk_abc"}
+
+
+def test_gatecha_verdicts_cached(gatecha):
+    assert app_module.verify_altcha_via_gatecha("P1", GATECHA_CONFIG) == (True, "Valid solution")
+    assert app_module.verify_altcha_via_gatecha("P1", GATECHA_CONFIG) == (True, "Valid solution")
+    gatecha.ok = False
+    assert app_module.verify_altcha_via_gatecha("P2", GATECHA_CONFIG) == (False, "Invalid solution")
+    assert app_module.verify_altcha_via_gatecha("P2", GATECHA_CONFIG) == (False, "Invalid solution")
+    assert gatecha.calls == 2
+
+
+def test_gatecha_circuit_breaker_fails_fast(gatecha):
+    import requests
+
+    gatecha.error = requests.exceptions.ConnectTimeout("down")
+    config = dict(GATECHA_CONFIG, gatecha_breaker_threshold=3)
+    for n in range(5):
+        ok, message = app_module.verify_altcha_via_gatecha(f"P{n}", config)
+        assert (ok, message) == (False, "GateCHA verification error")
+    assert gatecha.calls == 3 and app_module.gatecha_breaker.state == "open"
+    # fail-open accepts while GateCHA is unreachable.
+    ok, _ = app_module.verify_altcha_via_gatecha("P9", dict(config, gatecha_fail_open=True))
+    assert ok is True and gatecha.calls == 3
+
+
+def test_gatecha_server_errors_count_as_failures(gatecha):
+    gatecha.status_code = 503
+    config = dict(GATECHA_CONFIG, gatecha_breaker_threshold=1)
+    assert app_module.verify_altcha_via_gatecha("P1", config)[0] is False
+    assert app_module.gatecha_breaker.state == "open"
+    # Not cached: the same payload is retried once GateCHA is back.
+    assert app_module.state_backend.get(
+        "gatecha-verdict:" + app_module.hashlib.sha256(b"P1").hexdigest()) is None
+
+
+def test_circuit_breaker_half_open():
+    clock = FakeClock()
+    breaker = app_module.CircuitBreaker(clock=clock)
+    breaker.failure(threshold=2)
+    assert breaker.allow(30) and breaker.state == "closed"
+    breaker.failure(threshold=2)
+    assert not breaker.allow(30)
+    clock.now += 30
+    assert breaker.allow(30) and breaker.state == "half-open"
+    assert not breaker.allow(30)  # one trial at a time
+    breaker.failure(threshold=2)
+    assert breaker.state == "open" and not breaker.allow(30)
+    clock.now += 30
+    assert breaker.allow(30)
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow(30)
+
+
 # --- local ALTCHA provider --------------------------------------------------
 # These exercise the real altcha library rather than a mock: the widget speaks
 # the v1 protocol, so a library upgrade that changes the v1 wire format or the
@@ -147,11 +1281,11 @@ def test_verify_altcha_dispatches_to_gatecha(monkeypatch):
 LOCAL_CONFIG = {"altcha_provider": "local", "altcha_hmac_key": "k" * 32}
 
 
-def solve(challenge):
+def solve(challenge, max_number=None):
     """Solve a challenge the way the browser widget does, returning the payload."""
     solution = solve_challenge_v1(
         challenge.challenge, challenge.salt, challenge.algorithm,
-        app_module.ALTCHA_MAX_NUMBER, 0,
+        max_number or app_module.ALTCHA_MAX_NUMBER, 0,
     )
     assert solution is not None, "challenge was not solvable within max_number"
     return {
@@ -206,6 +1340,78 @@ def test_verify_altcha_rejects_garbage_payload():
     assert ok is False
 
 
+def test_challenge_pool_serves_presigned_challenges(challenge_pool):
+    config = dict(LOCAL_CONFIG, altcha_pool_size=8, altcha_pool_low_watermark=2)
+    first, _ = app_module.create_altcha_challenge(config)  # empty pool: signed inline
+    challenge_pool.refill()
+    pool = next(iter(challenge_pool._pools.values()))
+    assert len(pool) == 8
+
+    served = [app_module.create_altcha_challenge(config)[0] for _ in range(6)]
+    assert len(pool) == 2 and len({c.challenge for c in served + [first]}) == 7
+    # Below the watermark: the next refill tops the pool up again.
+    app_module.create_altcha_challenge(config)
+    challenge_pool.refill()
+    assert len(pool) == 8
+    ok, message = app_module.verify_altcha_solution(encode(solve(served[0])), config)
+    assert ok is True, message
+
+
+def test_challenge_pool_discards_old_challenges():
+    clock = FakeClock()
+    pool = app_module.ChallengePool(background=False, clock=clock)
+    pool.get("k" * 32, 1000, 400, 4, 1)
+    pool.refill()
+    clock.now += 101  # over a quarter of the 400s TTL
+    pool.get("k" * 32, 1000, 400, 4, 1)
+    assert len(pool._pools[("k" * 32, 1000, 400)]) == 0
+
+
+def test_challenge_pool_disabled(challenge_pool):
+    app_module.create_altcha_challenge(dict(LOCAL_CONFIG, altcha_pool_size=0))
+    assert not challenge_pool._pools
+
+
+def test_verify_altcha_rejects_replayed_solution(state_backend):
+    challenge, _ = app_module.create_altcha_challenge(LOCAL_CONFIG)
+    payload = encode(solve(challenge))
+    assert app_module.verify_altcha_solution(payload, LOCAL_CONFIG)[0] is True
+    assert app_module.verify_altcha_solution(payload, LOCAL_CONFIG) == (False, "Challenge already used")
+    # Remembered until the challenge itself expires.
+    expiry = state_backend.expiry(f"altcha-used:{challenge.challenge}")
+    assert abs(expiry - (app_module.time.time() + app_module.ALTCHA_CHALLENGE_TTL)) < 5
+
+
+def test_verify_altcha_concurrent_replay_loses_claim(state_backend):
+    challenge, _ = app_module.create_altcha_challenge(LOCAL_CONFIG)
+    payload = encode(solve(challenge))
+    # Another worker claims the challenge between our lookup and our claim.
+    state_backend.add(f"altcha-used:{challenge.challenge}", 1, 60)
+    state_backend.get = lambda key, default=None: default
+    assert app_module.verify_altcha_solution(payload, LOCAL_CONFIG) == (False, "Challenge already used")
+
+
+def test_failed_altcha_does_not_consume_challenge(state_backend):
+    challenge, _ = app_module.create_altcha_challenge(LOCAL_CONFIG)
+    payload = solve(challenge)
+    payload["number"] += 1
+    assert app_module.verify_altcha_solution(encode(payload), LOCAL_CONFIG)[0] is False
+    payload["number"] -= 1
+    assert app_module.verify_altcha_solution(encode(payload), LOCAL_CONFIG)[0] is True
+
+
+
+def test_verify_altcha_refused_when_replay_store_full(monkeypatch):
+    state = app_module.MemoryStateBackend(max_entries=2, pinned_prefixes=("altcha-used:",), max_pinned=1)
+    monkeypatch.setattr(app_module, "state_backend", state)
+    first, second = (encode(solve(app_module.create_altcha_challenge(LOCAL_CONFIG)[0])) for _ in range(2))
+    assert app_module.verify_altcha_solution(first, LOCAL_CONFIG)[0] is True
+    for n in range(5):  # other traffic does not push the marker out
+        state.set(f"other{n}", 1, 60)
+    assert app_module.verify_altcha_solution(second, LOCAL_CONFIG) == (
+        False, "Too many verifications, please try again later")
+    assert app_module.verify_altcha_solution(first, LOCAL_CONFIG) == (False, "Challenge already used")
+
 # --- /api/altcha/challenge --------------------------------------------------
 
 def test_altcha_challenge_endpoint_serves_solvable_challenge(client, monkeypatch):
@@ -213,7 +1419,8 @@ def test_altcha_challenge_endpoint_serves_solvable_challenge(client, monkeypatch
     monkeypatch.setattr(app_module, "load_config", lambda: cfg)
 
     data = client.get("/api/altcha/challenge").get_json()
-    assert set(data) == {"algorithm", "challenge", "salt", "signature"}
+    assert set(data) == {"algorithm", "challenge", "maxnumber", "salt", "signature"}
+    assert data["maxnumber"] == app_module.ALTCHA_MAX_NUMBER
 
     # What the endpoint serves must round-trip through the verifier.
     served = SimpleNamespace(**data)
@@ -221,6 +1428,42 @@ def test_altcha_challenge_endpoint_serves_solvable_challenge(client, monkeypatch
     assert ok is True, message
 
 
+def test_altcha_difficulty_rises_with_failed_logins(client, monkeypatch):
+    cfg = dict(TEST_CONFIG, altcha_enabled=True)
+    monkeypatch.setattr(app_module, "load_config", lambda: cfg)
+    base = app_module.ALTCHA_MAX_NUMBER
+
+    for _ in range(5):
+        assert client.post("/api/auth", json={"password": "nope", "altcha": "bad"}).status_code == 400
+    assert client.get("/api/altcha/challenge").get_json()["maxnumber"] == base * 2
+    # Other subnets only see the global count, still below its threshold.
+    assert app_module.altcha_max_number("198.51.100.7", cfg) == base
+
+    for _ in range(15):
+        app_module.record_auth_failure("127.0.0.1", cfg)
+    # 20 failures: 4x the per-IP threshold, so 2**4.
+    assert app_module.altcha_max_number("127.0.0.1", cfg) == base * 16
+    assert app_module.altcha_max_number("127.0.0.200", cfg) == base * 2  # subnet threshold
+    assert app_module.altcha_max_number("127.0.0.1", dict(cfg, altcha_max_number_cap=50000)) == 50000
+
+
+def test_auth_failures_slide_out_of_window(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app_module.time, "time", clock)
+    monkeypatch.setattr(app_module, "state_backend", app_module.MemoryStateBackend(clock=clock))
+    cfg = dict(TEST_CONFIG, altcha_failure_window=100)
+    clock.now = 1000.0  # start of a window
+    for _ in range(10):
+        app_module.record_auth_failure("2001:db8::1", cfg)
+    assert app_module.auth_failure_counts("2001:db8::2", cfg) == {"global": 10, "subnet": 10, "ip": 0}
+    clock.now = 1150.0  # halfway through the next window
+    assert app_module.auth_failure_counts("2001:db8::1", cfg)["ip"] == 5
+    clock.now = 1200.0
+    assert app_module.auth_failure_counts("2001:db8::1", cfg)["ip"] == 0
+
+
+
+
 def test_altcha_challenge_endpoint_disabled(client):
     # TEST_CONFIG has altcha_enabled False.
     assert client.get("/api/altcha/challenge").status_code == 400
@@ -246,6 +1489,74 @@ def test_auth_wrong_password(client):
     assert r.status_code == 401
 
 
+def test_auth_with_username(client):
+    r = client.post("/api/auth", json={"username": "alice", "password": "hashed-pass"})
+    assert r.status_code == 200
+    assert r.get_json()["user"]["id"] == "alice"
+    r = client.post("/api/auth", json={"username": "alice", "password": "plain-pass"})
+    assert r.status_code == 401
+
+
+def test_auth_username_required_when_enabled(client, monkeypatch):
+    cfg = dict(TEST_CONFIG, username_login=True)
+    monkeypatch.setattr(app_module, "load_config", lambda: cfg)
+    assert client.get("/api/config").get_json()["username_login"] is True
+    assert client.post("/api/auth", json={"password": "plain-pass"}).status_code == 400
+    r = client.post("/api/auth", json={"username": "bob", "password": "plain-pass"})
+    assert r.status_code == 200
+
+
+
+def test_auth_rejects_non_string_username(client):
+    for username in (["alice"], {"a": 1}, 7):
+        r = client.post("/api/auth", json={"username": username, "password": "plain-pass"})
+        assert r.status_code == 400
+        assert r.get_json()["error"] == "Username must be a string"
+
+# --- session tokens ---------------------------------------------------------
+
+def test_session_token_round_trip():
+    token = app_module.issue_session_token("alice", TEST_CONFIG)
+    assert app_module.verify_session_token(token, TEST_CONFIG) == "alice"
+
+
+def test_session_token_rejections(monkeypatch):
+    token = app_module.issue_session_token("alice", TEST_CONFIG)
+    body, signature = token.split(".")
+    forged = app_module._b64encode(json.dumps({"sub": "bob", "exp": 2**40}).encode())
+    assert app_module.verify_session_token(f"{forged}.{signature}", TEST_CONFIG) is None
+    assert app_module.verify_session_token("garbage", TEST_CONFIG) is None
+    # Another secret, a removed user, an expired token.
+    assert app_module.verify_session_token(token, dict(TEST_CONFIG, session_secret="other")) is None
+    assert app_module.verify_session_token(token, dict(TEST_CONFIG, users={})) is None
+    expired = app_module.issue_session_token("alice", dict(TEST_CONFIG, session_ttl=-1))
+    assert app_module.verify_session_token(expired, TEST_CONFIG) is None
+
+
+def test_auth_issues_usable_token(anon_client):
+    r = anon_client.post("/api/auth", json={"password": "plain-pass"})
+    data = r.get_json()
+    assert data["expires_in"] == 3600
+    headers = {"Authorization": f"Bearer {data['token']}"}
+    assert anon_client.get("/api/config", headers=headers).get_json()["default_redirect"] == "bob@example.com"
+    refreshed = anon_client.post("/api/auth/refresh", headers=headers)
+    assert refreshed.status_code == 200
+    assert app_module.verify_session_token(refreshed.get_json()["token"], TEST_CONFIG) == "bob"
+
+
+def test_protected_endpoints_require_token(anon_client, mailcow):
+    body = {"alias": "svc@example.com", "redirectTo": "me@example.com"}
+    assert anon_client.post("/api/create-alias", json=body).status_code == 401
+    assert anon_client.post("/api/create-aliases", json={"aliases": [body]}).status_code == 401
+    assert anon_client.post("/api/generate-alias", json={"service": "svc"}).status_code == 401
+    assert anon_client.get("/api/aliases").status_code == 401
+    assert anon_client.post("/api/auth/refresh").status_code == 401
+    assert "add_alias" not in mailcow.calls
+    # Public config stays available to the login page, without user defaults.
+    data = anon_client.get("/api/config?user_id=alice").get_json()
+    assert data["default_redirect"] == "user@example.com"
+
+
 # --- rate limiting ----------------------------------------------------------
 
 def test_auth_rate_limited(client):
@@ -260,3 +1571,261 @@ def test_auth_rate_limited(client):
     finally:
         app_module.limiter.enabled = False
         app_module.limiter.reset()
+
+
+def test_create_alias_rate_limited_per_user(anon_client, monkeypatch):
+    config = dict(TEST_CONFIG, rate_limits={"create_alias": "2 per minute"})
+    monkeypatch.setattr(app_module, "load_config", lambda: config)
+
+    def create(user, n):
+        token = app_module.issue_session_token(user, config)
+        return anon_client.post(
+            "/api/create-alias",
+            json={"alias": f"{user}{n}@example.com", "redirectTo": "dest@example.com"},
+            headers={"Authorization": f"Bearer {token}"},
+        ).status_code
+
+    app_module.limiter.enabled = True
+    try:
+        assert [create("alice", n) for n in range(3)] == [200, 200, 429]
+        # Separate bucket per user, and per endpoint.
+        assert create("bob", 0) == 200
+        token = app_module.issue_session_token("alice", config)
+        response = anon_client.post(
+            "/api/generate-alias", json={"service": "svc"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert response.status_code == 200
+    finally:
+        app_module.limiter.enabled = False
+        app_module.limiter.reset()
+
+
+def test_invalid_rate_limit_falls_back_to_default(config_file):
+    config_file.write_text(json.dumps(dict(TEST_CONFIG, rate_limits={"create_alias": "lots"})))
+    config = app_module._read_config(str(config_file))
+    assert "create_alias" not in config["rate_limits"]
+
+
+def test_sqlite_limiter_storage(tmp_path):
+    from limits.storage import storage_from_string
+
+    storage = storage_from_string(f"sqlite:///{tmp_path}/limits.sqlite3")
+    assert isinstance(storage, app_module.SQLiteLimiterStorage)
+    assert storage.incr("k", 60) == 1
+    assert storage.incr("k", 60) == 2
+    assert storage.get("k") == 2 and storage.get("missing") == 0
+    assert storage.get_expiry("k") > 0
+    assert storage.check()
+    storage.clear("k")
+    assert storage.get("k") == 0
+
+
+# --- shared state -----------------------------------------------------------
+
+@pytest.fixture(params=["memory", "sqlite"])
+def state_factory(request, tmp_path):
+    clock = FakeClock()
+    if request.param == "memory":
+        backend = app_module.MemoryStateBackend(clock=clock)
+        return clock, lambda: backend
+    path = str(tmp_path / "state.sqlite3")
+    return clock, lambda: app_module.SQLiteStateBackend(path, clock=clock)
+
+
+def test_state_backend_operations(state_factory):
+    clock, make = state_factory
+    state = make()
+    assert state.get("missing") is None and state.get("missing", 0) == 0
+    state.set("k", {"a": 1}, 10)
+    assert state.get("k") == {"a": 1}
+    assert state.expiry("k") == clock.now + 10
+    assert state.add("k", 2, 10) is False
+    assert state.add("new", 2, 10) is True
+    state.delete("k")
+    assert state.get("k") is None
+    clock.now += 11
+    assert state.get("new") is None
+    assert state.add("new", 3, 10) is True
+
+
+def test_state_backend_counters_expire(state_factory):
+    clock, make = state_factory
+    state = make()
+    assert state.incr("c", 60) == 1
+    assert state.incr("c", 60, amount=2) == 3
+    clock.now += 30
+    # The window is fixed when the counter is created.
+    assert state.incr("c", 60) == 4
+    assert state.expiry("c") == 1060.0
+    clock.now += 31
+    assert state.incr("c", 60) == 1
+
+
+def test_state_backend_shared_between_instances(state_factory):
+    _, make = state_factory
+    first, second = make(), make()  # e.g. two gunicorn workers
+    first.incr("c", 60)
+    second.incr("c", 60)
+    assert first.get("c") == 2
+    assert first.add("lock", 1, 60) and not second.add("lock", 1, 60)
+    second.clear()
+    assert first.get("c") is None
+
+
+def test_memory_state_backend_bounded():
+    clock = FakeClock()
+    state = app_module.MemoryStateBackend(max_entries=4, clock=clock)
+    state.set("expired", 1, 1)
+    for key in "abc":
+        state.set(key, 1, 60)
+    clock.now += 2
+    state.set("d", 1, 60)
+    # Expired entries go first, then the oldest write.
+    assert [state.get(k) for k in ("a", "b", "c", "d")] == [1, 1, 1, 1]
+    state.set("e", 1, 60)
+    assert state.get("a") is None and state.get("e") == 1
+
+
+def test_memory_state_backend_expires_from_heap():
+    clock = FakeClock()
+    state = app_module.MemoryStateBackend(max_entries=3, clock=clock)
+    state.set("a", 1, 1)
+    state.set("a", 2, 60)  # the stale 1s expiry must not drop the rewrite
+    state.set("b", 1, 1)
+    clock.now += 2
+    state.set("c", 1, 60)
+    assert state.get("a") == 2 and state.get("c") == 1
+    assert "b" not in state._data  # purged by the write, not only on read
+    for n in range(3000):
+        state.set("c", n, 60)
+    # Rewrites leave stale heap pairs behind; they are compacted away.
+    assert len(state._expiries) <= 2 * len(state._data) + 1024
+
+
+def test_memory_state_backend_pinned_keys_not_evicted():
+    clock = FakeClock()
+    state = app_module.MemoryStateBackend(max_entries=2, clock=clock, pinned_prefixes=("used:",), max_pinned=2)
+    state.add("used:a", 1, 10)
+    state.add("used:b", 1, 60)
+    for key in "xyz":
+        state.set(key, 1, 60)
+    assert state.get("used:a") == 1 and state.get("used:b") == 1
+    with pytest.raises(app_module.StateStoreFull):
+        state.add("used:c", 1, 60)
+    clock.now += 11  # once a marker expires, there is room again
+    assert state.add("used:c", 1, 60) is True
+    assert state.get("used:a") is None and state.get("used:b") == 1
+
+
+def test_create_state_backend(tmp_path):
+    backend = app_module.create_state_backend("memory://")
+    assert isinstance(backend, app_module.MemoryStateBackend)
+    assert backend.max_pinned == app_module.ALTCHA_VERIFICATIONS_PER_SECOND * app_module.ALTCHA_CHALLENGE_TTL
+    backend = app_module.create_state_backend(f"sqlite:///{tmp_path}/state.sqlite3")
+    assert isinstance(backend, app_module.SQLiteStateBackend)
+    assert backend.path == f"{tmp_path}/state.sqlite3"
+    with pytest.raises(ValueError):
+        app_module.create_state_backend("ftp://nope")
+
+
+def test_alias_reservations_use_shared_state(state_backend):
+    first, second = app_module.AliasReservations(), app_module.AliasReservations()
+    assert first.reserve("svc1234@example.com") is True
+    assert second.reserve("svc1234@example.com") is False
+    assert state_backend.get("alias-reservation:svc1234@example.com") == 1
+
+
+# --- metrics ----------------------------------------------------------------
+
+def sample(name, **labels):
+    return app_module.REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_endpoint(anon_client):
+    anon_client.post("/api/auth", json={"password": "nope"})
+    body = anon_client.get("/metrics").get_data(as_text=True)
+    assert 'auth_failures_total{reason="password"}' in body
+    assert 'http_requests_total{method="POST",route="/api/auth",status="401"}' in body
+
+
+def test_metrics_count_requests_auth_and_caches(client):
+    requests_before = sample("http_requests_total", route="/api/create-alias", method="POST", status="200")
+    index_before = sample("cache_lookups_total", cache="alias_index", result="hit")
+    auth_before = sample("auth_successes_total")
+
+    client.post("/api/create-alias", json={"alias": "m1@example.com", "redirectTo": "d@example.com"})
+    client.post("/api/auth", json={"password": "hashed-pass"})
+
+    assert sample("http_requests_total", route="/api/create-alias", method="POST", status="200") == requests_before + 1
+    assert sample("http_request_duration_seconds_count", route="/api/create-alias", method="POST") > 0
+    assert sample("cache_lookups_total", cache="alias_index", result="hit") == index_before + 1
+    assert sample("auth_successes_total") == auth_before + 1
+    unmatched = sample("http_requests_total", route="unmatched", method="GET", status="404")
+    client.get("/no-such-page")
+    assert sample("http_requests_total", route="unmatched", method="GET", status="404") == unmatched + 1
+
+
+def test_metrics_mailcow_calls(monkeypatch):
+    import requests
+
+    client = app_module.MailcowClient("https://mail.test", "KEY", retries=0)
+    monkeypatch.setattr(client.session, "request", lambda *a, **k: FakeResponse(status_code=500))
+    before = sample("mailcow_api_errors_total", endpoint="get/alias/all", error="HTTP 500")
+    client.get_aliases()
+    assert sample("mailcow_api_errors_total", endpoint="get/alias/all", error="HTTP 500") == before + 1
+    # Lookups of one alias share a series instead of one per address.
+    before = sample("mailcow_api_errors_total", endpoint="get/alias/{address}", error="HTTP 500")
+    client.get_alias("x1@example.com")
+    client.get_alias("x2@example.com")
+    assert sample("mailcow_api_errors_total", endpoint="get/alias/{address}", error="HTTP 500") == before + 2
+    assert app_module.REGISTRY.get_sample_value("mailcow_api_duration_seconds_count",
+                                                {"endpoint": "get/alias/x1@example.com"}) is None
+
+    def refuse(*args, **kwargs):
+        raise requests.exceptions.ConnectionError("refused")
+
+    monkeypatch.setattr(client.session, "request", refuse)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get_version()
+    assert sample("mailcow_api_errors_total", endpoint="get/status/version", error="ConnectionError") >= 1
+    assert sample("mailcow_api_duration_seconds_count", endpoint="get/status/version") >= 1
+
+
+def test_metrics_altcha_verify_and_config_reloads(config_file):
+    before = sample("altcha_verify_duration_seconds_count", provider="local", result="invalid")
+    app_module.verify_altcha_solution("not-base64-json", LOCAL_CONFIG)
+    assert sample("altcha_verify_duration_seconds_count", provider="local", result="invalid") == before + 1
+
+    reloads = sample("config_reloads_total")
+    store = app_module.ConfigStore(str(config_file))
+    store.get()
+    store.get()
+    assert sample("config_reloads_total") == reloads + 1
+
+
+def test_metrics_token(anon_client, monkeypatch):
+    monkeypatch.setattr(app_module, "load_config", lambda: dict(TEST_CONFIG, metrics_token="s3cret"))
+    assert anon_client.get("/metrics").status_code == 401
+    response = anon_client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+
+
+def test_metrics_aggregated_across_processes(tmp_path):
+    """Samples written by separate worker processes are summed by /metrics."""
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def run(code):
+        return subprocess.run(
+            [sys.executable, "-c", "import app\n" + code],
+            cwd=root, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+
+    for _ in range(2):  # two "workers"
+        run("app.AUTH_SUCCESSES.inc()")
+    body = run(
+        "app.load_config = lambda: {}\n"
+        "print(app.app.test_client().get('/metrics').get_data(as_text=True))"
+    )
+    assert "auth_successes_total 2.0" in body